@@ -1,14 +1,21 @@
 import os, io, csv, base64,re
 from datetime import datetime, date, timedelta
-import os, gc
-IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "50"))
+import os, gc, time, hashlib, tempfile, threading, codecs, itertools, json, uuid, shutil, zipfile
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, Response, jsonify, jsonify, jsonify
+from flask import Flask, current_app, render_template, request, redirect, url_for, flash, send_file, Response, jsonify, g, has_app_context, stream_with_context, session, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user, UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
-from sqlalchemy import inspect,text, func, case
+from collections import OrderedDict, namedtuple
+from bisect import bisect_left, insort
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from sqlalchemy import inspect,text, func, case, update, or_, tuple_, event, select, cast, Numeric, bindparam
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from werkzeug.middleware.proxy_fix import ProxyFix  # trust proxy headers on Render
 
 try:
@@ -20,24 +27,9 @@ try:
 except Exception:
     qrcode = None
 
-app = Flask(__name__, static_folder="static", static_url_path="/static")
-
-app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1, x_prefix=1)
-
-# ---------------------- Core settings ----------------------
-# SECRET_KEY from environment (set it in Render → Environment)
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "change-me-please")
-
 # Optional: set timezone for logs (purely informational)
 os.environ.setdefault("TZ", "Asia/Beirut")
 
-# Limit upload size (defensive; adjust for your XLSX size)
-app.config["MAX_CONTENT_LENGTH"] = 12 * 1024 * 1024  # 16 MB
-
-# JSON settings (optional)
-app.config["JSON_SORT_KEYS"] = False
-app.config["JSON_AS_ASCII"] = False
-
 # ---------------------- Database URL (Render/Neon) ----------------------
 db_url = os.getenv("DATABASE_URL", "sqlite:///invoices.db")
 
@@ -45,33 +37,15 @@ db_url = os.getenv("DATABASE_URL", "sqlite:///invoices.db")
 if db_url.startswith("postgresql://"):
     db_url = db_url.replace("postgresql://", "postgresql+psycopg2://", 1)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = db_url
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-
-# Connection pool tuning for Neon/Render (reduces cold-start/db reconnect latency)
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_pre_ping": True,       # drop dead connections quickly
-    "pool_size": 5,              # small pool for free tiers
-    "max_overflow": 5,
-    "pool_recycle": 280,         # recycle before common idle timeouts
-    # For Neon over SSL:
-    "connect_args": {"sslmode": "require"} if db_url.startswith("postgresql+psycopg2://") else {},
-}
-
-# ---------------------- Init extensions ----------------------
-db = SQLAlchemy(app)
+# ---------------------- Extensions (bound in create_app) ----------------------
+db = SQLAlchemy()
 
-login_manager = LoginManager(app)
+login_manager = LoginManager()
 login_manager.login_view = "login"   # make sure you have endpoint=login
 login_manager.login_message = "الرجاء تسجيل الدخول."
 
-# HTTP compression (gzip) for faster page loads
-if Compress is not None:
-    Compress(app)
-
 # ---------------------- Static caching headers ----------------------
 # Cache /static assets aggressively in browsers & Cloudflare (after you enable proxy)
-@app.after_request
 def _add_cache_headers(resp):
     # Long cache for static files (immutable if filenames change with versioning)
     if request.path.startswith("/static/"):
@@ -81,8 +55,74 @@ def _add_cache_headers(resp):
         resp.headers.setdefault("Cache-Control", "no-store")
     return resp
 
+# ---------------------- Conditional GET (ETag / 304) ----------------------
+# Pages and APIs built from a few rows (one invoice, the pricing row, the
+# monthly rollup) call revalidate() with what they depend on before doing any
+# rendering; a matching If-None-Match / If-Modified-Since gets a bare 304.
+def _deploy_salt() -> str:
+    """Changes when the code or templates do, so an old ETag never matches a new layout."""
+    salt = os.getenv("ETAG_SALT") or os.getenv("RENDER_GIT_COMMIT")
+    if salt:
+        return salt
+    base = os.path.dirname(os.path.abspath(__file__))
+    tdir = os.path.join(base, "templates")
+    try:
+        mtimes = [os.path.getmtime(os.path.join(tdir, f)) for f in os.listdir(tdir)]
+    except OSError:
+        mtimes = []
+    return str(int(max(mtimes + [os.path.getmtime(os.path.abspath(__file__))])))
+
+ETAG_SALT = _deploy_salt()
+
+def revalidate(*parts, last_modified=None):
+    """
+    Weak ETag from `parts` (+ the user and deploy) and optional Last-Modified.
+    Returns a 304 response when the client's copy is current, else None and the
+    validators are added to the eventual 200 by _apply_validators.
+    Pending flash messages disable it: that page must be rendered for real.
+    """
+    if request.method != "GET" or session.get("_flashes"):
+        return None
+    raw = "|".join(str(p) for p in (ETAG_SALT, getattr(current_user, "id", ""), *parts))
+    etag = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+    g._validators = (etag, last_modified)
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        ims = request.if_modified_since
+        fresh = bool(last_modified and ims and last_modified <= ims.replace(tzinfo=None))
+    if not fresh:
+        return None
+    resp = Response(status=304)
+    _apply_validators(resp)
+    return resp
+
+def revalidate_invoice(invoice_id: int):
+    """
+    revalidate() for pages showing one invoice: keyed on its sync_version / updated_at
+    and the pricing row (the money filters format with its currency). 404 if missing.
+    """
+    row = db.session.query(Invoice.updated_at, Invoice.sync_version).filter(Invoice.id == invoice_id).first()
+    if row is None:
+        abort(404)
+    p = get_pricing()
+    stamps = [d for d in (row.updated_at, p.updated_at) if d]
+    return revalidate("invoice", invoice_id, row.sync_version, row.updated_at, p.id, p.updated_at,
+                      request.query_string, last_modified=max(stamps) if stamps else None)
+
+def _apply_validators(resp):
+    validators = g.pop("_validators", None)
+    if validators and resp.status_code in (200, 304):
+        etag, last_modified = validators
+        resp.set_etag(etag, weak=True)
+        if last_modified is not None:
+            resp.last_modified = last_modified
+        resp.headers["Cache-Control"] = "private, no-cache"   # store, but ask every time
+    return resp
+
 # ---------------------- (Optional) Security headers ----------------------
-@app.after_request
 def _security_headers(resp):
     resp.headers.setdefault("X-Content-Type-Options", "nosniff")
     resp.headers.setdefault("X-Frame-Options", "SAMEORIGIN")
@@ -91,60 +131,7 @@ def _security_headers(resp):
     # resp.headers.setdefault("Content-Security-Policy", "default-src 'self'; img-src 'self' data:; style-src 'self' 'unsafe-inline';")
     return resp
 
-# ---------------------- Bootstrap DB / lightweight migrations ----------------------
-with app.app_context():
-    try:
-        db.create_all()
-    except Exception:
-        pass
-
-    # Example: cross-DB column checks (no PRAGMA)
-    insp = inspect(db.engine)
-
-    def table_exists(name: str) -> bool:
-        try:
-            return name in insp.get_table_names()
-        except Exception:
-            return False
-
-    def has_column(table: str, col: str) -> bool:
-        try:
-            return any(c.get("name") == col for c in insp.get_columns(table))
-        except Exception:
-            return False
-
-    # users.is_admin (safe on Postgres & SQLite)
-    try:
-        if table_exists("users") and not has_column("users", "is_admin"):
-            db.session.execute(text(
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin BOOLEAN NOT NULL DEFAULT FALSE"
-            ))
-            db.session.commit()
-    except Exception:
-        db.session.rollback()
-
-    # pricing.fee_15 (safe on Postgres & SQLite)
-    try:
-        if table_exists("pricing") and not has_column("pricing", "fee_15"):
-            db.session.execute(text(
-                "ALTER TABLE pricing ADD COLUMN IF NOT EXISTS fee_15 REAL NOT NULL DEFAULT 0"
-            ))
-            db.session.commit()
-    except Exception:
-        db.session.rollback()
-       
-app = Flask(__name__)
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY") or "dev-key-change-me"
-#app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///invoices.db"
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL") or "sqlite:///invoices.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config['JSON_AS_ASCII'] = False
-db = SQLAlchemy(app)
-
-
 # ---- Keep user filters (ym/start/end) across actions ----
-from flask import make_response
-
 def _current_filter_args():
     keys = ("ym", "start", "end", "status", "q")
     out = {}
@@ -154,7 +141,6 @@ def _current_filter_args():
             out[k] = v
     return out
 
-@app.after_request
 def _remember_filters(resp):
     try:
         for k in ("ym", "start", "end", "status", "q"):
@@ -165,6 +151,144 @@ def _remember_filters(resp):
         pass
     return resp
 
+# ---------------------- Routes registry ----------------------
+# Views, template filters and context processors below are declared with
+# @routes.* and recorded here; create_app() applies them to every app it
+# builds, so the factory returns a complete, independent app each call.
+class RouteRegistry:
+    def __init__(self):
+        self._setup = []   # (Flask method name, args, kwargs, function)
+
+    def _record(self, method, *args, **kwargs):
+        def decorator(f):
+            self._setup.append((method, args, kwargs, f))
+            return f
+        return decorator
+
+    def route(self, rule, **options):
+        return self._record("route", rule, **options)
+
+    def get(self, rule, **options):
+        return self._record("get", rule, **options)
+
+    def post(self, rule, **options):
+        return self._record("post", rule, **options)
+
+    def template_filter(self, name=None):
+        return self._record("template_filter", name)
+
+    def context_processor(self, f):
+        self._setup.append(("context_processor", None, None, f))
+        return f
+
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        self._setup.append(("add_url_rule", (rule, endpoint, view_func), options, None))
+
+    def init_app(self, app: Flask) -> None:
+        for method, args, kwargs, f in self._setup:
+            if method == "context_processor":
+                app.context_processor(f)
+            elif f is None:
+                getattr(app, method)(*args, **kwargs)
+            else:
+                getattr(app, method)(*args, **kwargs)(f)
+
+routes = RouteRegistry()
+
+# ---------------------- App factory ----------------------
+def create_app(config: dict = None) -> Flask:
+    """
+    Build a fully configured app: settings (then `config` overrides), engine/pool
+    options, ProxyFix, compression, response hooks and every registered route.
+    Runs the startup schema check unless AUTO_MIGRATE=0. The module-level `app`
+    at the bottom of this file is one call of this; gunicorn serves wsgi:app.
+    """
+    app = Flask(__name__, static_folder="static", static_url_path="/static")
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1, x_prefix=1)
+
+    # ---------------------- Core settings ----------------------
+    # SECRET_KEY from environment (set it in Render → Environment)
+    app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "change-me-please")
+
+    # Limit upload size. Imports are streamed (uploads spool to disk, XLSX is
+    # read in read-only mode), so this can be raised safely via MAX_UPLOAD_MB.
+    app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_UPLOAD_MB", "64")) * 1024 * 1024
+
+    # JSON settings (optional)
+    app.config["JSON_SORT_KEYS"] = False
+    app.config["JSON_AS_ASCII"] = False
+    app.json.sort_keys = False
+    app.json.ensure_ascii = False
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = db_url
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    # Connection pool tuning for Neon/Render (reduces cold-start/db reconnect latency)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_pre_ping": True,       # drop dead connections quickly
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),   # small pool for free tiers
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        "pool_recycle": 280,         # recycle before common idle timeouts
+        # For Neon over SSL:
+        "connect_args": {"sslmode": "require"} if db_url.startswith("postgresql+psycopg2://") else {},
+    }
+
+    app.config.update(config or {})
+
+    # ---------------------- Init extensions ----------------------
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    # HTTP compression (gzip) for faster page loads
+    if Compress is not None:
+        app.extensions["compress"] = Compress(app)
+
+    app.after_request(_add_cache_headers)
+    app.after_request(_apply_validators)
+    app.after_request(_security_headers)
+    app.after_request(_remember_filters)
+
+    routes.init_app(app)
+
+    with app.app_context():
+        ensure_schema()
+    return app
+
+def startup_self_check(app: Flask) -> dict:
+    """
+    Report the settings that are actually in effect (pool, compression, proxy),
+    so a silently discarded configuration shows up in the startup log.
+    """
+    with app.app_context():
+        engine = db.engine
+        pool = engine.pool
+        wanted = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        info = {
+            "engine": engine.name,
+            "pool": type(pool).__name__,
+            "pool_size": pool.size() if hasattr(pool, "size") else None,
+            "max_overflow": getattr(pool, "_max_overflow", None),
+            "pool_pre_ping": bool(getattr(pool, "_pre_ping", False)),
+            "pool_recycle": getattr(pool, "_recycle", None),
+            "compress": "compress" in app.extensions,
+            "proxy_fix": isinstance(app.wsgi_app, ProxyFix),
+            "max_upload_mb": (app.config.get("MAX_CONTENT_LENGTH") or 0) // (1024 * 1024),
+        }
+    problems = []
+    if wanted.get("pool_pre_ping") and not info["pool_pre_ping"]:
+        problems.append("pool_pre_ping not applied")
+    if info["pool_size"] is not None and wanted.get("pool_size") not in (None, info["pool_size"]):
+        problems.append(f"pool_size {info['pool_size']} != {wanted.get('pool_size')}")
+    if not info["compress"]:
+        problems.append("Flask-Compress not active (pip install Flask-Compress)")
+    if not info["proxy_fix"]:
+        problems.append("ProxyFix not installed")
+    info["problems"] = problems
+    print("[startup] " + " ".join(f"{k}={v}" for k, v in info.items() if k != "problems"))
+    for msg in problems:
+        print("[startup] WARNING:", msg)
+    return info
+
 
 # ---------------- Models ----------------
 class User(UserMixin, db.Model):
@@ -219,10 +343,45 @@ class Invoice(db.Model):
     energy_cost = db.Column(db.Float, nullable=False, default=0.0)
     month_cost = db.Column(db.Float, nullable=False, default=0.0)
     total_due = db.Column(db.Float, nullable=False, default=0.0)
+    search_text = db.Column(db.Text, nullable=True)   # normalized name/branch/meter/number, see normalize_search()
+    billing_month = db.Column(db.String(7), nullable=True)   # "YYYY-MM" of date; one invoice per branch per month
+    sync_version = db.Column(db.BigInteger, nullable=True)    # "sync" counter value of the last commit that wrote it
+    updated_at = db.Column(db.DateTime, nullable=True, index=True)   # time of that commit (stamped with sync_version)
+
+    __table_args__ = (db.Index("ux_invoices_branch_month", "branch_number", "billing_month", unique=True),
+                      db.Index("ix_invoices_sync", "sync_version", "id"))
+
+class BranchState(db.Model):
+    """Latest invoice per branch, kept in step with invoices on every commit (see refresh_branch_state)."""
+    __tablename__ = "branch_state"
+    branch_number = db.Column(db.String(64), primary_key=True)
+    last_invoice_id = db.Column(db.Integer, nullable=False)
+    last_invoice_number = db.Column(db.String(64), nullable=True)
+    last_date = db.Column(db.Date, nullable=False)
+    last_billed_month = db.Column(db.String(7), nullable=False)   # "YYYY-MM" of last_date
+    last_reading = db.Column(db.Integer, nullable=False, default=0)
+    customer_name = db.Column(db.String(255), nullable=True)
+    meter_number = db.Column(db.String(64), nullable=True)
+    subscription_amps = db.Column(db.Integer, nullable=True)
+    subscription_fee = db.Column(db.Float, nullable=True)
+    unit_price = db.Column(db.Float, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # Invoice-shaped aliases so callers of last_for_branch() need no changes
+    id = property(lambda self: self.last_invoice_id)
+    invoice_number = property(lambda self: self.last_invoice_number)
+    date = property(lambda self: self.last_date)
+    curr_reading = property(lambda self: self.last_reading)
+
+class Counter(db.Model):
+    """Named monotonic counters, e.g. "invoice:202509" = last invoice suffix used that month."""
+    __tablename__ = "counters"
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
 
 # ---------------- Helpers ----------------
 
-@app.template_filter("money")
+@routes.template_filter("money")
 def money(val):
     try:
         p = get_pricing()
@@ -240,7 +399,7 @@ def money(val):
             return str(val)
 
 
-@app.template_filter("money_lbp")
+@routes.template_filter("money_lbp")
 def money_lbp(val):
     try:
         amt = float(val or 0.0)
@@ -248,7 +407,7 @@ def money_lbp(val):
     except Exception:
         return str(val)
 
-@app.template_filter("money_usd")
+@routes.template_filter("money_usd")
 def money_usd(val):
     try:
         p = get_pricing()
@@ -261,7 +420,7 @@ def money_usd(val):
         except Exception:
             return str(val)
 
-@app.template_filter("money_both")
+@routes.template_filter("money_both")
 def money_both(val):
     # e.g. "1,234,567 ل.ل  /  $13.79"
     try:
@@ -271,39 +430,59 @@ def money_both(val):
 
 
 # Make helpers available in templates
-@app.context_processor
+@routes.context_processor
 def inject_helpers():
     return dict(get_pricing=get_pricing)
 
-def get_pricing() -> Pricing:
-    """
-    Robust getter that auto-creates the pricing row and self-heals columns if needed,
-    using SQLAlchemy's inspector (works on Postgres & SQLite).
-    """
-    insp = inspect(db.engine)
+# ---------------- Cross-worker cache stamps ----------------
+# Each gunicorn worker keeps its own in-process caches. A tiny "stamp" file per
+# cache name (shared by all workers on the host) tells the others to reload
+# after a write, without any extra DB round trip.
+CACHE_STAMP_DIR = os.getenv("CACHE_STAMP_DIR") or os.path.join(
+    tempfile.gettempdir(),
+    "invoice_app_stamps_" + hashlib.sha1(db_url.encode("utf-8")).hexdigest()[:10],
+)
 
-    # Self-heal columns in a cross-DB way (no PRAGMA)
-    try:
-        cols = {c['name'] for c in insp.get_columns('pricing')}
-    except Exception:
-        cols = set()
+def _stamp_path(name: str) -> str:
+    return os.path.join(CACHE_STAMP_DIR, f"{name}.stamp")
 
+def read_cache_stamp(name: str) -> str:
     try:
-        if 'currency_code' not in cols:
-            # Postgres & SQLite friendly
-            db.session.execute(text(
-                "ALTER TABLE pricing ADD COLUMN IF NOT EXISTS currency_code TEXT NOT NULL DEFAULT 'LBP'"
-            ))
-        if 'usd_rate' not in cols:
-            db.session.execute(text(
-                "ALTER TABLE pricing ADD COLUMN IF NOT EXISTS usd_rate REAL NOT NULL DEFAULT 90000"
-            ))
-        db.session.commit()
-    except Exception:
-        db.session.rollback()
-        # If inspector failed or ALTER blocked, continue—row creation below will still work
+        with open(_stamp_path(name), "r", encoding="ascii") as fh:
+            return fh.read()
+    except OSError:
+        return ""
 
-    # Fetch or create the pricing row
+def bump_cache_stamp(name: str) -> None:
+    try:
+        os.makedirs(CACHE_STAMP_DIR, exist_ok=True)
+        tmp_path = _stamp_path(name) + f".{os.getpid()}"
+        with open(tmp_path, "w", encoding="ascii") as fh:
+            fh.write(f"{time.time_ns()}-{os.getpid()}")
+        os.replace(tmp_path, _stamp_path(name))  # atomic for concurrent readers
+    except OSError as e:
+        print("[cache] could not bump stamp", name, e)
+
+# ---------------- Pricing cache ----------------
+# Safety net for multi-host deployments where the stamp file is not shared.
+PRICING_CACHE_TTL = float(os.getenv("PRICING_CACHE_TTL", "300"))
+
+class PricingSnapshot:
+    """Read-only copy of the current pricing row, safe to share between requests."""
+    __slots__ = ("id", "unit_price", "fee_20", "fee_15", "fee_10", "fee_5",
+                 "currency_code", "usd_rate", "updated_at")
+
+    def __init__(self, p: Pricing):
+        for name in self.__slots__:
+            setattr(self, name, getattr(p, name))
+
+    fee_for_amp = Pricing.fee_for_amp
+
+_pricing_cache = {"snapshot": None, "stamp": None, "loaded_at": 0.0}
+_pricing_lock = threading.Lock()
+
+def _pricing_row() -> Pricing:
+    """Fetch (or create) the pricing row as a live ORM object, for writers."""
     p = Pricing.query.order_by(Pricing.id.desc()).first()
     if not p:
         p = Pricing(
@@ -314,6 +493,37 @@ def get_pricing() -> Pricing:
         db.session.commit()
     return p
 
+def get_pricing() -> PricingSnapshot:
+    """
+    Current pricing, cached per request (flask.g) and per process.
+    The process copy is reloaded when another worker bumps the "pricing" stamp
+    (see invalidate_pricing_cache) or after PRICING_CACHE_TTL seconds.
+    """
+    in_ctx = has_app_context()
+    if in_ctx:
+        snap = g.get("_pricing")
+        if snap is not None:
+            return snap
+
+    stamp = read_cache_stamp("pricing")
+    snap = _pricing_cache["snapshot"]
+    if (snap is None or _pricing_cache["stamp"] != stamp
+            or time.monotonic() - _pricing_cache["loaded_at"] > PRICING_CACHE_TTL):
+        snap = PricingSnapshot(_pricing_row())
+        with _pricing_lock:
+            _pricing_cache.update(snapshot=snap, stamp=stamp, loaded_at=time.monotonic())
+
+    if in_ctx:
+        g._pricing = snap
+    return snap
+
+def invalidate_pricing_cache() -> None:
+    """Drop cached pricing here and signal the other workers to reload it."""
+    with _pricing_lock:
+        _pricing_cache.update(snapshot=None, stamp=None, loaded_at=0.0)
+    if has_app_context():
+        g.pop("_pricing", None)
+    bump_cache_stamp("pricing")
 
 
 def month_bounds(d: date):
@@ -325,35 +535,125 @@ def month_bounds(d: date):
     return first, next_first
 
 def last_for_branch(branch_number: str):
+    """Latest invoice of a branch (as its BranchState row): a single primary-key lookup."""
     if not branch_number: return None
+    if branch_state_ready():
+        return db.session.get(BranchState, branch_number)
     return Invoice.query.filter_by(branch_number=branch_number).order_by(Invoice.date.desc(), Invoice.id.desc()).first()
 
 def month_key(d: date) -> str:
     return d.strftime("%Y-%m")
 
-def existing_invoice_for_month(branch_number: str, d: date):
-    """Return the most recent invoice for this branch in the same month as date d, or None."""
+def existing_invoice_for_month(branch_number: str, d: date, state=None):
+    """
+    Return this branch's invoice for the month of date d, or None.
+    Answered from branch_state (pass `state` if already loaded) unless d is before the
+    branch's last billed month, which needs the invoices table.
+    """
     if not branch_number or not d:
         return None
-    first, next_first = month_bounds(d)
+    if branch_state_ready():
+        st = state if state is not None else db.session.get(BranchState, branch_number)
+        if st is None or month_key(d) > st.last_billed_month:
+            return None
+        if month_key(d) == st.last_billed_month:
+            return st
     return (Invoice.query
             .filter(Invoice.branch_number == branch_number)
-            .filter(Invoice.date >= first)
-            .filter(Invoice.date <  next_first)
-            .order_by(Invoice.date.desc(), Invoice.id.desc())
+            .filter(Invoice.billing_month == month_key(d))
             .first())
 
 def has_invoice_in_month(branch_number: str, d: date) -> bool:
     return existing_invoice_for_month(branch_number, d) is not None
 
-def next_invoice_number_for_date(d: date) -> str:
-    yyyymm = d.strftime("%Y%m"); prefix = f"{yyyymm}-"
-    rows = Invoice.query.filter(Invoice.invoice_number.like(f"{prefix}%")).all()
+def dialect_insert(table):
+    """INSERT construct with ON CONFLICT support (Postgres and SQLite >= 3.24)."""
+    if db.engine.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as _insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as _insert
+    return _insert(table)
+
+# ---------------- One invoice per branch per month ----------------
+# invoices.billing_month ("YYYY-MM" of date) carries a unique (branch_number,
+# billing_month) index; create paths INSERT ... ON CONFLICT against it instead
+# of checking first, so two clerks can't bill the same month twice.
+def billing_month_conflict(tbl=None) -> dict:
+    tbl = Invoice.__table__ if tbl is None else tbl
+    return {"index_elements": [tbl.c.branch_number, tbl.c.billing_month]}
+
+def insert_invoice(inv):
+    """
+    INSERT a new (unsaved) Invoice unless its branch is already billed for that
+    month. Returns the new id, or None on conflict — the caller rolls back,
+    which also returns the invoice number it reserved.
+    """
+    tbl = Invoice.__table__
+    values = {c.key: getattr(inv, c.key) for c in tbl.columns
+              if c.key != "id" and getattr(inv, c.key) is not None}
+    values["billing_month"] = month_key(values["date"])
+    values["search_text"] = invoice_search_text(values)
+    # row as execute params, so the session hooks see its branch and month
+    stmt = (dialect_insert(tbl)
+            .on_conflict_do_nothing(**billing_month_conflict(tbl))
+            .returning(tbl.c.id))
+    return db.session.execute(stmt, values).scalar()
+
+def bump_counter(name: str, n: int = 1, seed=0) -> int:
+    """
+    Atomically add n to counter `name` inside the current transaction and return
+    the new value. `seed` (value or callable) is the starting point when the
+    counter row does not exist yet. On Postgres the row stays locked until
+    commit, so concurrent workers get disjoint ranges.
+    """
+    tbl = Counter.__table__
+    val = db.session.execute(
+        update(tbl).where(tbl.c.name == name)
+        .values(value=tbl.c.value + n)
+        .returning(tbl.c.value)
+    ).scalar()
+    if val is None:
+        start = int(seed() if callable(seed) else (seed or 0))
+        ins = dialect_insert(tbl).values(name=name, value=start + n)
+        ins = ins.on_conflict_do_update(index_elements=[tbl.c.name],
+                                        set_={"value": tbl.c.value + n})
+        val = db.session.execute(ins.returning(tbl.c.value)).scalar()
+    return int(val)
+
+def _max_invoice_suffix(prefix: str) -> int:
+    """Largest numeric suffix already used with this prefix (legacy rows; column-only scan)."""
     max_suffix = 0
-    for r in rows:
-        try: max_suffix = max(max_suffix, int(r.invoice_number.split("-")[-1]))
+    for (num,) in db.session.query(Invoice.invoice_number).filter(Invoice.invoice_number.like(f"{prefix}%")):
+        try: max_suffix = max(max_suffix, int(num.split("-")[-1]))
         except Exception: pass
-    return f"{prefix}{(max_suffix+1):04d}"
+    return max_suffix
+
+def reserve_invoice_numbers(d: date, n: int = 1) -> list:
+    """Reserve n consecutive invoice numbers for d's month in one round trip."""
+    if n <= 0:
+        return []
+    yyyymm = d.strftime("%Y%m"); prefix = f"{yyyymm}-"
+    last = bump_counter(f"invoice:{yyyymm}", n, seed=lambda: _max_invoice_suffix(prefix))
+    return [f"{prefix}{k:04d}" for k in range(last - n + 1, last + 1)]
+
+def next_invoice_number_for_date(d: date) -> str:
+    return reserve_invoice_numbers(d, 1)[0]
+
+def sync_invoice_counter(invoice_number: str) -> None:
+    """Keep the month counter ahead of an externally supplied number like 202509-0123."""
+    m = re.match(r"^(\d{6})-(\d+)$", (invoice_number or "").strip())
+    if not m:
+        return
+    name, value = f"invoice:{m.group(1)}", int(m.group(2))
+    tbl = Counter.__table__
+    hit = db.session.execute(
+        update(tbl).where(tbl.c.name == name, tbl.c.value < value).values(value=value)
+    ).rowcount
+    if not hit:
+        db.session.execute(
+            dialect_insert(tbl).values(name=name, value=max(value, _max_invoice_suffix(f"{m.group(1)}-")))
+            .on_conflict_do_nothing(index_elements=[tbl.c.name])
+        )
 
 def apply_pricing_defaults(inv: Invoice, pricing: Pricing):
     if inv.unit_price in (None, 0):
@@ -363,9 +663,6 @@ def apply_pricing_defaults(inv: Invoice, pricing: Pricing):
         inv.subscription_fee = float(fee or 0.0)
 
 # ---------------- Auth ----------------
-login_manager = LoginManager(app)
-login_manager.login_view = "login"
-
 @login_manager.user_loader
 def load_user(user_id):
     try: return db.session.get(User, int(user_id))
@@ -388,12 +685,12 @@ def role_required(role):
     return decorator
 
 # ---------------- Pricing page ----------------
-@app.route("/pricing", methods=["GET","POST"], endpoint="pricing_page")
+@routes.route("/pricing", methods=["GET","POST"], endpoint="pricing_page")
 @login_required
 @role_required("admin")
 
 def pricing_page():
-    p = get_pricing()
+    p = _pricing_row()
     if request.method == "POST":
         try:
             # Save currency selection and rate
@@ -424,6 +721,7 @@ def pricing_page():
 
             p.updated_at = datetime.utcnow()
             db.session.commit()
+            invalidate_pricing_cache()
             flash("تم حفظ التسعير.", "success")
         except Exception as e:
             db.session.rollback()
@@ -453,52 +751,226 @@ def pricing_page():
 # ---------------- Routes ----------------
 
 
-@app.route("/bulk/update-unit-price", methods=["POST"], endpoint="bulk_update_unit_price")
+# ---------------- Set-based repricing ----------------
+REPRICE_CHUNK = int(os.getenv("REPRICE_CHUNK", "5000"))   # ids per UPDATE statement
+
+def _round2(expr):
+    # ROUND(x, 2) needs NUMERIC on Postgres (there is no round(double precision, int))
+    return func.round(cast(expr, Numeric), 2)
+
+def reprice_invoices(start_date: date, end_date: date, unit_price=None, fees=None, chunk=None) -> int:
+    """
+    Recompute kwh_used / energy_cost / month_cost / total_due in SQL for invoices
+    with start_date <= date < end_date, the same way compute_invoice_totals()
+    does in Python. unit_price (if given) replaces each invoice's unit price;
+    fees ({amps: fee}, e.g. from Pricing.fee_*) replaces subscription_fee for
+    those amperages. Runs one UPDATE per id range of `chunk` rows, all in the
+    caller's transaction (the caller commits once, so a failure part-way
+    rolls back the whole month), and returns the number of invoices updated.
+    """
+    chunk = int(chunk or REPRICE_CHUNK)
+    in_range = (Invoice.date >= start_date, Invoice.date < end_date)
+    lo, hi = db.session.query(func.min(Invoice.id), func.max(Invoice.id)).filter(*in_range).one()
+    if lo is None:
+        return 0
+
+    diff = Invoice.curr_reading - Invoice.prev_reading
+    kwh = case((diff > 0, diff), else_=0)
+    price = Invoice.unit_price if unit_price is None else float(unit_price)
+    fee = Invoice.subscription_fee
+    if fees:
+        fee = case(*[(Invoice.subscription_amps == int(a), float(f)) for a, f in fees.items()],
+                   else_=Invoice.subscription_fee)
+    energy = _round2(kwh * price)
+    values = dict(kwh_used=kwh, energy_cost=energy, month_cost=fee, total_due=_round2(energy + fee))
+    if unit_price is not None:
+        values["unit_price"] = float(unit_price)
+    if fees:
+        values["subscription_fee"] = fee
+
+    count = 0
+    for first_id in range(lo, hi + 1, chunk):
+        res = db.session.execute(
+            update(Invoice)
+            .where(*in_range, Invoice.id >= first_id, Invoice.id < first_id + chunk)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        count += res.rowcount or 0
+    return count
+
+@routes.route("/bulk/update-unit-price", methods=["POST"], endpoint="bulk_update_unit_price")
 @login_required
 @role_required("admin")
 def bulk_update_unit_price():
     """
-    Bulk update invoices' unit_price (LBP only) for a specific month/year.
+    Bulk update invoices' unit_price (LBP only) for a specific month/year,
+    optionally re-applying the current subscription fee per amperage.
     """
     try:
         month = int(request.form.get("month") or 0)
         year  = int(request.form.get("year") or 0)
-        unit_price_input = float(request.form.get("unit_price_input") or 0.0)
+        raw_price = (request.form.get("unit_price_input") or "").strip()
+        reprice_fees = request.form.get("reprice_fees") in ("1", "on", "true")
 
         if month < 1 or month > 12 or year < 1900:
             flash("برجاء اختيار شهر وسنة صالحَين.", "error")
             return redirect(request.referrer or url_for("pricing_page"))
+        if not raw_price and not reprice_fees:
+            flash("أدخل سعر الك.و.س أو اختر تحديث رسوم الاشتراك.", "error")
+            return redirect(request.referrer or url_for("pricing_page"))
 
-        # Always treat input as LBP (no currency conversion)
-        unit_price_lbp = unit_price_input
-
-        # Date range for selected month
-        start_date = date(year, month, 1)
-        end_date = date(year + (1 if month == 12 else 0),
-                        1 if month == 12 else month + 1,
-                        1)
-
-        # Query and update invoices
-        q = Invoice.query.filter(Invoice.date >= start_date, Invoice.date < end_date)
-        count = 0
-        for inv in q.all():
-            inv.unit_price = unit_price_lbp
-            inv.kwh_used = max(0, (inv.curr_reading or 0) - (inv.prev_reading or 0))
-            inv.energy_cost = round(inv.kwh_used * float(inv.unit_price or 0), 2)
-            inv.month_cost = float(inv.subscription_fee or 0)
-            inv.total_due = round((inv.energy_cost or 0) + (inv.month_cost or 0), 2)
-            count += 1
+        # Always treat input as LBP (no currency conversion); blank keeps each invoice's price
+        unit_price_lbp = float(raw_price) if raw_price else None
 
-        db.session.commit()
+        fees = None
+        if reprice_fees:
+            p = get_pricing()
+            fees = {a: p.fee_for_amp(a) for a in (5, 10, 15, 20)}
+
+        start_date, end_date = month_bounds(date(year, month, 1))
+        count = reprice_invoices(start_date, end_date, unit_price=unit_price_lbp, fees=fees)
+        db.session.commit()   # invoice/rollup caches are invalidated by the commit hooks
         flash(f"تم تحديث تسعيرة ك.و.س ({count} فاتورة) لشهر {month:02d}/{year}.", "success")
 
     except Exception as e:
         db.session.rollback()
-        flash("حدث خطأ أثناء التحديث.", "error")
+        print("[reprice] failed:", e)
+        flash("حدث خطأ أثناء التحديث، ولم يتم تعديل أي فاتورة.", "error")
 
     return redirect(request.referrer or url_for("pricing_page"))
+# ---------------- What-if tariff simulator ----------------
+# Read-only: loads one month's usage as arrays and prices it under many
+# candidate tariffs at once. Nothing is written.
+try:
+    import numpy as np   # optional: only the simulator needs it
+except Exception:
+    np = None
+
+SIM_MAX_SCENARIOS = int(os.getenv("SIM_MAX_SCENARIOS", "20000"))
+SIM_CELLS_PER_CHUNK = int(os.getenv("SIM_CELLS_PER_CHUNK", "4000000"))   # scenarios x invoices per pass
+SIM_AMPS = (5, 10, 15, 20)   # column k+1 of the fee matrix; column 0 keeps the invoice's own fee
+
+def load_month_usage(month_start: date) -> dict:
+    """kWh, amperage slot, own fee and current total of every invoice in the month, as arrays."""
+    first, next_first = month_bounds(month_start)
+    rows = (db.session.query(Invoice.kwh_used, Invoice.subscription_amps,
+                             Invoice.subscription_fee, Invoice.total_due)
+            .filter(Invoice.date >= first, Invoice.date < next_first)
+            .all())
+    slot = {a: k + 1 for k, a in enumerate(SIM_AMPS)}
+    return {
+        "kwh": np.fromiter((r[0] or 0 for r in rows), dtype=np.float64, count=len(rows)),
+        "slot": np.fromiter((slot.get(r[1], 0) for r in rows), dtype=np.intp, count=len(rows)),
+        "own_fee": np.fromiter((r[2] or 0 for r in rows), dtype=np.float64, count=len(rows)),
+        "current": np.fromiter((r[3] or 0 for r in rows), dtype=np.float64, count=len(rows)),
+    }
+
+def expand_scenarios(spec: dict, base) -> list:
+    """
+    Explicit {"scenarios": [{unit_price, fee_5, ...}, ...]} and/or a grid where each
+    of unit_price / fee_5 / fee_10 / fee_15 / fee_20 is a number or a list of numbers
+    (cartesian product). Missing or null values default to the current pricing `base`.
+    """
+    keys = ("unit_price",) + tuple(f"fee_{a}" for a in SIM_AMPS)
+    defaults = {k: float(getattr(base, k) or 0) for k in keys}
+    given = lambda v: v not in (None, "")
+    out = [{**defaults, **{k: float(v) for k, v in sc.items() if k in keys and given(v)}}
+           for sc in (spec.get("scenarios") or [])]
+    grid = {k: [x for x in (spec.get(k) if isinstance(spec.get(k), list) else [spec.get(k)]) if given(x)]
+            for k in keys}
+    axes = [[float(x) for x in grid[k]] or [defaults[k]] for k in keys]
+    if not out or any(grid.values()):
+        out.extend(dict(zip(keys, combo)) for combo in itertools.product(*axes))
+    return out
+
+def _round2_inplace(a):
+    a *= 100
+    np.rint(a, out=a)
+    a /= 100
+
+def simulate_tariffs(usage: dict, scenarios: list) -> dict:
+    """Price the month under every scenario in vectorized chunks; returns totals and bill-change spread."""
+    kwh, slot, own_fee, current = usage["kwh"], usage["slot"], usage["own_fee"], usage["current"]
+    n, baseline = len(kwh), float(current.sum())
+    prices = np.array([sc["unit_price"] for sc in scenarios], dtype=np.float64)
+    fees = np.zeros((len(scenarios), len(SIM_AMPS) + 1), dtype=np.float64)
+    fees[:, 1:] = [[sc[f"fee_{a}"] for a in SIM_AMPS] for sc in scenarios]
+    own = slot == 0
+
+    results = []
+    step = max(1, SIM_CELLS_PER_CHUNK // max(n, 1))
+    for lo in range(0, len(scenarios), step):
+        p, f = prices[lo:lo + step], fees[lo:lo + step]
+        fee = f[:, slot]                                   # (S, n)
+        fee[:, own] = own_fee[own]
+        bills = np.multiply.outer(p, kwh)                  # same rounding as compute_invoice_totals,
+        _round2_inplace(bills)                             # done in place to keep one (S, n) buffer
+        bills += fee
+        _round2_inplace(bills)
+        totals = bills.sum(axis=1)
+        if n:
+            delta = bills
+            delta -= current
+            pct = np.percentile(delta, [0, 10, 50, 90, 100], axis=1)
+            mean = delta.mean(axis=1)
+            up, down = (delta > 0.005).sum(axis=1), (delta < -0.005).sum(axis=1)
+        for k in range(len(p)):
+            total = float(totals[k])
+            results.append({
+                **scenarios[lo + k],
+                "total": round(total, 2),
+                "delta_total": round(total - baseline, 2),
+                "delta_pct": round((total - baseline) / baseline * 100, 2) if baseline else None,
+                "changes": {
+                    "min": round(float(pct[0][k]), 2), "p10": round(float(pct[1][k]), 2),
+                    "median": round(float(pct[2][k]), 2), "p90": round(float(pct[3][k]), 2),
+                    "max": round(float(pct[4][k]), 2), "mean": round(float(mean[k]), 2),
+                    "up": int(up[k]), "down": int(down[k]), "same": int(n - up[k] - down[k]),
+                } if n else None,
+            })
+    return {"invoices": n, "baseline_total": round(baseline, 2), "results": results}
+
+@routes.get("/pricing/simulate", endpoint="pricing_simulate")
+@login_required
+@role_required("admin")
+def pricing_simulate():
+    return render_template("pricing_simulate.html", p=get_pricing(),
+                           this_month=datetime.utcnow().strftime("%Y-%m"), enabled=np is not None)
+
+@routes.post("/api/pricing/simulate", endpoint="api_pricing_simulate")
+@login_required
+@role_required("admin")
+def api_pricing_simulate():
+    """
+    JSON body: {"month": "YYYY-MM", "unit_price": 15000 | [..], "fee_20": .. | [..], ...,
+                "scenarios": [{...}]}  ->  totals per tariff + bill-change distribution.
+    """
+    if np is None:
+        return jsonify({"error": "المحاكاة تتطلب مكتبة numpy على الخادم."}), 503
+    spec = request.get_json(silent=True) or {}
+    ym = str(spec.get("month") or datetime.utcnow().strftime("%Y-%m"))
+    try:
+        month_start = datetime.strptime(ym, "%Y-%m").date() if re.match(r"^\d{4}-\d{2}$", ym) else None
+    except ValueError:
+        month_start = None
+    if month_start is None:
+        return jsonify({"error": "صيغة الشهر غير صحيحة (YYYY-MM)."}), 400
+    try:
+        scenarios = expand_scenarios(spec, get_pricing())
+    except (TypeError, ValueError):
+        return jsonify({"error": "قيم التسعير يجب أن تكون أرقاماً."}), 400
+    if len(scenarios) > SIM_MAX_SCENARIOS:
+        return jsonify({"error": f"عدد السيناريوهات كبير جداً (الحد {SIM_MAX_SCENARIOS})."}), 400
+
+    t0 = time.perf_counter()
+    usage = load_month_usage(month_start)
+    out = simulate_tariffs(usage, scenarios)
+    out.update(month=ym, scenarios=len(scenarios), seconds=round(time.perf_counter() - t0, 3))
+    return jsonify(out)
+
 # ---------------- Login ----------------
-@app.route("/login", methods=["GET", "POST"], endpoint="login")
+@routes.route("/login", methods=["GET", "POST"], endpoint="login")
 def login():
     if request.method == "POST":
         username = (request.form.get("username") or "").strip()
@@ -516,49 +988,13 @@ def login():
     # GET
     return render_template("login.html")
 
-@app.route("/logout")
+@routes.route("/logout")
 @login_required
 def logout():
     logout_user(); flash("تم تسجيل الخروج.", "success"); return redirect(url_for("login"))
 
-@app.route("/", methods=["GET"])
-@login_required
-def index():
-    # Employee view
-    if current_user.role == "employee" and not getattr(current_user, "is_admin", False):
-        q = (request.args.get("q") or "").strip().lower()
-        ym = (request.args.get("ym") or "").strip()
-        status = (request.args.get("status") or "").strip().lower()
-        qry = Invoice.query
-
-        # Month filter (YYYY-MM)
-        if ym and re.match(r"^\d{4}-\d{2}$", ym):
-            y, mth = ym.split("-")
-            y = int(y); mth = int(mth)
-            from datetime import date as _date
-            first = _date(y, mth, 1)
-            first, next_first = month_bounds(first)
-            qry = qry.filter(Invoice.date >= first, Invoice.date < next_first)
-
-        # Status filter
-        if status in ("paid", "unpaid"):
-            want_paid = (status == "paid")
-            qry = qry.filter(Invoice.is_paid == want_paid)
-
-        rows = qry.order_by(Invoice.id.desc()).all()
-
-        if getattr(current_user, "min_visible_date", None):
-            rows = [r for r in rows if r.date is None or r.date >= current_user.min_visible_date]
-        if q:
-            rows = [r for r in rows if q in (r.branch_number or "").lower() or q in (r.customer_name or "").lower()]
-        return render_template("employee_list.html", rows=rows, q=q, this_month=datetime.utcnow().strftime("%Y-%m"), ym=ym, status=status)
-
-    # Admin list (FAST + PAGINATED)
-    q = (request.args.get("q") or "").strip()
-    status = (request.args.get("status") or "").strip().lower()
-    start_param = (request.args.get("start") or "").strip()
-    end_param   = (request.args.get("end") or "").strip()
-
+def list_date_range(start_param: str, end_param: str):
+    """Parse the list's ?start/?end (YYYY-MM-DD); both empty means the current month."""
     today = datetime.utcnow().date()
     first, next_first = month_bounds(today)
     start_date = end_date = None
@@ -576,54 +1012,649 @@ def index():
                 end_date = datetime.strptime(end_param, "%Y-%m-%d").date()
             except Exception:
                 end_date = None
+    return start_date, end_date
+
+# ---------------- Search ----------------
+# invoices.search_text holds the normalized customer name, branch, meter and
+# invoice number. Substring search runs on it through an FTS5 trigram table
+# (SQLite, synced by triggers) or a pg_trgm GIN index (Postgres); both need
+# at least 3 characters, shorter queries fall back to a plain LIKE.
+SEARCH_FIELDS = ("customer_name", "branch_number", "meter_number", "invoice_number")
+
+_AR_TRANSLATE = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه", "ى": "ي", "ئ": "ي", "ؤ": "و",
+    "ـ": None,                                                # tatweel
+    **{chr(0x0660 + d): str(d) for d in range(10)},           # Arabic-Indic digits
+    **{chr(0x06F0 + d): str(d) for d in range(10)},           # Persian digits
+    **{chr(c): None for c in range(0x064B, 0x0660)},          # tashkeel
+    "\u0670": None,
+})
+
+def normalize_search(s) -> str:
+    """Lowercase, fold alef/hamza/taa marbuta/alef maqsura variants, drop tashkeel/tatweel, ASCII digits."""
+    return " ".join(str(s or "").lower().translate(_AR_TRANSLATE).split())
+
+def invoice_search_text(inv) -> str:
+    """search_text for an Invoice object or an invoice values dict."""
+    get = inv.get if isinstance(inv, dict) else (lambda k: getattr(inv, k, None))
+    return normalize_search(" ".join(str(get(k) or "") for k in SEARCH_FIELDS))
+
+_search_backend = {"name": None}
+
+def search_backend() -> str:
+    """'fts5', 'trgm' or 'like' -- resolved once per process from the live schema."""
+    if _search_backend["name"] is None:
+        if db.engine.name == "postgresql":
+            name = "trgm"
+        else:
+            name = "fts5" if inspect(db.engine).has_table("invoice_search") else "like"
+        _search_backend["name"] = name
+    return _search_backend["name"]
 
-    base = Invoice.query
+def _fts_phrase(nq: str) -> str:
+    return '"' + nq.replace('"', '""') + '"'
+
+def invoice_search_criterion(q: str):
+    """WHERE clause matching `q` anywhere in an invoice's searchable fields, or None for a blank query."""
+    nq = normalize_search(q)
+    if not nq:
+        return None
+    backend = search_backend()
+    if backend == "fts5" and len(nq) >= 3:
+        return Invoice.id.in_(
+            select(text("rowid")).select_from(text("invoice_search"))
+            .where(text("invoice_search MATCH :fts_q").bindparams(fts_q=_fts_phrase(nq)))
+        )
+    return Invoice.search_text.contains(nq, autoescape=True)   # LIKE '%q%' (GIN-indexed on Postgres)
+
+def search_invoices(q: str, limit: int = 20) -> list:
+    """Best matches first: exact branch/invoice number, then FTS5 bm25 / trigram similarity."""
+    nq = normalize_search(q)
+    if not nq:
+        return []
+    exact = case((or_(func.lower(Invoice.branch_number) == nq, func.lower(Invoice.invoice_number) == nq), 0), else_=1)
+    backend = search_backend()
+    if backend == "fts5" and len(nq) >= 3:
+        ranked = db.session.execute(
+            text("SELECT rowid FROM invoice_search WHERE invoice_search MATCH :q ORDER BY rank LIMIT :n"),
+            {"q": _fts_phrase(nq), "n": int(limit) * 5},
+        ).scalars().all()
+        pos = {rid: k for k, rid in enumerate(ranked)}
+        rows = Invoice.query.filter(Invoice.id.in_(ranked)).all() if ranked else []
+        exact_ids = {r.id for r in rows if nq in ((r.branch_number or "").lower(), (r.invoice_number or "").lower())}
+        rows.sort(key=lambda r: (r.id not in exact_ids, pos[r.id]))
+        return rows[:limit]
+    qry = Invoice.query.filter(invoice_search_criterion(nq))
+    if backend == "trgm":
+        qry = qry.order_by(exact, func.similarity(Invoice.search_text, nq).desc(), Invoice.date.desc())
+    else:
+        qry = qry.order_by(exact, Invoice.date.desc(), Invoice.id.desc())
+    return qry.limit(limit).all()
+
+def backfill_search_text(conn, only_missing: bool = True, chunk: int = 2000) -> int:
+    """(Re)compute invoices.search_text in id order. Returns rows written."""
+    tbl = Invoice.__table__
+    stmt = tbl.update().where(tbl.c.id == bindparam("b_id")).values(search_text=bindparam("b_text"))
+    done, last_id = 0, 0
+    while True:
+        sel = (select(tbl.c.id, *[tbl.c[k] for k in SEARCH_FIELDS])
+               .where(tbl.c.id > last_id).order_by(tbl.c.id).limit(chunk))
+        if only_missing:
+            sel = sel.where(tbl.c.search_text.is_(None))
+        rows = conn.execute(sel).all()
+        if not rows:
+            return done
+        conn.execute(stmt, [{"b_id": r[0], "b_text": invoice_search_text(dict(zip(SEARCH_FIELDS, r[1:])))}
+                            for r in rows])
+        done += len(rows)
+        last_id = rows[-1][0]
+
+def create_search_index(conn) -> None:
+    """FTS5 trigram table + sync triggers (SQLite) or GIN trigram index (Postgres)."""
+    if conn.engine.name == "postgresql":
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_search_trgm ON invoices USING gin (search_text gin_trgm_ops)"))
+        return
+    try:
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS invoice_search USING fts5("
+            "search_text, content='invoices', content_rowid='id', tokenize='trigram')"))
+    except Exception as e:   # SQLite < 3.34 has no trigram tokenizer: stay on LIKE
+        print("[search] FTS5 trigram unavailable, using LIKE:", e)
+        return
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS invoices_search_ai AFTER INSERT ON invoices BEGIN "
+        "INSERT INTO invoice_search(rowid, search_text) VALUES (new.id, new.search_text); END"))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS invoices_search_ad AFTER DELETE ON invoices BEGIN "
+        "INSERT INTO invoice_search(invoice_search, rowid, search_text) VALUES ('delete', old.id, old.search_text); END"))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS invoices_search_au AFTER UPDATE OF search_text ON invoices BEGIN "
+        "INSERT INTO invoice_search(invoice_search, rowid, search_text) VALUES ('delete', old.id, old.search_text); "
+        "INSERT INTO invoice_search(rowid, search_text) VALUES (new.id, new.search_text); END"))
+    conn.execute(text("INSERT INTO invoice_search(invoice_search) VALUES ('rebuild')"))
+
+# Keep search_text / billing_month current for ORM creates/edits (bulk imports set them in the values)
+@event.listens_for(Session, "before_flush")
+def _refresh_search_text(session, flush_context, instances):
+    for obj in itertools.chain(session.new, session.dirty):
+        if not isinstance(obj, Invoice):
+            continue
+        st = inspect(obj)
+        if obj in session.new or any(st.attrs[k].history.has_changes() for k in SEARCH_FIELDS):
+            obj.search_text = invoice_search_text(obj)
+        if obj in session.new or st.attrs.date.history.has_changes():
+            obj.billing_month = month_key(obj.date or datetime.utcnow())
+
+# ---------------- Branch typeahead index ----------------
+# Per-process sorted index of every branch's latest invoice, searched by
+# prefix with bisect. Same-process commits refresh the branches they touched;
+# other workers' inserts are picked up from the "invoices" stamp + an id
+# high-water mark, and BRANCH_INDEX_TTL rebuilds cover their edits/deletes.
+BRANCH_INDEX_TTL = float(os.getenv("BRANCH_INDEX_TTL", "120"))
+
+BranchSnapshot = namedtuple("BranchSnapshot", "branch_number customer_name meter_number subscription_amps "
+                                              "curr_reading date invoice_id invoice_number")
+
+class BranchIndex:
+    FIELDS = ("number", "name", "meter")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snap = {}                                  # branch -> BranchSnapshot
+        self.keys = {f: [] for f in self.FIELDS}        # field -> sorted [(normalized key, branch)]
+        self.stamp = None
+        self.high_id = 0
+        self.loaded_at = 0.0
+        self.pending = set()                            # branches changed by this process ("*" = all)
+
+    @staticmethod
+    def _keys_for(sn):
+        name = normalize_search(sn.customer_name)
+        yield "number", normalize_search(sn.branch_number)
+        if sn.meter_number:
+            yield "meter", normalize_search(sn.meter_number)
+        if name:
+            yield "name", name
+            for word in name.split()[1:]:               # match any word of the name
+                yield "name", word
+
+    def _put(self, sn):
+        self._drop(sn.branch_number)
+        self.snap[sn.branch_number] = sn
+        for field, key in self._keys_for(sn):
+            insort(self.keys[field], (key, sn.branch_number))
+
+    def _drop(self, branch):
+        old = self.snap.pop(branch, None)
+        if old is None:
+            return
+        for field, key in self._keys_for(old):
+            lst = self.keys[field]
+            k = bisect_left(lst, (key, branch))
+            if k < len(lst) and lst[k] == (key, branch):
+                del lst[k]
+
+    @staticmethod
+    def _snapshot(r):
+        return BranchSnapshot(r.branch_number, r.customer_name or "", r.meter_number or "", r.subscription_amps,
+                              r.curr_reading, r.date, r.id, r.invoice_number)
+
+    def rebuild(self):
+        with self.lock:
+            self.pending.clear()   # the full read below covers them
+        stamp = read_cache_stamp("invoices")
+        high = db.session.query(func.coalesce(func.max(Invoice.id), 0)).scalar() or 0
+        snaps = [self._snapshot(r) for r in branch_states().values()]
+        keys = {f: [] for f in self.FIELDS}
+        for sn in snaps:
+            for field, key in self._keys_for(sn):
+                keys[field].append((key, sn.branch_number))
+        for lst in keys.values():
+            lst.sort()
+        with self.lock:
+            self.snap = {sn.branch_number: sn for sn in snaps}
+            self.keys = keys
+            self.stamp, self.high_id, self.loaded_at = stamp, high, time.monotonic()
+
+    def refresh(self):
+        """Bring the index up to date: incremental when possible, full on first use / TTL / bulk changes."""
+        stamp = read_cache_stamp("invoices")
+        if (not self.loaded_at or "*" in self.pending
+                or time.monotonic() - self.loaded_at > BRANCH_INDEX_TTL):
+            return self.rebuild()
+        if stamp == self.stamp and not self.pending:
+            return
+        with self.lock:
+            branches, self.pending = set(self.pending), set()
+        new = (db.session.query(Invoice.branch_number, func.max(Invoice.id))
+               .filter(Invoice.id > self.high_id)
+               .group_by(Invoice.branch_number).all())
+        branches.update(b for b, _ in new)
+        latest = branch_states(branches)
+        with self.lock:
+            for b in branches:
+                if b in latest:
+                    self._put(self._snapshot(latest[b]))
+                else:
+                    self._drop(b)
+            self.high_id = max([self.high_id] + [i for _, i in new])
+            self.stamp = stamp
+
+    def note_changes(self, branches):
+        with self.lock:
+            self.pending.update(branches)
+
+    def lookup(self, prefix: str, limit: int = 10) -> list:
+        """Branches whose number, name (any word) or meter starts with `prefix`; number matches first."""
+        p = normalize_search(prefix)
+        if not p:
+            return []
+        out, seen = [], set()
+        with self.lock:
+            for field in self.FIELDS:
+                lst = self.keys[field]
+                k = bisect_left(lst, (p,))
+                while k < len(lst) and lst[k][0].startswith(p) and len(out) < limit:
+                    b = lst[k][1]
+                    if b not in seen:
+                        seen.add(b)
+                        out.append(self.snap[b])
+                    k += 1
+                if len(out) >= limit:
+                    break
+        return out
+
+branch_index = BranchIndex()
+
+def _branches_touched(state, model_col):
+    sel = select(model_col).distinct()
+    if state.statement.whereclause is not None:
+        sel = sel.where(state.statement.whereclause)
+    return {b for (b,) in state.session.connection().execute(sel)}
+
+# Invoice columns branch_state (and the typeahead snapshot) is derived from;
+# writes that change none of them (is_paid, totals, search_text, ...) skip the refresh.
+BRANCH_STATE_SOURCES = frozenset(("id", "branch_number", "date", "invoice_number", "curr_reading", "customer_name",
+                                  "meter_number", "subscription_amps", "subscription_fee", "unit_price"))
+
+def _update_columns(state):
+    """Names of the columns an UPDATE sets (from .values() or the executemany rows); None if unknown."""
+    vals = getattr(state.statement, "_values", None)
+    if vals:
+        return {getattr(k, "key", k) for k in vals}
+    params = state.parameters
+    rows = params if isinstance(params, (list, tuple)) else ([params] if params else [])
+    return set().union(*(r.keys() for r in rows)) if rows else None
+
+@event.listens_for(Session, "before_flush")
+def _track_branch_flush(session, flush_context, instances):
+    touched = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Invoice):
+            if obj in session.dirty and obj not in session.deleted:
+                attrs = inspect(obj).attrs
+                if not any(attrs[c].history.has_changes() for c in BRANCH_STATE_SOURCES if c in attrs):
+                    continue
+            hist = inspect(obj).attrs.branch_number.history
+            touched.update(v for v in itertools.chain(hist.added or (), hist.unchanged or (), hist.deleted or ()) if v)
+            touched.add(obj.branch_number)
+    touched.discard(None)
+    if touched:
+        session.info.setdefault("branch_changes", set()).update(touched)
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_branch_bulk(state):
+    if not (state.is_insert or state.is_update or state.is_delete):
+        return
+    if getattr(getattr(state.statement, "table", None), "name", None) != Invoice.__tablename__:
+        return
+    if state.is_update:
+        cols = _update_columns(state)
+        if cols is not None and not (cols & BRANCH_STATE_SOURCES):
+            return
+    params = state.parameters
+    rows = params if isinstance(params, (list, tuple)) else ([params] if params else [])
+    changes = state.session.info.setdefault("branch_changes", set())
+    if state.is_insert and rows and all(p.get("branch_number") for p in rows):
+        changes.update(p["branch_number"] for p in rows)
+    elif state.is_insert or (rows and state.statement.whereclause is None):
+        changes.add("*")
+    else:
+        changes.update(_branches_touched(state, Invoice.branch_number))
+
+@event.listens_for(Session, "after_commit")
+def _branches_committed(session):
+    changes = session.info.pop("branch_changes", None)
+    if changes:
+        branch_index.note_changes(changes)
+
+@event.listens_for(Session, "after_rollback")
+def _branches_rolled_back(session):
+    session.info.pop("branch_changes", None)
+
+# ---------------- Branch state ----------------
+# branch_state mirrors each branch's latest invoice. before_commit re-reads the
+# branches this transaction touched (the "branch_changes" recorded above) and
+# upserts their rows in the same transaction, so readers never see it lag.
+_branch_state_ready = {"ok": False}
+
+def branch_state_ready() -> bool:
+    if not _branch_state_ready["ok"]:
+        _branch_state_ready["ok"] = inspect(db.engine).has_table(BranchState.__tablename__)
+    return _branch_state_ready["ok"]
+
+def branch_states(branches=None) -> dict:
+    """{branch: BranchState} for `branches` (None = all), by primary key; window query before migration 9."""
+    if not branch_state_ready():
+        if branches is None:
+            branches = [b for (b,) in db.session.query(Invoice.branch_number).distinct()]
+        return latest_invoices_for_branches(branches)
+    if branches is None:
+        return {st.branch_number: st for st in BranchState.query}
+    out = {}
+    branches = list({b for b in branches if b})
+    for i in range(0, len(branches), IMPORT_PREFETCH_CHUNK):
+        for st in BranchState.query.filter(BranchState.branch_number.in_(branches[i:i + IMPORT_PREFETCH_CHUNK])):
+            out[st.branch_number] = st
+    return out
+
+def _branch_state_values(r, now) -> dict:
+    return dict(
+        last_invoice_id=r.id, last_invoice_number=r.invoice_number, last_date=r.date,
+        last_billed_month=month_key(r.date), last_reading=int(r.curr_reading or 0),
+        customer_name=r.customer_name, meter_number=r.meter_number,
+        subscription_amps=r.subscription_amps, subscription_fee=r.subscription_fee,
+        unit_price=r.unit_price, updated_at=now,
+    )
+
+def refresh_branch_state(conn, branches) -> None:
+    """Recompute branch_state for `branches` from invoices, on `conn` (inside the caller's transaction)."""
+    tbl = BranchState.__table__
+    branches = list({b for b in branches if b})
+    now = datetime.utcnow()
+    ins = dialect_insert(tbl)
+    upsert = ins.on_conflict_do_update(index_elements=[tbl.c.branch_number],
+                                       set_={c.name: ins.excluded[c.name] for c in tbl.c if not c.primary_key})
+    for i in range(0, len(branches), IMPORT_PREFETCH_CHUNK):
+        chunk = branches[i:i + IMPORT_PREFETCH_CHUNK]
+        latest = _latest_invoice_rows(conn, chunk)
+        gone = [b for b in chunk if b not in latest]
+        if gone:
+            conn.execute(tbl.delete().where(tbl.c.branch_number.in_(gone)))
+        if latest:
+            # one executemany per chunk, not a statement per branch
+            conn.execute(upsert, [dict(branch_number=b, **_branch_state_values(r, now)) for b, r in latest.items()])
+
+def rebuild_branch_state(conn) -> int:
+    """Backfill: one row per branch from its latest invoice. Returns branches written."""
+    tbl = BranchState.__table__
+    conn.execute(tbl.delete())
+    now = datetime.utcnow()
+    rows = [dict(branch_number=b, **_branch_state_values(r, now)) for b, r in _latest_invoice_rows(conn).items()]
+    for i in range(0, len(rows), IMPORT_BATCH_SIZE):
+        conn.execute(tbl.insert(), rows[i:i + IMPORT_BATCH_SIZE])
+    return len(rows)
+
+def _latest_invoice_rows(conn, branches=None) -> dict:
+    """Latest invoice (by date, id) per branch via row_number(), on a plain connection."""
+    t = Invoice.__table__
+    rn = func.row_number().over(partition_by=t.c.branch_number, order_by=(t.c.date.desc(), t.c.id.desc())).label("rn")
+    sub = select(t.c.id, t.c.invoice_number, t.c.branch_number, t.c.date, t.c.curr_reading, t.c.customer_name,
+                 t.c.meter_number, t.c.subscription_amps, t.c.subscription_fee, t.c.unit_price, rn)
+    if branches is not None:
+        sub = sub.where(t.c.branch_number.in_(branches))
+    sub = sub.subquery()
+    return {r.branch_number: r for r in conn.execute(select(sub).where(sub.c.rn == 1))}
+
+@event.listens_for(Session, "before_commit")
+def _refresh_branch_state_on_commit(session):
+    if not (session.info.get("branch_changes") or session.new or session.dirty or session.deleted):
+        return
+    session.flush()   # records branch_changes for pending rows
+    changes = session.info.get("branch_changes")
+    if not changes or not branch_state_ready():
+        return
+    conn = session.connection()
+    if "*" in changes:
+        rebuild_branch_state(conn)
+    else:
+        refresh_branch_state(conn, changes)
+
+def invoice_list_criteria(start_date=None, end_date=None, status: str = "", q: str = "") -> list:
+    """WHERE criteria for the admin list filters (also used by totals and bulk actions)."""
+    crit = []
     if start_date:
-        base = base.filter(Invoice.date >= start_date)
+        crit.append(Invoice.date >= start_date)
     if end_date:
-        base = base.filter(Invoice.date <= end_date)
+        crit.append(Invoice.date <= end_date)
     if status == "paid":
-        base = base.filter(Invoice.is_paid.is_(True))
+        crit.append(Invoice.is_paid.is_(True))
     elif status == "unpaid":
-        base = base.filter(Invoice.is_paid.is_(False))
-
-    from sqlalchemy import or_
-    if q:
-        like = f"{q}%"
-        base = base.filter(or_(
-            Invoice.customer_name.ilike(like),
-            Invoice.branch_number.ilike(like),
-            Invoice.meter_number.ilike(like),
-            Invoice.invoice_number.ilike(like),
-        ))
-
-    # Pagination
+        crit.append(Invoice.is_paid.is_(False))
+    match = invoice_search_criterion(q)
+    if match is not None:
+        crit.append(match)
+    return crit
+
+# ---------------- Invoice list totals ----------------
+# Totals for a filter are one aggregate statement, cached per normalized filter
+# and dropped whenever invoices are written (the "invoices" cache stamp).
+LIST_TOTALS_CACHE_SIZE = int(os.getenv("LIST_TOTALS_CACHE_SIZE", "256"))
+LIST_TOTALS_TTL = float(os.getenv("LIST_TOTALS_TTL", "300"))  # multi-host safety net
+
+_totals_cache = OrderedDict()   # fingerprint -> (stamp, loaded_at, totals)
+_totals_lock = threading.Lock()
+
+def _list_filter_fingerprint(start_date, end_date, status, q) -> tuple:
+    return (
+        start_date.isoformat() if start_date else "",
+        end_date.isoformat() if end_date else "",
+        status if status in ("paid", "unpaid") else "",
+        (q or "").strip().lower(),
+    )
+
+def invoice_list_totals(start_date=None, end_date=None, status: str = "", q: str = "") -> dict:
+    """count / kWh / total due / paid-unpaid split for the list filters, in a single scan."""
+    key = _list_filter_fingerprint(start_date, end_date, status, q)
+    stamp = read_cache_stamp("invoices")
+    with _totals_lock:
+        hit = _totals_cache.get(key)
+        if hit and hit[0] == stamp and time.monotonic() - hit[1] <= LIST_TOTALS_TTL:
+            _totals_cache.move_to_end(key)
+            return hit[2]
+
+    paid = Invoice.is_paid.is_(True)
+    row = (db.session.query(
+                func.count(Invoice.id),
+                func.coalesce(func.sum(Invoice.kwh_used), 0),
+                func.coalesce(func.sum(Invoice.total_due), 0.0),
+                func.coalesce(func.sum(case((paid, Invoice.total_due), else_=0.0)), 0.0),
+                func.coalesce(func.sum(case((paid, 1), else_=0)), 0),
+            )
+            .filter(*invoice_list_criteria(start_date, end_date, status, q))
+            .one())
+    count, kwh, total_due, paid_due, paid_count = row
+    totals = {
+        "count": int(count or 0),
+        "kwh": int(kwh or 0),
+        "total_due": float(total_due or 0),
+        "paid_due": float(paid_due or 0),
+        "unpaid_due": float(total_due or 0) - float(paid_due or 0),
+        "paid_count": int(paid_count or 0),
+        "unpaid_count": int(count or 0) - int(paid_count or 0),
+    }
+    with _totals_lock:
+        _totals_cache[key] = (stamp, time.monotonic(), totals)
+        _totals_cache.move_to_end(key)
+        while len(_totals_cache) > LIST_TOTALS_CACHE_SIZE:
+            _totals_cache.popitem(last=False)
+    return totals
+
+def invalidate_invoice_caches() -> None:
+    """Drop invoice-derived caches here and signal the other workers."""
+    with _totals_lock:
+        _totals_cache.clear()
+    bump_cache_stamp("invoices")
+
+def mark_invoices_changed(session=None) -> None:
+    """For writes the session events can't see (raw SQL): invalidate on commit."""
+    (session or db.session).info["invoices_changed"] = True
+
+# ORM unit-of-work writes (add / edit / delete of Invoice objects)
+@event.listens_for(Session, "after_flush")
+def _track_invoice_flush(session, flush_context):
+    if any(isinstance(o, Invoice) for o in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info["invoices_changed"] = True
+
+# Bulk writes: executemany insert(Invoice.__table__), Query.update/delete, update(Invoice)
+@event.listens_for(Session, "do_orm_execute")
+def _track_invoice_bulk(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        if getattr(getattr(state.statement, "table", None), "name", None) == Invoice.__tablename__:
+            state.session.info["invoices_changed"] = True
+
+@event.listens_for(Session, "after_commit")
+def _invoices_committed(session):
+    if session.info.pop("invoices_changed", False):
+        invalidate_invoice_caches()
+
+@event.listens_for(Session, "after_rollback")
+def _invoices_rolled_back(session):
+    session.info.pop("invoices_changed", None)
+
+def encode_list_cursor(d: date, invoice_id: int) -> str:
+    """Opaque cursor for the admin list: the (date, id) of the row at a page edge."""
+    raw = f"{d.isoformat()}|{int(invoice_id)}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_list_cursor(token: str):
+    """(date, id) from a cursor, or None for a missing/garbled one (=> first page)."""
+    if not token:
+        return None
     try:
-        page = max(int(request.args.get("page", 1)), 1)
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        d, invoice_id = raw.split("|")
+        return date.fromisoformat(d), int(invoice_id)
     except Exception:
-        page = 1
+        return None
+
+def keyset_invoice_page(base, per_page: int, after=None, before=None, descending: bool = True):
+    """
+    One page of `base` ordered by (date, id) -- newest first unless
+    descending=False -- by seeking past a cursor instead of OFFSET, so every
+    page is an index range scan on ix_invoices_date_id(_desc) and costs the
+    same as the first one. Returns (rows, next_cursor, prev_cursor).
+    """
+    key = tuple_(Invoice.date, Invoice.id)
+    fwd = (Invoice.date.desc(), Invoice.id.desc()) if descending else (Invoice.date.asc(), Invoice.id.asc())
+    rev = (Invoice.date.asc(), Invoice.id.asc()) if descending else (Invoice.date.desc(), Invoice.id.desc())
+
+    def past(cursor):      # rows after the cursor in display order
+        return key < tuple_(*cursor) if descending else key > tuple_(*cursor)
+
+    def before_(cursor):   # rows before the cursor in display order
+        return key > tuple_(*cursor) if descending else key < tuple_(*cursor)
+
+    if before:
+        # walk backwards from the cursor, then flip for display
+        rows = base.filter(before_(before)).order_by(*rev).limit(per_page + 1).all()
+        has_prev, has_next = len(rows) > per_page, True
+        rows = rows[:per_page][::-1]
+    else:
+        qry = base.filter(past(after)) if after else base
+        rows = qry.order_by(*fwd).limit(per_page + 1).all()
+        has_prev, has_next = after is not None, len(rows) > per_page
+        rows = rows[:per_page]
+    next_cursor = encode_list_cursor(rows[-1].date, rows[-1].id) if (rows and has_next) else None
+    prev_cursor = encode_list_cursor(rows[0].date, rows[0].id) if (rows and has_prev) else None
+    return rows, next_cursor, prev_cursor
+
+EMPLOYEE_PAGE_SIZE = int(os.getenv("EMPLOYEE_PAGE_SIZE", "50"))
+
+# ?sort=<key>:<dir> for the employee list; id breaks ties so pages are stable
+EMPLOYEE_SORTS = {
+    "":            (Invoice.id.desc(),),
+    "date:desc":   (Invoice.date.desc(), Invoice.id.desc()),
+    "date:asc":    (Invoice.date.asc(), Invoice.id.asc()),
+    "amount:desc": (Invoice.total_due.desc(), Invoice.id.desc()),
+    "amount:asc":  (Invoice.total_due.asc(), Invoice.id.asc()),
+    "kwh:desc":    (Invoice.kwh_used.desc(), Invoice.id.desc()),
+    "kwh:asc":     (Invoice.kwh_used.asc(), Invoice.id.asc()),
+}
+
+def employee_invoice_criteria(user, q: str = "", ym: str = "", status: str = "") -> list:
+    """WHERE criteria for the employee list: visibility date, month, status and substring search."""
+    crit = []
+    min_visible = getattr(user, "min_visible_date", None)
+    if min_visible:
+        crit.append(Invoice.date >= min_visible)
+    # Month filter (YYYY-MM)
+    if ym and re.match(r"^\d{4}-\d{2}$", ym):
+        y, mth = map(int, ym.split("-"))
+        first, next_first = month_bounds(date(y, mth, 1))
+        crit.append(Invoice.date >= first)
+        crit.append(Invoice.date < next_first)
+    # Status filter
+    if status in ("paid", "unpaid"):
+        crit.append(Invoice.is_paid.is_(status == "paid"))
+    match = invoice_search_criterion(q)
+    if match is not None:
+        crit.append(match)
+    return crit
+
+def employee_invoice_page(user, q="", ym="", status="", sort="", page=1, per_page=None):
+    """One page of the employee list. Returns (rows, has_more) without a COUNT query."""
+    per_page = min(max(int(per_page or EMPLOYEE_PAGE_SIZE), 1), 200)
+    page = max(int(page or 1), 1)
+    rows = (Invoice.query
+            .filter(*employee_invoice_criteria(user, q, ym, status))
+            .order_by(*EMPLOYEE_SORTS.get(sort, EMPLOYEE_SORTS[""]))
+            .limit(per_page + 1)
+            .offset((page - 1) * per_page)
+            .all())
+    return rows[:per_page], len(rows) > per_page
+
+@routes.route("/", methods=["GET"])
+@login_required
+def index():
+    # Employee view (filters, search and sort in SQL; further pages via /api/employee/invoices)
+    if current_user.role == "employee" and not getattr(current_user, "is_admin", False):
+        q = (request.args.get("q") or "").strip().lower()
+        ym = (request.args.get("ym") or "").strip()
+        status = (request.args.get("status") or "").strip().lower()
+        sort = (request.args.get("sort") or "").strip().lower()
+        rows, has_more = employee_invoice_page(current_user, q=q, ym=ym, status=status, sort=sort, page=1)
+        return render_template("employee_list.html", rows=rows, q=q, this_month=datetime.utcnow().strftime("%Y-%m"),
+                               ym=ym, status=status, sort=sort, has_more=has_more, per_page=EMPLOYEE_PAGE_SIZE)
+
+    # Admin list (FAST + PAGINATED)
+    q = (request.args.get("q") or "").strip()
+    status = (request.args.get("status") or "").strip().lower()
+    start_param = (request.args.get("start") or "").strip()
+    end_param   = (request.args.get("end") or "").strip()
+
+    start_date, end_date = list_date_range(start_param, end_param)
+    base = Invoice.query.filter(*invoice_list_criteria(start_date, end_date, status, q))
+
+    # Keyset pagination on (date, id): ?after=<cursor> / ?before=<cursor>
     try:
         per_page = min(max(int(request.args.get("per_page", 100)), 20), 200)
     except Exception:
         per_page = 100
+    after = decode_list_cursor(request.args.get("after") or "")
+    before = decode_list_cursor(request.args.get("before") or "")
+
+    totals = invoice_list_totals(start_date, end_date, status, q)
+
+    items, next_cursor, prev_cursor = keyset_invoice_page(base, per_page, after=after, before=before)
 
-    # Totals using DB
-    count_q = db.session.query(func.count(Invoice.id))
-    sum_kwh_q = db.session.query(func.coalesce(func.sum(Invoice.kwh_used), 0))
-    # Reapply filters
-    where_parts = getattr(base, "_where_criteria", None)
-    if where_parts:
-        for crit in where_parts:
-            count_q = count_q.filter(crit)
-            sum_kwh_q = sum_kwh_q.filter(crit)
-    total_count = int(count_q.scalar() or 0)
-    total_kwh = int(sum_kwh_q.scalar() or 0)
-
-    items = (base
-             .order_by(Invoice.date.desc(), Invoice.id.desc())
-             .limit(per_page)
-             .offset((page - 1) * per_page)
-             .all())
+    # Navigation links keep the filters and swap the cursor
+    nav_args = {k: v for k, v in request.args.items() if k not in ("after", "before", "page")}
+    next_url = url_for("index", **nav_args, after=next_cursor) if next_cursor else None
+    prev_url = url_for("index", **nav_args, before=prev_cursor) if prev_cursor else None
+    first_url = url_for("index", **nav_args) if (after or before) else None
 
     start_value = (start_date.isoformat() if start_date else (start_param or ""))
     end_value   = (end_date.isoformat()   if end_date   else (end_param   or ""))
@@ -631,14 +1662,95 @@ def index():
     return render_template(
         "list.html",
         invoices=items, q=q, status=status,
-        total_kwh=total_kwh, start=start_value, end=end_value,
+        total_kwh=totals["kwh"], start=start_value, end=end_value,
         this_month=datetime.utcnow().strftime("%Y-%m"),
-        page=page, per_page=per_page, total_count=total_count
+        per_page=per_page, total_count=totals["count"], totals=totals,
+        next_url=next_url, prev_url=prev_url, first_url=first_url
+    )
+
+
+@routes.get("/api/employee/invoices", endpoint="api_employee_invoices")
+@login_required
+def api_employee_invoices():
+    """Paged employee list as compact JSON for static/employee.js (search/sort/infinite scroll)."""
+    try:
+        page = int(request.args.get("page", 1))
+    except Exception:
+        page = 1
+    try:
+        per_page = int(request.args.get("per_page", EMPLOYEE_PAGE_SIZE))
+    except Exception:
+        per_page = EMPLOYEE_PAGE_SIZE
+    rows, has_more = employee_invoice_page(
+        current_user,
+        q=(request.args.get("q") or "").strip().lower(),
+        ym=(request.args.get("ym") or "").strip(),
+        status=(request.args.get("status") or "").strip().lower(),
+        sort=(request.args.get("sort") or "").strip().lower(),
+        page=page, per_page=per_page,
     )
+    return jsonify({
+        "page": max(page, 1),
+        "has_more": has_more,
+        "items": [{
+            "id": i.id,
+            "branch_number": i.branch_number,
+            "customer_name": i.customer_name,
+            "curr_reading": i.curr_reading,
+            "date": i.date.isoformat() if i.date else "",
+            "kwh_used": i.kwh_used,
+            "total_due": round(float(i.total_due or 0), 2),
+            "is_paid": bool(i.is_paid),
+        } for i in rows],
+    })
+
+@routes.get("/api/invoices/search", endpoint="api_invoice_search")
+@login_required
+@role_required("admin")
+def api_invoice_search():
+    """Ranked substring search over name / branch / meter / invoice number (Arabic-normalized)."""
+    q = (request.args.get("q") or "").strip()
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 100)
+    except Exception:
+        limit = 20
+    t0 = time.perf_counter()
+    rows = search_invoices(q, limit)
+    return jsonify({
+        "q": q,
+        "backend": search_backend(),
+        "ms": round((time.perf_counter() - t0) * 1000, 1),
+        "items": [{
+            "id": i.id,
+            "invoice_number": i.invoice_number,
+            "customer_name": i.customer_name,
+            "branch_number": i.branch_number,
+            "meter_number": i.meter_number,
+            "date": i.date.isoformat() if i.date else "",
+            "total_due": round(float(i.total_due or 0), 2),
+            "is_paid": bool(i.is_paid),
+        } for i in rows],
+    })
 
+@routes.get("/api/branches/typeahead", endpoint="api_branch_typeahead")
+@login_required
+def api_branch_typeahead():
+    """Prefix search over branch number / customer name / meter, served from the in-memory branch index."""
+    q = (request.args.get("q") or "").strip()
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), 50)
+    except Exception:
+        limit = 10
+    branch_index.refresh()
+    return jsonify({
+        "fields": ["branch", "name", "meter", "amps", "reading", "date"],
+        "items": [[sn.branch_number, sn.customer_name, sn.meter_number, sn.subscription_amps,
+                   sn.curr_reading, sn.date.isoformat() if sn.date else ""]
+                  for sn in branch_index.lookup(q, limit)],
+    })
 
 # Employee quick create
-@app.post("/employee/quick-create", endpoint="employee_quick_create")
+@routes.post("/employee/quick-create", endpoint="employee_quick_create")
 @login_required
 @role_required("employee")
 def employee_quick_create():
@@ -649,12 +1761,6 @@ def employee_quick_create():
         curr_reading = 0
     last = last_for_branch(branch)
     today = datetime.utcnow().date()
-    # prevent duplicate per branch per month
-    if has_invoice_in_month(branch, today):
-        existing = existing_invoice_for_month(branch, today)
-        flash(f"يوجد فاتورة لهذه الشعبة لنفس الشهر ({month_key(today)}): رقم {existing.invoice_number}", "error")
-        return redirect(request.referrer or url_for("index"))
-
     if not last:
         flash("لا توجد فاتورة سابقة لهذه الشعبة.", "error"); return redirect(request.referrer or url_for("index"))
     if curr_reading < (last.curr_reading or 0):
@@ -668,11 +1774,112 @@ def employee_quick_create():
     inv.energy_cost = round(inv.kwh_used * float(inv.unit_price or 0), 2)
     inv.month_cost = float(inv.subscription_fee or 0)
     inv.total_due = round(inv.energy_cost + inv.month_cost, 2)
-    db.session.add(inv); db.session.commit()
+    # one invoice per branch per month: the unique index decides
+    if insert_invoice(inv) is None:
+        db.session.rollback()
+        existing = existing_invoice_for_month(branch, today)
+        flash(f"يوجد فاتورة لهذه الشعبة لنفس الشهر ({month_key(today)}): رقم {getattr(existing, 'invoice_number', '')}", "error")
+        return redirect(request.referrer or url_for("index"))
+    db.session.commit()
     flash("تم إنشاء فاتورة جديدة.", "success"); return redirect(url_for("index", **_current_filter_args()))
 
+# ---------------- Route-sheet readings ----------------
+# A meter reader posts a whole street at once. Every branch's previous reading
+# comes from one branch_state query, pricing is read once, invoice numbers are
+# reserved as one block and the invoices go in as one executemany INSERT ...
+# ON CONFLICT DO NOTHING; bad rows are reported, the rest commit together.
+READINGS_BATCH_MAX = int(os.getenv("READINGS_BATCH_MAX", "500"))
+
+def create_reading_invoices(readings, d: date = None) -> list:
+    """
+    Create this month's invoices from [{"branch_number", "curr_reading"}, ...].
+    Returns one result per input row, in order: {"index", "branch_number", "ok": True,
+    "invoice_number", "kwh_used", "total_due"} or {"index", "branch_number", "error"}.
+    Runs in the caller's transaction; the caller commits.
+    """
+    d = d or datetime.utcnow().date()
+    ym = month_key(d)
+    results, todo, seen = [], [], set()
+    for k, item in enumerate(readings):
+        item = item if isinstance(item, dict) else {}
+        branch = str(item.get("branch_number") or "").strip()
+        res = {"index": k, "branch_number": branch}
+        results.append(res)
+        try:
+            curr = int(float(item.get("curr_reading")))
+        except (TypeError, ValueError):
+            curr = None
+        if not branch:
+            res["error"] = "رقم الشعبة مطلوب."
+        elif curr is None or curr < 0:
+            res["error"] = "القراءة الحالية غير صالحة."
+        elif branch in seen:
+            res["error"] = "الشعبة مكررة في نفس الدفعة."
+        else:
+            seen.add(branch)
+            todo.append((res, branch, curr))
+
+    states = branch_states([b for _, b, _ in todo])
+    pricing = get_pricing()
+    values = []
+    for res, branch, curr in todo:
+        last = states.get(branch)
+        if last is None:
+            res["error"] = "لا توجد فاتورة سابقة لهذه الشعبة."
+        elif curr < (last.curr_reading or 0):
+            res["error"] = f"القراءة الحالية يجب أن تكون ≥ آخر قراءة ({last.curr_reading})."
+        elif month_key(last.date) == ym:
+            res["error"] = f"يوجد فاتورة لهذه الشعبة لنفس الشهر ({ym}): رقم {last.invoice_number}"
+        else:
+            amps = last.subscription_amps or 0
+            v = compute_invoice_totals({
+                "date": d, "billing_month": ym, "branch_number": branch,
+                "customer_name": last.customer_name or "", "meter_number": last.meter_number,
+                "subscription_amps": amps, "prev_reading": last.curr_reading or 0, "curr_reading": curr,
+                "unit_price": float(pricing.unit_price or 0.0),
+                "subscription_fee": float(last.subscription_fee or pricing.fee_for_amp(int(amps)) or 0.0),
+                "is_paid": False,
+            })
+            v["search_text"] = invoice_search_text(v)
+            values.append((res, v))
+
+    for (res, v), num in zip(values, reserve_invoice_numbers(d, len(values))):
+        v["invoice_number"] = num
+    if values:
+        tbl = Invoice.__table__
+        stmt = (dialect_insert(tbl).on_conflict_do_nothing(**billing_month_conflict(tbl))
+                .returning(tbl.c.branch_number))
+        created = set(db.session.execute(stmt, [v for _, v in values]).scalars())
+        for res, v in values:
+            if v["branch_number"] in created:
+                res.update(ok=True, invoice_number=v["invoice_number"],
+                           kwh_used=v["kwh_used"], total_due=v["total_due"])
+            else:   # billed by someone else since branch_state was read
+                res["error"] = f"يوجد فاتورة لهذه الشعبة لنفس الشهر ({ym})."
+    return results
+
+@routes.post("/api/employee/readings", endpoint="api_employee_readings")
+@login_required
+@role_required("employee")
+def api_employee_readings():
+    """
+    Route-sheet batch entry. JSON [{"branch_number": .., "curr_reading": ..}, ...]
+    (or {"readings": [...]})  ->  {"created", "errors", "results": [per row]}.
+    """
+    body = request.get_json(silent=True)
+    readings = body.get("readings") if isinstance(body, dict) else body
+    if not isinstance(readings, list) or not readings:
+        return jsonify({"error": "أرسل قائمة القراءات بصيغة JSON."}), 400
+    if len(readings) > READINGS_BATCH_MAX:
+        return jsonify({"error": f"عدد القراءات كبير جداً (الحد {READINGS_BATCH_MAX})."}), 400
+    results = create_reading_invoices(readings)
+    db.session.commit()
+    created = sum(1 for r in results if r.get("ok"))
+    current_app.logger.info("[readings] %s: %d created, %d rejected", current_user.username, created, len(results) - created)
+    return jsonify({"created": created, "errors": len(results) - created, "results": results})
+
 # Mark paid / Toggle paid
-@app.post("/invoice/<int:invoice_id>/mark-paid", endpoint="mark_paid")
+@routes.post("/invoice/<int:invoice_id>/mark-paid", endpoint="mark_paid")
 @login_required
 @role_required("employee")
 def mark_paid(invoice_id: int):
@@ -681,21 +1888,385 @@ def mark_paid(invoice_id: int):
         flash("هذه الفاتورة مدفوعة مسبقًا.", "info"); return redirect(request.referrer or url_for("index"))
     inv.is_paid = True; db.session.commit(); flash("تم تعليم الفاتورة كمدفوعة.", "success"); return redirect(request.referrer or url_for("index"))
 
-@app.post("/invoice/<int:invoice_id>/toggle-paid", endpoint="toggle_paid")
+@routes.post("/invoice/<int:invoice_id>/toggle-paid", endpoint="toggle_paid")
 @login_required
 @role_required("admin")
 def toggle_paid(invoice_id: int):
     inv = Invoice.query.get_or_404(invoice_id); inv.is_paid = not bool(inv.is_paid); db.session.commit()
     flash("تم تحديث حالة الدفع.", "success"); return redirect(request.referrer or url_for("index"))
 
+# ---------------- Batch payments ----------------
+# Collection days: one request marks many invoices paid. The ids / receipt
+# numbers are resolved in one query and flipped with one set UPDATE ...
+# WHERE id IN (...) AND NOT is_paid RETURNING id, so a concurrent payment
+# shows up as "already_paid" rather than being counted twice.
+PAY_BATCH_MAX = int(os.getenv("PAY_BATCH_MAX", "5000"))
+
+def receipt_invoice_numbers(file_storage) -> list:
+    """Invoice numbers from a receipts CSV: the invoice_number column if there is a header, else the first column."""
+    stream = file_storage.stream
+    text_stream = io.TextIOWrapper(stream, encoding=_sniff_text_encoding(stream), errors="replace", newline="")
+    try:
+        rows = csv.reader(text_stream)
+        header = next(rows, None)
+        if header is None:
+            return []
+        col = _import_header_map(header).get("invoice_number")
+        if col is None:
+            col, rows = 0, itertools.chain([header], rows)
+        return [str(r[col]).strip() for r in rows if len(r) > col and str(r[col]).strip()]
+    finally:
+        text_stream.detach()
+
+def pay_invoices(ids=(), numbers=(), scope=()) -> list:
+    """
+    Mark invoices paid by id and/or invoice number. `scope` is extra WHERE
+    criteria (invoices outside it count as not found). Returns one dict per
+    distinct input, in input order, with outcome "updated", "already_paid" or
+    "not_found". Runs in the caller's transaction; the caller commits.
+    """
+    keys = list(dict.fromkeys([("id", i) for i in ids] + [("invoice_number", n) for n in numbers]))
+    by_id = [v for k, v in keys if k == "id"]
+    by_number = [v for k, v in keys if k == "invoice_number"]
+    found = {}
+    if keys:
+        match = or_(Invoice.id.in_(by_id), Invoice.invoice_number.in_(by_number))
+        for i, num, paid in (db.session.query(Invoice.id, Invoice.invoice_number, Invoice.is_paid)
+                             .filter(match, *scope)):
+            found[("id", i)] = found[("invoice_number", num)] = (i, num, bool(paid))
+    unpaid = sorted({i for i, _, paid in found.values() if not paid})
+    updated = set()
+    if unpaid:
+        stmt = (update(Invoice)
+                .where(Invoice.id.in_(unpaid), Invoice.is_paid.is_(False))
+                .values(is_paid=True)
+                .returning(Invoice.id))
+        updated = set(db.session.execute(stmt).scalars())
+    out = []
+    for key in keys:
+        hit = found.get(key)
+        if hit is None:
+            out.append({key[0]: key[1], "outcome": "not_found"})
+        else:
+            out.append({"id": hit[0], "invoice_number": hit[1],
+                        "outcome": "updated" if hit[0] in updated else "already_paid"})
+    return out
+
+@routes.post("/api/invoices/pay", endpoint="api_invoices_pay")
+@login_required
+@role_required(("employee", "admin"))
+def api_invoices_pay():
+    """
+    Batch payment posting. JSON {"ids": [..], "invoice_numbers": [..]} or a
+    multipart receipts CSV in "file"  ->  per-invoice outcomes + counts.
+    """
+    ids, numbers = [], []
+    f = request.files.get("file")
+    if f and f.filename:
+        if not f.filename.lower().endswith(".csv"):
+            return jsonify({"error": "ملف الإيصالات يجب أن يكون CSV."}), 400
+        numbers = receipt_invoice_numbers(f)
+    else:
+        body = request.get_json(silent=True) or {}
+        try:
+            ids = [int(v) for v in (body.get("ids") or [])]
+        except (TypeError, ValueError):
+            return jsonify({"error": "أرقام الفواتير (ids) يجب أن تكون أعداداً صحيحة."}), 400
+        numbers = [str(v).strip() for v in (body.get("invoice_numbers") or []) if str(v).strip()]
+    if not (ids or numbers):
+        return jsonify({"error": "لا توجد فواتير في الطلب."}), 400
+    if len(ids) + len(numbers) > PAY_BATCH_MAX:
+        return jsonify({"error": f"عدد الفواتير كبير جداً (الحد {PAY_BATCH_MAX})."}), 400
+
+    results = pay_invoices(ids, numbers, _employee_scope(current_user))
+    db.session.commit()
+    counts = {k: sum(1 for r in results if r["outcome"] == k) for k in ("updated", "already_paid", "not_found")}
+    current_app.logger.info("[pay] %s: %s", current_user.username, counts)
+    return jsonify(dict(counts, results=results))
+
+# ---------------- Delta sync (employee field view) ----------------
+# Every commit that writes invoices takes one value of the "sync" counter:
+# writes leave invoices.sync_version NULL (new rows, ORM edits, bulk UPDATEs
+# all set it so) and before_commit stamps the NULL rows in one UPDATE, along
+# with updated_at.
+# Deletes leave a tombstone at the same version. On Postgres the counter row
+# stays locked until commit, so versions become visible in order and a
+# client's (sync_version, id) cursor never skips a row.
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "500"))
+SYNC_WINDOW_MONTHS = int(os.getenv("SYNC_WINDOW_MONTHS", "3"))   # the offline copy holds the last N months
+SYNC_OPS_TTL_DAYS = int(os.getenv("SYNC_OPS_TTL_DAYS", "30"))
+SYNC_INVOICE_FIELDS = ("id", "invoice_number", "date", "branch_number", "customer_name", "meter_number",
+                       "prev_reading", "curr_reading", "kwh_used", "total_due", "is_paid")
+SYNC_BRANCH_FIELDS = ("branch_number", "customer_name", "meter_number", "subscription_amps",
+                      "curr_reading", "date", "id")
+
+class InvoiceTombstone(db.Model):
+    __tablename__ = "invoice_tombstones"
+    invoice_id = db.Column(db.Integer, primary_key=True)
+    branch_number = db.Column(db.String(64), nullable=True)
+    sync_version = db.Column(db.BigInteger, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class SyncOp(db.Model):
+    """Idempotency record of an offline op (reading / payment) replayed through /api/employee/sync."""
+    __tablename__ = "sync_ops"
+    op_key = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    result = db.Column(db.Text, nullable=True)              # JSON; NULL while the claiming request runs
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+def _mark_sync(session, deleted=None):
+    session.info["sync_pending"] = True
+    if deleted:
+        session.info.setdefault("sync_deleted", {}).update(deleted)
+
+@event.listens_for(Session, "before_flush")
+def _track_sync_flush(session, flush_context, instances):
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, Invoice) and (obj in session.new or session.is_modified(obj)):
+            obj.sync_version = None
+            _mark_sync(session)
+    deleted = {obj.id: obj.branch_number for obj in session.deleted if isinstance(obj, Invoice) and obj.id}
+    if deleted:
+        _mark_sync(session, deleted)
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_sync_bulk(state):
+    if not (state.is_insert or state.is_update or state.is_delete):
+        return
+    if getattr(getattr(state.statement, "table", None), "name", None) != Invoice.__tablename__:
+        return
+    params = state.parameters
+    rows = params if isinstance(params, (list, tuple)) else ([params] if params else [])
+    if state.is_update:
+        if rows and state.statement.whereclause is None:    # ORM bulk UPDATE by primary key
+            for p in rows:
+                p["sync_version"] = None
+        else:
+            state.statement = state.statement.values(sync_version=None)
+    elif state.is_delete:
+        sel = select(Invoice.id, Invoice.branch_number)
+        if state.statement.whereclause is not None:
+            sel = sel.where(state.statement.whereclause)
+        _mark_sync(state.session, dict(state.session.connection().execute(sel).all()))
+        return
+    _mark_sync(state.session)
+
+@event.listens_for(Session, "before_commit")
+def _stamp_sync_on_commit(session):
+    if not (session.info.get("sync_pending") or session.new or session.dirty or session.deleted):
+        return
+    session.flush()
+    if not session.info.pop("sync_pending", False):
+        return
+    deleted = session.info.pop("sync_deleted", None)
+    version = bump_counter("sync")
+    now = datetime.utcnow()
+    conn = session.connection()   # Core: the statements below are not re-tracked
+    tbl = Invoice.__table__
+    conn.execute(update(tbl).where(tbl.c.sync_version.is_(None)).values(sync_version=version, updated_at=now))
+    if deleted:
+        tomb = InvoiceTombstone.__table__
+        ins = dialect_insert(tomb)
+        conn.execute(ins.on_conflict_do_update(index_elements=[tomb.c.invoice_id],
+                                               set_={"sync_version": ins.excluded.sync_version,
+                                                     "branch_number": ins.excluded.branch_number,
+                                                     "deleted_at": ins.excluded.deleted_at}),
+                     [{"invoice_id": i, "branch_number": b, "sync_version": version,
+                       "deleted_at": now} for i, b in deleted.items()])
+
+@event.listens_for(Session, "after_rollback")
+def _sync_rolled_back(session):
+    session.info.pop("sync_pending", None)
+    session.info.pop("sync_deleted", None)
+
+def encode_sync_cursor(version, invoice_id) -> str:
+    return f"{int(version)}.{int(invoice_id)}"
+
+def decode_sync_cursor(token):
+    """(version, id) from "123.456", or None for a full sync."""
+    m = re.match(r"^(\d+)\.(\d+)$", (token or "").strip())
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+def _sync_value(v):
+    if isinstance(v, date):
+        return v.isoformat()
+    if isinstance(v, float):
+        return round(v, 2)
+    return v
+
+def sync_changes(since=None, limit=None, scope=()) -> dict:
+    """
+    Invoices written after cursor `since` (a (version, id) pair, None = all),
+    oldest change first, plus tombstones and the branch snapshots they touch.
+    Rows are positional lists in SYNC_*_FIELDS order to keep the payload small.
+    """
+    limit = min(max(int(limit or SYNC_PAGE_SIZE), 1), 2000)
+    cols = [getattr(Invoice, f) for f in SYNC_INVOICE_FIELDS]
+    qry = db.session.query(Invoice.sync_version, *cols).filter(Invoice.sync_version.isnot(None), *scope)
+    if since is not None:
+        qry = qry.filter(tuple_(Invoice.sync_version, Invoice.id) > tuple_(*since))
+    rows = qry.order_by(Invoice.sync_version, Invoice.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    deleted = []
+    if since is not None:
+        tq = db.session.query(InvoiceTombstone.invoice_id, InvoiceTombstone.branch_number).filter(
+            InvoiceTombstone.sync_version > since[0])
+        if has_more:   # the rest arrive with the page that reaches their version
+            tq = tq.filter(InvoiceTombstone.sync_version <= rows[-1][0])
+        deleted = tq.all()
+
+    cursor = encode_sync_cursor(rows[-1][0], rows[-1][1]) if rows else (
+        encode_sync_cursor(*since) if since else None)
+    if not has_more:
+        # nothing left: jump past tombstone-only versions so they aren't re-sent
+        top = db.session.query(func.max(InvoiceTombstone.sync_version)).scalar()
+        if top is not None and (since is None or top > since[0]) and (not rows or top > rows[-1][0]):
+            cursor = encode_sync_cursor(top, 0)
+
+    branches = {r[1 + SYNC_INVOICE_FIELDS.index("branch_number")] for r in rows} | {b for _, b in deleted if b}
+    states = branch_states(branches) if branches else {}
+    return {
+        "cursor": cursor,
+        "has_more": has_more,
+        "fields": list(SYNC_INVOICE_FIELDS),
+        "invoices": [[_sync_value(v) for v in r[1:]] for r in rows],
+        "deleted": [i for i, _ in deleted],
+        "branch_fields": list(SYNC_BRANCH_FIELDS),
+        "branches": [[_sync_value(getattr(st, f)) for f in SYNC_BRANCH_FIELDS] for st in states.values()],
+        "branches_removed": sorted(b for b in branches if b not in states),
+    }
+
+def apply_sync_ops(user, ops, scope=()) -> list:
+    """
+    Replay queued offline ops: {"key", "type": "reading", "branch_number", "curr_reading", "date"?}
+    or {"key", "type": "pay", "id"}. Each key is claimed in sync_ops first, so a
+    resent op returns its stored result instead of running twice.
+    Runs in the caller's transaction; the caller commits.
+    """
+    today = datetime.utcnow().date()
+    ops = list({str(op.get("key") or ""): op for op in ops if isinstance(op, dict)}.items())
+    results = {k: {"key": k, "error": "مفتاح العملية (key) مطلوب."} for k, _ in ops if not k or len(k) > 64}
+    ops = [(k, op) for k, op in ops if k not in results]
+    if not ops:
+        return list(results.values())
+
+    tbl = SyncOp.__table__
+    claimed = set(db.session.execute(
+        dialect_insert(tbl).on_conflict_do_nothing(index_elements=[tbl.c.op_key]).returning(tbl.c.op_key),
+        [{"op_key": k, "user_id": user.id, "created_at": datetime.utcnow()} for k, _ in ops]).scalars())
+    for k, res in db.session.query(SyncOp.op_key, SyncOp.result).filter(
+            SyncOp.op_key.in_([k for k, _ in ops if k not in claimed])):
+        results[k] = dict(json.loads(res) if res else {"error": "العملية قيد التنفيذ."}, key=k, replayed=True)
+
+    readings, pays = {}, []
+    for k, op in ops:
+        if k not in claimed:
+            continue
+        if op.get("type") == "reading":
+            d = _parse_import_date(op.get("date")) or today
+            readings.setdefault(min(d, today), []).append((k, op))
+        elif op.get("type") == "pay":
+            pays.append((k, op))
+        else:
+            results[k] = {"key": k, "error": "نوع العملية غير معروف."}
+    for d, items in readings.items():
+        for (k, _), res in zip(items, create_reading_invoices([op for _, op in items], d)):
+            res.pop("index", None)
+            results[k] = dict(res, key=k)
+    if pays:
+        ids = {}
+        for k, op in pays:
+            try:
+                ids[k] = int(op.get("id"))
+            except (TypeError, ValueError):
+                results[k] = {"key": k, "error": "رقم الفاتورة غير صالح."}
+        outcome = {r["id"]: r for r in pay_invoices(list(ids.values()), scope=scope)}
+        for k, i in ids.items():
+            results[k] = dict(outcome.get(i, {"id": i, "outcome": "not_found"}), key=k)
+
+    stored = [{"op_key": k, "result": json.dumps({f: v for f, v in results[k].items() if f != "key"},
+                                                  ensure_ascii=False)}
+              for k in claimed if k in results]
+    if stored:
+        db.session.execute(update(SyncOp), stored)
+    return [results[k] for k, _ in ops] + [r for k, r in results.items() if not k or len(k) > 64]
+
+def prune_sync_ops() -> int:
+    cutoff = datetime.utcnow() - timedelta(days=SYNC_OPS_TTL_DAYS)
+    return SyncOp.query.filter(SyncOp.created_at < cutoff).delete(synchronize_session=False)
+
+def sync_window_start(today=None) -> date:
+    """First day of the oldest month the field view keeps offline (the current month counts as one)."""
+    d = (today or datetime.utcnow().date()).replace(day=1)
+    for _ in range(max(SYNC_WINDOW_MONTHS, 1) - 1):
+        d = (d - timedelta(days=1)).replace(day=1)
+    return d
+
+def _employee_scope(user) -> list:
+    min_visible = getattr(user, "min_visible_date", None)
+    if min_visible and getattr(user, "role", None) != "admin" and not getattr(user, "is_admin", False):
+        return [Invoice.date >= min_visible]
+    return []
+
+@routes.route("/api/employee/sync", methods=["GET", "POST"], endpoint="api_employee_sync")
+@login_required
+def api_employee_sync():
+    """
+    GET ?since=<cursor>&limit=N  ->  changes since the cursor (see sync_changes).
+    POST {"ops": [...], "since": cursor}  ->  {"results": [per op]} plus the changes
+    since `since`, so one round trip both flushes the offline queue and pulls.
+    Only invoices dated from `window_start` (SYNC_WINDOW_MONTHS) are sent; the
+    client drops older rows, so a cold start never pulls the whole history.
+    """
+    window = sync_window_start()
+    scope = _employee_scope(current_user) + [Invoice.date >= window]
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        ops = body.get("ops") or []
+        if not isinstance(ops, list) or len(ops) > READINGS_BATCH_MAX:
+            return jsonify({"error": f"قائمة العمليات غير صالحة (الحد {READINGS_BATCH_MAX})."}), 400
+        if ops and getattr(current_user, "role", None) != "employee":
+            return jsonify({"error": "غير مسموح."}), 403
+        results = apply_sync_ops(current_user, ops, scope) if ops else []
+        prune_sync_ops()
+        db.session.commit()
+        out = sync_changes(decode_sync_cursor(body.get("since")), body.get("limit"), scope)
+        out.update(results=results, window_start=window.isoformat())
+        return jsonify(out)
+    try:
+        limit = int(request.args.get("limit", SYNC_PAGE_SIZE))
+    except Exception:
+        limit = SYNC_PAGE_SIZE
+    out = sync_changes(decode_sync_cursor(request.args.get("since")), limit, scope)
+    out["window_start"] = window.isoformat()
+    return jsonify(out)
+
 # Export (also mapped to /admin/export)
-@app.get("/export", endpoint="export_invoices")
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "2000"))
+EXPORT_HEADERS = ["id","invoice_number","date","customer_name","meter_number","branch_number",
+                  "subscription_amps","prev_reading","curr_reading","kwh_used","unit_price",
+                  "energy_cost","subscription_fee","month_cost","total_due","is_paid"]
+
+def _export_rows(qry):
+    """Yield export rows as plain lists from column tuples fetched EXPORT_CHUNK at a time."""
+    for r in qry.execution_options(yield_per=EXPORT_CHUNK):
+        r = list(r)
+        r[2] = r[2].isoformat() if r[2] else ""
+        r[-1] = int(bool(r[-1]))
+        yield r
+
+@routes.get("/export", endpoint="export_invoices")
 @login_required
 @role_required("admin")
 def export_invoices():
+    """Stream invoices as CSV (chunked response) or XLSX (write-only workbook spooled to a temp file)."""
     fmt = (request.args.get("format") or "csv").lower()
     month = request.args.get("month")
-    qry = Invoice.query.order_by(Invoice.id.desc())
+    qry = (db.session.query(*[getattr(Invoice, c) for c in EXPORT_HEADERS])
+           .order_by(Invoice.id.desc()))
     if month:
         try:
             y, m = [int(x) for x in month.split("-")]
@@ -704,48 +2275,188 @@ def export_invoices():
             qry = qry.filter(Invoice.date >= first, Invoice.date <= last_day)
         except Exception:
             pass
-    rows = qry.all()
-    headers = ["id","invoice_number","date","customer_name","meter_number","branch_number",
-               "subscription_amps","prev_reading","curr_reading","kwh_used","unit_price",
-               "energy_cost","subscription_fee","month_cost","total_due","is_paid"]
     if fmt == "xlsx":
         try:
-            from openpyxl import Workbook
-            wb = Workbook(); ws = wb.active; ws.title="invoices"; ws.append(headers)
-            for i in rows:
-                ws.append([i.id, i.invoice_number, i.date.isoformat() if i.date else "", i.customer_name,
-                           i.meter_number, i.branch_number, i.subscription_amps, i.prev_reading, i.curr_reading,
-                           i.kwh_used, i.unit_price, i.energy_cost, i.subscription_fee, i.month_cost, i.total_due,
-                           int(bool(i.is_paid))])
-            bio = io.BytesIO(); wb.save(bio); wb.close(); bio.seek(0)
-            return send_file(bio, as_attachment=True, download_name="invoices.xlsx",
-                             mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-        except Exception:
-            fmt = "csv"
-    sio = io.StringIO(); w = csv.writer(sio); w.writerow(headers)
-    for i in rows:
-        w.writerow([i.id, i.invoice_number, i.date.isoformat() if i.date else "", i.customer_name,
-                    i.meter_number, i.branch_number, i.subscription_amps, i.prev_reading, i.curr_reading,
-                    i.kwh_used, i.unit_price, i.energy_cost, i.subscription_fee, i.month_cost, i.total_due,
-                    int(bool(i.is_paid))])
-    return Response(sio.getvalue(), mimetype="text/csv",
-                    headers={"Content-Disposition":"attachment; filename=invoices.csv"})
+            from openpyxl import Workbook
+            wb = Workbook(write_only=True); ws = wb.create_sheet("invoices"); ws.append(EXPORT_HEADERS)
+            for row in _export_rows(qry):
+                ws.append(row)
+            tmp = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+            wb.save(tmp); wb.close(); tmp.seek(0)
+            return send_file(tmp, as_attachment=True, download_name="invoices.xlsx",
+                             mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        except Exception:
+            fmt = "csv"
+
+    def generate():
+        sio = io.StringIO(); w = csv.writer(sio); w.writerow(EXPORT_HEADERS)
+        for n, row in enumerate(_export_rows(qry), 1):
+            w.writerow(row)
+            if n % 500 == 0:
+                yield sio.getvalue(); sio.seek(0); sio.truncate(0)
+        yield sio.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype="text/csv",
+                    headers={"Content-Disposition":"attachment; filename=invoices.csv"})
+
+routes.add_url_rule("/admin/export", endpoint="export_invoices", view_func=export_invoices, methods=["GET"])
+
+# Print & PDF
+
+# ---------------- Render process pool ----------------
+# One pool per worker process, created on first use and shared by QR and PDF
+# rendering, instead of a fresh pool per request/job. Its processes come from
+# a forkserver (spawn where unavailable), never fork()ed from a threaded worker.
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or (os.cpu_count() or 1)
+
+_render_pool = {"ex": None}
+_render_pool_lock = threading.Lock()
+
+def render_pool() -> ProcessPoolExecutor:
+    with _render_pool_lock:
+        if _render_pool["ex"] is None:
+            try:
+                ctx = multiprocessing.get_context("forkserver")
+            except ValueError:
+                ctx = multiprocessing.get_context("spawn")
+            _render_pool["ex"] = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=ctx)
+        return _render_pool["ex"]
+
+def reset_render_pool() -> None:
+    """Drop a broken pool (a render process died); the next render_pool() call starts a new one."""
+    with _render_pool_lock:
+        ex, _render_pool["ex"] = _render_pool["ex"], None
+    if ex is not None:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+# ---------------- QR code cache ----------------
+# Content-addressed: key = sha256(format, box size, payload). Two tiers: an
+# in-process LRU and a shared on-disk directory, so every worker benefits.
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "invoice_app_qr")
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "5000"))       # memory tier entries
+QR_PARALLEL_MIN = int(os.getenv("QR_PARALLEL_MIN", "64"))     # misses before using a process pool
+
+_qr_memory = OrderedDict()
+_qr_lock = threading.Lock()
+
+def _qr_key(payload: str, box_size: int, fmt: str) -> str:
+    return hashlib.sha256(f"{fmt}|{box_size}|1|{payload}".encode("utf-8")).hexdigest()
+
+def _qr_disk_path(key: str) -> str:
+    return os.path.join(QR_CACHE_DIR, key[:2], key + ".uri")
+
+def _qr_cache_get(key: str):
+    with _qr_lock:
+        uri = _qr_memory.get(key)
+        if uri is not None:
+            _qr_memory.move_to_end(key)
+            return uri
+    try:
+        with open(_qr_disk_path(key), "r", encoding="ascii") as fh:
+            uri = fh.read()
+    except OSError:
+        return None
+    _qr_memory_put(key, uri)
+    return uri
+
+def _qr_memory_put(key: str, uri: str) -> None:
+    with _qr_lock:
+        _qr_memory[key] = uri
+        _qr_memory.move_to_end(key)
+        while len(_qr_memory) > QR_CACHE_SIZE:
+            _qr_memory.popitem(last=False)
+
+def _qr_cache_put(key: str, uri: str) -> None:
+    _qr_memory_put(key, uri)
+    path = _qr_disk_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}"
+        with open(tmp_path, "w", encoding="ascii") as fh:
+            fh.write(uri)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def _render_qr(job):
+    """Render one QR as a data URI. Module-level so a process pool can run it."""
+    payload, box_size, fmt = job
+    try:
+        qr = qrcode.QRCode(version=1, box_size=box_size, border=1)
+        qr.add_data(payload)
+        qr.make(fit=True)
+        bio = io.BytesIO()
+        if fmt == "svg":
+            # vector path, no PNG/Pillow encoding at all
+            from qrcode.image.svg import SvgPathImage
+            qr.make_image(image_factory=SvgPathImage).save(bio)
+            return "data:image/svg+xml;base64," + base64.b64encode(bio.getvalue()).decode("ascii")
+        img = qr.make_image(fill_color="black", back_color="white")
+        img.save(bio, format="PNG")
+        return "data:image/png;base64," + base64.b64encode(bio.getvalue()).decode("ascii")
+    except Exception:
+        return None
+
+def qr_data_uris(payloads, box_size: int = 2, fmt: str = "png") -> list:
+    """
+    QR data URIs for many payloads (same order). Cache hits come from memory or
+    disk; misses are rendered once per distinct payload, in a process pool when
+    there are at least QR_PARALLEL_MIN of them. Returns None entries if qrcode
+    is unavailable or rendering fails.
+    """
+    if not qrcode:
+        return [None] * len(payloads)
+    fmt = "svg" if fmt == "svg" else "png"
+    results = [None] * len(payloads)
+    misses = {}   # key -> (payload, [indexes])
+    for i, payload in enumerate(payloads):
+        payload = payload or ""
+        key = _qr_key(payload, box_size, fmt)
+        uri = _qr_cache_get(key)
+        if uri is None:
+            misses.setdefault(key, (payload, []))[1].append(i)
+        else:
+            results[i] = uri
+    if not misses:
+        return results
+
+    jobs = [(payload, box_size, fmt) for payload, _ in misses.values()]
+    rendered = None
+    if len(jobs) >= QR_PARALLEL_MIN and RENDER_WORKERS > 1:
+        try:
+            rendered = list(render_pool().map(_render_qr, jobs,
+                                              chunksize=max(1, len(jobs) // (RENDER_WORKERS * 4))))
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                reset_render_pool()
+            print("[qr] process pool unavailable, rendering inline:", e)
+    if rendered is None:
+        rendered = [_render_qr(j) for j in jobs]
+
+    for (key, (_, idxs)), uri in zip(misses.items(), rendered):
+        if uri is None:
+            continue
+        _qr_cache_put(key, uri)
+        for i in idxs:
+            results[i] = uri
+    return results
 
-try:
-    app.add_url_rule("/admin/export", endpoint="export_invoices", view_func=export_invoices, methods=["GET"])
-except Exception:
-    pass
+def qr_data_uri(payload: str, box_size: int = 4, fmt: str = "png"):
+    return qr_data_uris([payload], box_size=box_size, fmt=fmt)[0]
 
-# Print & PDF
+def _qr_format_arg() -> str:
+    """?qr=svg selects the lighter inline SVG output."""
+    return "svg" if (request.args.get("qr") or "").lower() == "svg" else "png"
 
 
-@app.get("/invoices/print-all", endpoint="print_all_invoices")
+@routes.get("/invoices/print-all", endpoint="print_all_invoices")
 @login_required
 @role_required("admin")
 def print_all_invoices():
     """
     Render a printable view that includes all invoices for the specified month.
     Accepts ?month=YYYY-MM (preferred). If not provided, will derive from ?start=YYYY-MM-DD.
+    ?qr=svg switches the QR codes to inline SVG.
     """
     month_param = (request.args.get("month") or "").strip()
     start_param = (request.args.get("start") or "").strip()
@@ -776,62 +2487,274 @@ def print_all_invoices():
             .order_by(Invoice.id.asc())
             .all())
 
-    # Precompute QR codes if available (optional, same as invoice_print)
-    qr_map = {}
-    if qrcode:
-        for i in rows:
-            try:
-                qr = qrcode.QRCode(version=1, box_size=2, border=1)
-                qr.add_data(i.invoice_number or "")
-                qr.make(fit=True)
-                img = qr.make_image(fill_color="black", back_color="white")
-                bio = io.BytesIO(); img.save(bio, format="PNG")
-                qr_map[i.id] = "data:image/png;base64," + base64.b64encode(bio.getvalue()).decode("ascii")
-            except Exception:
-                qr_map[i.id] = None
+    # QR codes (cached; misses rendered in parallel)
+    uris = qr_data_uris([i.invoice_number or "" for i in rows], box_size=2, fmt=_qr_format_arg())
+    qr_map = {i.id: uri for i, uri in zip(rows, uris)}
 
     return render_template("invoice_print_all.html", invoices=rows, month=month_key_str, qr_map=qr_map)
-@app.get("/invoice/<int:invoice_id>/print", endpoint="invoice_print")
+@routes.get("/invoice/<int:invoice_id>/print", endpoint="invoice_print")
 @login_required
 @role_required("admin")
 def invoice_print(invoice_id: int):
+    fresh = revalidate_invoice(invoice_id)
+    if fresh is not None:
+        return fresh
     i = Invoice.query.get_or_404(invoice_id)
-    qr_data_uri = None
-    if qrcode:
-        try:
-            qr = qrcode.QRCode(version=1, box_size=4, border=1)
-            qr.add_data(f"INV:{i.invoice_number}")
-            qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
-            bio=io.BytesIO(); img.save(bio, format="PNG")
-            qr_data_uri = "data:image/png;base64," + base64.b64encode(bio.getvalue()).decode("ascii")
-        except Exception:
-            qr_data_uri=None
-    return render_template("invoice_print.html", i=i, qr_data_uri=qr_data_uri)
+    qr_uri = qr_data_uri(f"INV:{i.invoice_number}", box_size=4, fmt=_qr_format_arg())
+    return render_template("invoice_print.html", i=i, qr_data_uri=qr_uri)
+
+# ---------------- PDF rendering & month bundles ----------------
+# Rendered PDFs are cached on disk by sha256 of the invoice's rendered HTML,
+# so unchanged invoices are never re-rendered. Bundle jobs run in a background
+# thread feeding the shared render pool; their state lives in a JSON file so any
+# worker can answer progress polls.
+PDF_DIR = os.getenv("PDF_BUNDLE_DIR") or os.path.join(tempfile.gettempdir(), "invoice_app_pdf")
+PDF_BUNDLE_CHUNK = 200                                     # invoices rendered to HTML per step
+PDF_BUNDLE_TTL = int(os.getenv("PDF_BUNDLE_TTL_HOURS", "24")) * 3600
+PDF_CACHE_TTL = int(os.getenv("PDF_CACHE_TTL_DAYS", "30")) * 86400   # unused cached PDFs expire
+PDF_JOB_STALE = int(os.getenv("PDF_JOB_STALE_SECONDS", "900"))      # no heartbeat this long -> failed
+PDF_PRUNE_EVERY = 3600
 
-@app.get("/invoice/<int:invoice_id>/pdf", endpoint="invoice_pdf")
-@login_required
-@role_required("admin")
-def invoice_pdf(invoice_id: int):
-    i = Invoice.query.get_or_404(invoice_id)
-    html = render_template("invoice_print.html", i=i, qr_data_uri=None)
+try:
+    from pypdf import PdfWriter   # optional: merged single-PDF bundles
+except Exception:
+    PdfWriter = None
+
+def _html_to_pdf(html: str):
+    """xhtml2pdf render, module-level so a process pool can run it. Returns bytes or None."""
     try:
         from xhtml2pdf import pisa
         pdf_io = io.BytesIO()
         status = pisa.CreatePDF(html, dest=pdf_io, encoding="utf-8")
-        if not status.err:
-            pdf_io.seek(0)
-            return Response(pdf_io.getvalue(), mimetype="application/pdf",
-                            headers={"Content-Disposition": f"attachment; filename=invoice_{invoice_id}.pdf"})
+        return None if status.err else pdf_io.getvalue()
     except Exception:
+        return None
+
+def _pdf_cache_path(html: str) -> str:
+    key = hashlib.sha256(html.encode("utf-8")).hexdigest()
+    return os.path.join(PDF_DIR, "cache", key[:2], key + ".pdf")
+
+def _write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp_path, path)
+
+def render_invoice_html(i) -> str:
+    return render_template("invoice_print.html", i=i, qr_data_uri=None)
+
+def _job_path(job_id: str, name: str = "status.json") -> str:
+    return os.path.join(PDF_DIR, "jobs", job_id, name)
+
+def read_pdf_job(job_id: str):
+    """
+    Job state from its status file. A queued/running job whose heartbeat is older
+    than PDF_JOB_STALE lost its thread (worker recycled or killed) and is marked failed.
+    """
+    if not re.match(r"^[0-9a-f]{32}$", job_id or ""):
+        return None
+    try:
+        with open(_job_path(job_id), "r", encoding="utf-8") as fh:
+            state = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if (state.get("status") in ("queued", "running")
+            and time.time() - float(state.get("heartbeat") or 0) > PDF_JOB_STALE):
+        state.update(status="failed", error="توقفت المهمة (أُعيد تشغيل الخادم). أعد إنشاء الملف.",
+                     finished_at=datetime.utcnow().isoformat())
+        try:
+            _save_pdf_job(state, beat=False)
+        except OSError:
+            pass
+    return state
+
+def _save_pdf_job(state: dict, beat: bool = True) -> None:
+    if beat:
+        state["heartbeat"] = time.time()
+    _write_atomic(_job_path(state["id"]), json.dumps(state).encode("utf-8"))
+
+_pdf_pruned_at = {"t": 0.0}
+
+def _prune_pdf_jobs(force: bool = False) -> None:
+    """Drop job folders (and their bundles) past PDF_BUNDLE_TTL and cached PDFs unused for PDF_CACHE_TTL."""
+    now = time.time()
+    if not force and now - _pdf_pruned_at["t"] < PDF_PRUNE_EVERY:
+        return
+    _pdf_pruned_at["t"] = now
+    root = os.path.join(PDF_DIR, "jobs")
+    try:
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if os.path.getmtime(path) < now - PDF_BUNDLE_TTL:
+                shutil.rmtree(path, ignore_errors=True)
+    except OSError:
         pass
+    for dirpath, _, files in os.walk(os.path.join(PDF_DIR, "cache")):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            try:
+                if os.path.getmtime(path) < now - PDF_CACHE_TTL:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def _touch_cached_pdf(path: str) -> bool:
+    """True if the cached PDF exists; refreshes its mtime so pruning keeps PDFs still in use."""
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+def start_pdf_bundle(ids: list, label: str, fmt: str = "zip") -> dict:
+    """Queue a bundle job for the given invoice ids and start it in the background."""
+    _prune_pdf_jobs()
+    fmt = "pdf" if (fmt == "pdf" and PdfWriter is not None) else "zip"
+    state = {"id": uuid.uuid4().hex, "label": label, "format": fmt, "status": "queued",
+             "total": len(ids), "done": 0, "cached": 0, "failed": 0,
+             "started_at": datetime.utcnow().isoformat(), "finished_at": None, "error": None}
+    _save_pdf_job(state)
+    threading.Thread(target=_run_pdf_bundle, args=(current_app._get_current_object(), state, ids), daemon=True).start()
+    return state
+
+def _run_pdf_bundle(flask_app, state: dict, ids: list) -> None:
+    # A request context lets invoice_print.html use url_for() outside a request.
+    with flask_app.test_request_context():
+        try:
+            state["status"] = "running"; _save_pdf_job(state)
+            paths = []   # (arcname, cache path) in invoice order
+            ex = render_pool()
+            for k in range(0, len(ids), PDF_BUNDLE_CHUNK):
+                chunk = ids[k:k + PDF_BUNDLE_CHUNK]
+                rows = Invoice.query.filter(Invoice.id.in_(chunk)).order_by(Invoice.id.asc()).all()
+                pending = {}
+                for i in rows:
+                    html = render_invoice_html(i)
+                    path = _pdf_cache_path(html)
+                    paths.append((f"invoice_{i.invoice_number or i.id}.pdf", path))
+                    if _touch_cached_pdf(path):
+                        state["cached"] += 1; state["done"] += 1
+                    else:
+                        pending[path] = html
+                futures = {ex.submit(_html_to_pdf, html): path for path, html in pending.items()}
+                for fut in as_completed(futures):
+                    pdf = fut.result()
+                    if pdf:
+                        _write_atomic(futures[fut], pdf)
+                    else:
+                        state["failed"] += 1
+                    state["done"] += 1
+                    if state["done"] % 25 == 0:
+                        _save_pdf_job(state)
+                db.session.remove()
+                _save_pdf_job(state)
+
+            _save_pdf_job(state)   # heartbeat before the (possibly long) merge
+            out = _job_path(state["id"], "bundle." + state["format"])
+            if state["format"] == "pdf":
+                writer = PdfWriter()
+                for _, path in paths:
+                    if os.path.exists(path):
+                        writer.append(path)
+                with open(out, "wb") as fh:
+                    writer.write(fh)
+            else:
+                # PDFs are already compressed; store them as-is
+                with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as zf:
+                    for arcname, path in paths:
+                        if os.path.exists(path):
+                            zf.write(path, arcname)
+            state["status"] = "done"
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                reset_render_pool()
+            state["status"] = "failed"; state["error"] = str(e)
+            print("[pdf-bundle] failed:", e)
+        finally:
+            state["finished_at"] = datetime.utcnow().isoformat()
+            _save_pdf_job(state)
+            db.session.remove()
+
+@routes.get("/invoice/<int:invoice_id>/pdf", endpoint="invoice_pdf")
+@login_required
+@role_required("admin")
+def invoice_pdf(invoice_id: int):
+    i = Invoice.query.get_or_404(invoice_id)
+    html = render_invoice_html(i)
+    path = _pdf_cache_path(html)
+    pdf = None
+    try:
+        with open(path, "rb") as fh:
+            pdf = fh.read()
+        _touch_cached_pdf(path)
+    except OSError:
+        pdf = _html_to_pdf(html)
+        if pdf:
+            try: _write_atomic(path, pdf)
+            except OSError: pass
+    if pdf:
+        return Response(pdf, mimetype="application/pdf",
+                        headers={"Content-Disposition": f"attachment; filename=invoice_{invoice_id}.pdf"})
     flash("تعذّر إنشاء PDF تلقائيًا. استخدم الطباعة ثم حفظ كـ PDF.", "error")
     return redirect(url_for("invoice_print", invoice_id=invoice_id))
 
+@routes.post("/invoices/pdf-bundle", endpoint="pdf_bundle_start")
+@login_required
+@role_required("admin")
+def pdf_bundle_start():
+    """
+    Start a PDF bundle for ?month=YYYY-MM, or for the current list filter
+    (start/end/status/q) when no month is given. format=zip (default) or pdf.
+    """
+    month_param = (request.values.get("month") or "").strip()
+    if re.match(r"^\d{4}-\d{2}$", month_param):
+        first, next_first = month_bounds(date(*map(int, month_param.split("-")), 1))
+        crit = [Invoice.date >= first, Invoice.date < next_first]
+        label = month_param
+    else:
+        start_date, end_date = list_date_range((request.values.get("start") or "").strip(),
+                                               (request.values.get("end") or "").strip())
+        crit = invoice_list_criteria(start_date, end_date,
+                                     (request.values.get("status") or "").strip().lower(),
+                                     (request.values.get("q") or "").strip())
+        label = f"{start_date or ''}..{end_date or ''}"
+    ids = [r[0] for r in db.session.query(Invoice.id).filter(*crit).order_by(Invoice.id.asc())]
+    if not ids:
+        flash("لا توجد فواتير ضمن هذا الاختيار.", "warning")
+        return redirect(request.referrer or url_for("index"))
+    state = start_pdf_bundle(ids, label, (request.values.get("format") or "zip").lower())
+    return redirect(url_for("pdf_bundle_status", job_id=state["id"]))
+
+@routes.get("/invoices/pdf-bundle/<job_id>", endpoint="pdf_bundle_status")
+@login_required
+@role_required("admin")
+def pdf_bundle_status(job_id: str):
+    _prune_pdf_jobs()
+    state = read_pdf_job(job_id)
+    if state is None:
+        return (jsonify({"error": "not found"}), 404) if request.args.get("json") else ("Not found", 404)
+    if request.args.get("json"):
+        return jsonify(state)
+    return render_template("pdf_bundle.html", job=state)
+
+@routes.get("/invoices/pdf-bundle/<job_id>/download", endpoint="pdf_bundle_download")
+@login_required
+@role_required("admin")
+def pdf_bundle_download(job_id: str):
+    state = read_pdf_job(job_id)
+    if not state or state.get("status") != "done":
+        flash("الملف غير جاهز بعد.", "warning")
+        return redirect(url_for("pdf_bundle_status", job_id=job_id))
+    fmt = state["format"]
+    return send_file(_job_path(job_id, "bundle." + fmt), as_attachment=True,
+                     download_name=f"invoices_{state['label']}.{fmt}".replace("..", "_"),
+                     mimetype="application/pdf" if fmt == "pdf" else "application/zip")
+
 # Users (minimal)
 
 
-@app.route("/admin/users", methods=["GET","POST"], endpoint="manage_users")
+@routes.route("/admin/users", methods=["GET","POST"], endpoint="manage_users")
 @login_required
 @role_required("admin")
 def manage_users():
@@ -867,7 +2790,7 @@ def manage_users():
 
     users = User.query.order_by(User.id.desc()).all()
     return render_template("users.html", users=users)
-@app.route("/admin/users/<int:user_id>/edit", methods=["GET","POST"], endpoint="edit_user")
+@routes.route("/admin/users/<int:user_id>/edit", methods=["GET","POST"], endpoint="edit_user")
 @login_required
 @role_required("admin")
 def edit_user(user_id):
@@ -947,7 +2870,7 @@ def manage_users():
 # New / View / Edit / Delete Invoice
 
 
-@app.route("/admin/users/<int:user_id>/delete", methods=["POST"], endpoint="delete_user")
+@routes.route("/admin/users/<int:user_id>/delete", methods=["POST"], endpoint="delete_user")
 @login_required
 @role_required("admin")
 def delete_user(user_id):
@@ -960,7 +2883,7 @@ def delete_user(user_id):
     db.session.commit()
     flash("تم حذف المستخدم.", "success")
     return redirect(url_for("manage_users"))
-@app.route("/invoice/new", methods=["GET","POST"], endpoint="new_invoice")
+@routes.route("/invoice/new", methods=["GET","POST"], endpoint="new_invoice")
 @login_required
 @role_required("admin")
 def new_invoice():
@@ -992,16 +2915,7 @@ def new_invoice():
         # defaults from last invoice of the same branch
         last = last_for_branch(branch)
 
-        # 3) prevent duplicate for the *selected* month (not today's)
-        if has_invoice_in_month(branch, use_date):
-            existing = existing_invoice_for_month(branch, use_date)
-            flash(
-                f"يوجد فاتورة لهذه الشعبة لنفس الشهر ({month_key(use_date)}): رقم {existing.invoice_number}",
-                "error",
-            )
-            return redirect(request.referrer or url_for("index"))
-
-        # 4) readings
+        # 3) readings
         try:
             prev_reading = int(request.form.get("prev_reading") or (getattr(last, "curr_reading", 0) or 0))
         except Exception:
@@ -1029,7 +2943,7 @@ def new_invoice():
             unit_price = float(get_pricing().unit_price or 0.0)
         subscription_fee = _float(request.form.get("subscription_fee"))
         is_paid_val = request.form.get("is_paid") in ["on", "1", "true", "True"]
-        # 5) create invoice using the selected date
+        # 4) create invoice using the selected date
         inv = Invoice(
             invoice_number=next_invoice_number_for_date(use_date),
             date=use_date,
@@ -1046,14 +2960,22 @@ def new_invoice():
             is_paid=is_paid_val,
         )
 
-        # 6) totals
+        # 5) totals
         apply_pricing_defaults(inv, get_pricing())
         inv.kwh_used = max(0, inv.curr_reading - inv.prev_reading)
         inv.energy_cost = round(inv.kwh_used * float(inv.unit_price or 0), 2)
         inv.month_cost = float(inv.subscription_fee or 0)
         inv.total_due = round(inv.energy_cost + inv.month_cost, 2)
 
-        db.session.add(inv)
+        # 6) one invoice per branch for the *selected* month (not today's): the unique index decides
+        if insert_invoice(inv) is None:
+            db.session.rollback()
+            existing = existing_invoice_for_month(branch, use_date)
+            flash(
+                f"يوجد فاتورة لهذه الشعبة لنفس الشهر ({month_key(use_date)}): رقم {getattr(existing, 'invoice_number', '')}",
+                "error",
+            )
+            return redirect(request.referrer or url_for("index"))
         db.session.commit()
         flash("تم إنشاء الفاتورة الجديدة.", "success")
         return redirect(url_for("index", **_current_filter_args()))
@@ -1065,15 +2987,18 @@ def new_invoice():
     today = date.today().strftime("%Y-%m-%d")
     return render_template("invoice_new.html", last=last, branch=branch_arg, default_unit=default_unit, today=today)
 
-@app.get("/invoice/<int:invoice_id>", endpoint="view_invoice")
+@routes.get("/invoice/<int:invoice_id>", endpoint="view_invoice")
 @login_required
 @role_required("admin")
 def view_invoice(invoice_id: int):
+    fresh = revalidate_invoice(invoice_id)
+    if fresh is not None:
+        return fresh
     i = Invoice.query.get_or_404(invoice_id)
     return render_template("invoice_view.html", i=i)
 
 # ---- Edit / Delete (admin) ----
-@app.route("/invoice/<int:invoice_id>/edit", methods=["GET", "POST"], endpoint="edit_invoice")
+@routes.route("/invoice/<int:invoice_id>/edit", methods=["GET", "POST"], endpoint="edit_invoice")
 @login_required
 @role_required("admin")
 def edit_invoice(invoice_id: int):
@@ -1109,17 +3034,6 @@ def edit_invoice(invoice_id: int):
         new_fee    = _float(request.form.get("subscription_fee"), i.subscription_fee)
         new_paid   = request.form.get("is_paid") in ("on", "1", "true", "yes")
 
-        # duplicate guard (same شعبة + same month, excluding this invoice)
-        first, next_first = month_bounds(new_date)
-        dup = (Invoice.query
-               .filter(Invoice.id != i.id)
-               .filter(Invoice.branch_number == new_branch)
-               .filter(Invoice.date >= first, Invoice.date < next_first)
-               .first())
-        if dup:
-            flash(f"يوجد فاتورة لهذه الشعبة لنفس الشهر ({new_date.strftime('%Y-%m')}): رقم {dup.invoice_number}", "error")
-            return redirect(request.referrer or url_for("index"))
-
         # apply changes
         i.date = new_date
         i.branch_number = new_branch
@@ -1138,13 +3052,20 @@ def edit_invoice(invoice_id: int):
         i.month_cost  = float(i.subscription_fee or 0)
         i.total_due   = round(i.energy_cost + i.month_cost, 2)
 
-        db.session.commit()
+        # duplicate guard (same شعبة + same month): the unique index rejects the flush
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            dup = existing_invoice_for_month(new_branch, new_date)
+            flash(f"يوجد فاتورة لهذه الشعبة لنفس الشهر ({month_key(new_date)}): رقم {getattr(dup, 'invoice_number', '')}", "error")
+            return redirect(request.referrer or url_for("index"))
         flash("تم تحديث الفاتورة.", "success")
         return redirect(url_for("view_invoice", invoice_id=i.id))
 
     return render_template("invoice_edit.html", i=i)
 
-@app.post("/invoice/<int:invoice_id>/delete", endpoint="delete_invoice")
+@routes.post("/invoice/<int:invoice_id>/delete", endpoint="delete_invoice")
 @login_required
 @role_required("admin")
 def delete_invoice(invoice_id: int):
@@ -1155,7 +3076,7 @@ def delete_invoice(invoice_id: int):
     return redirect(url_for("index", **_current_filter_args()))
 
 
-@app.post("/invoices/bulk-delete", endpoint="bulk_delete_invoices")
+@routes.post("/invoices/bulk-delete", endpoint="bulk_delete_invoices")
 @login_required
 @role_required("admin")
 def bulk_delete_invoices():
@@ -1181,7 +3102,7 @@ def bulk_delete_invoices():
     return redirect(url_for("index", **_current_filter_args()))
 
 # Import branches + template
-@app.get("/admin/branches/template.xlsx", endpoint="branches_template_xlsx")
+@routes.get("/admin/branches/template.xlsx", endpoint="branches_template_xlsx")
 @login_required
 @role_required("admin")
 def branches_template_xlsx():
@@ -1206,260 +3127,429 @@ def branches_template_xlsx():
     )
 
 
-@app.route("/admin/branches/import-xlsx", methods=["GET","POST"], endpoint="import_branches_xlsx")
-@login_required
-@role_required("admin")
-def import_branches_xlsx():
-    import io, csv
-    from datetime import datetime, date
-    print(f"✅ Import batch size set to {IMPORT_BATCH_SIZE}")
-    BATCH = IMPORT_BATCH_SIZE
-    if request.method == "GET":
-        return render_template("import_branches.html", excel=True)
+# ---------------- Bulk import engine ----------------
+IMPORT_PREFETCH_CHUNK = 900   # stays under SQLite's bound-parameter limit
 
-    f = request.files.get("file")
-    if not f or not f.filename:
-        flash("اختر ملف Excel أو CSV.", "error")
-        return redirect(url_for("import_branches_xlsx"))
-    name = f.filename.lower()
-    today = datetime.utcnow().date()
-    created = 0
+def latest_invoices_for_branches(branches) -> dict:
+    """
+    Latest invoice (by date, id) for many branches at once: one windowed
+    query per IMPORT_PREFETCH_CHUNK branches instead of one query per row.
+    Returns {branch_number: row} with the columns an import needs.
+    """
+    out = {}
+    branches = list({b for b in branches if b})
+    for i in range(0, len(branches), IMPORT_PREFETCH_CHUNK):
+        chunk = branches[i:i + IMPORT_PREFETCH_CHUNK]
+        rn = func.row_number().over(
+            partition_by=Invoice.branch_number,
+            order_by=(Invoice.date.desc(), Invoice.id.desc()),
+        ).label("rn")
+        sub = (db.session.query(
+                    Invoice.branch_number, Invoice.date, Invoice.customer_name, Invoice.meter_number,
+                    Invoice.subscription_amps, Invoice.unit_price, Invoice.subscription_fee,
+                    Invoice.curr_reading, Invoice.id, Invoice.invoice_number, rn)
+               .filter(Invoice.branch_number.in_(chunk))
+               .subquery())
+        for r in db.session.query(sub).filter(sub.c.rn == 1):
+            out[r.branch_number] = r
+    return out
 
-    # تحويل تاريخ Excel serial أو نص إلى date
-    def _parse_date(val):
-        if val in (None, ""):
-            return None
-        # Excel serial numbers (1900-based), handle without pandas
+def compute_invoice_totals(v: dict) -> dict:
+    """Fill kwh_used / energy_cost / month_cost / total_due on an invoice values dict."""
+    v["kwh_used"]    = max(0, int(v.get("curr_reading") or 0) - int(v.get("prev_reading") or 0))
+    v["energy_cost"] = round(v["kwh_used"] * float(v.get("unit_price") or 0), 2)
+    v["month_cost"]  = float(v.get("subscription_fee") or 0)
+    v["total_due"]   = round(v["energy_cost"] + v["month_cost"], 2)
+    return v
+
+# تحويل تاريخ Excel serial أو نص إلى date
+def _parse_import_date(val):
+    if val in (None, ""):
+        return None
+    if isinstance(val, datetime):
+        return val.date()
+    if isinstance(val, date):
+        return val
+    # Excel serial numbers (1900-based), handle without pandas
+    try:
+        if isinstance(val, (int, float)) and float(val) > 10000:
+            base = datetime(1899, 12, 30)
+            return (base + timedelta(days=int(val))).date()
+    except Exception:
+        pass
+    s = str(val).strip()
+    # Try multiple common formats
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%Y/%m/%d", "%d-%m-%Y", "%m-%d-%Y"):
         try:
-            if isinstance(val, (int, float)) and float(val) > 10000:
-                base = datetime(1899, 12, 30)
-                return (base + timedelta(days=int(val))).date()
+            return datetime.strptime(s, fmt).date()
         except Exception:
             pass
-        s = str(val).strip()
-        # Try multiple common formats
-        for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%Y/%m/%d", "%d-%m-%Y", "%m-%d-%Y"):
-            try:
-                return datetime.strptime(s, fmt).date()
-            except Exception:
-                pass
-        # Last resort: split heuristics (m/d/y or y-m)
-        try:
-            parts = re.split(r"[\-/]", s)
-            if len(parts) == 3:
-                a,b,c = parts
-                if len(a)==4:  # Y-M-D
-                    return date(int(a), int(b), int(c))
-                # assume M/D/Y
-                return date(int(c), int(a), int(b))
-        except Exception:
-            return None
-
-    def create_from_row(getv):
-        nonlocal created
-        branch = str(getv("branch_number") or "").strip()
-        if not branch:
-            return
+    # Last resort: split heuristics (m/d/y or y-m)
+    try:
+        parts = re.split(r"[\-/]", s)
+        if len(parts) == 3:
+            a,b,c = parts
+            if len(a)==4:  # Y-M-D
+                return date(int(a), int(b), int(c))
+            # assume M/D/Y
+            return date(int(c), int(a), int(b))
+    except Exception:
+        return None
 
-        # آخر فاتورة للشعبة لافتراض القراءة السابقة إذا ما أُرسلت
-        last = last_for_branch(branch)
+# حالة الدفع من الملف (0/1, true/false, نعم/لا)
+def _import_bool(v):
+    if v is None: return False
+    s = str(v).strip().lower()
+    return s in ("1","true","yes","y","نعم","مدفوع")
 
-        # القيم الأساسية (مع fallbacks)
-        customer_name = (str(getv("customer_name") or "") or getattr(last, "customer_name", "")).strip() or getattr(last, "customer_name", "")
-        meter_number  = (str(getv("meter_number")  or "") or getattr(last, "meter_number",  "")).strip() or getattr(last, "meter_number",  "")
+def _import_row_values(row, last, pricing, today) -> dict:
+    """Turn one import row tuple (IMPORT_COLUMNS order) into invoice values, falling back to the branch's last invoice."""
+    (branch, f_customer, f_meter, f_amps, f_unit, f_fee, f_curr,
+     f_prev, f_date, f_number, f_paid) = row
+    branch = str(branch or "").strip()
 
-        try:
-            subscription_amps = int(getv("subscription_amps") or (getattr(last, "subscription_amps", 0) or 0))
-        except Exception:
-            subscription_amps = getattr(last, "subscription_amps", 0) or 0
+    # القيم الأساسية (مع fallbacks)
+    customer_name = (str(f_customer or "") or getattr(last, "customer_name", "") or "").strip() or (getattr(last, "customer_name", "") or "")
+    meter_number  = (str(f_meter  or "") or getattr(last, "meter_number",  "") or "").strip() or (getattr(last, "meter_number",  "") or "")
 
-        try:
-            unit_price = float(getv("unit_price") or (getattr(last, "unit_price", 0.0) or 0.0))
-        except Exception:
-            unit_price = getattr(last, "unit_price", 0.0) or 0.0
+    try:
+        subscription_amps = int(f_amps or (getattr(last, "subscription_amps", 0) or 0))
+    except Exception:
+        subscription_amps = getattr(last, "subscription_amps", 0) or 0
 
-        try:
-            subscription_fee = float(getv("subscription_fee") or (getattr(last, "subscription_fee", 0.0) or 0.0))
-        except Exception:
-            subscription_fee = getattr(last, "subscription_fee", 0.0) or 0.0
+    try:
+        unit_price = float(f_unit or (getattr(last, "unit_price", 0.0) or 0.0))
+    except Exception:
+        unit_price = getattr(last, "unit_price", 0.0) or 0.0
 
-        # القيم الجديدة (مؤثرة على إنشاء الفاتورة)
-        # prev_reading إن لم يرد بالملف سنأخذ من آخر فاتورة
-        prev_from_file = getv("prev_reading")
-        try:
-            prev = int(float(prev_from_file)) if prev_from_file not in (None, "") else int(getattr(last, "curr_reading", 0) or 0)
-        except Exception:
-            prev = int(getattr(last, "curr_reading", 0) or 0)
+    try:
+        subscription_fee = float(f_fee or (getattr(last, "subscription_fee", 0.0) or 0.0))
+    except Exception:
+        subscription_fee = getattr(last, "subscription_fee", 0.0) or 0.0
 
-        # current reading
-        try:
-            curr = int(float(getv("curr_reading") or prev))
-        except Exception:
-            curr = prev
+    # prev_reading إن لم يرد بالملف سنأخذ من آخر فاتورة
+    prev_from_file = f_prev
+    try:
+        prev = int(float(prev_from_file)) if prev_from_file not in (None, "") else int(getattr(last, "curr_reading", 0) or 0)
+    except Exception:
+        prev = int(getattr(last, "curr_reading", 0) or 0)
 
-        # تاريخ الفاتورة، إن لم يُرسل بالملف نستخدم اليوم
-        inv_date_from_file = _parse_date(getv("invoice_date"))
-        inv_date = inv_date_from_file or today
+    try:
+        curr = int(float(f_curr or prev))
+    except Exception:
+        curr = prev
+
+    # تسعير افتراضي (نفس apply_pricing_defaults)
+    if unit_price in (None, 0):
+        unit_price = float(pricing.unit_price or 0.0)
+    if subscription_fee in (None, 0):
+        subscription_fee = float(pricing.fee_for_amp(int(subscription_amps or 0)) or 0.0)
+
+    return compute_invoice_totals({
+        "invoice_number": (str(f_number or "").strip() or None),
+        "date": _parse_import_date(f_date) or today,
+        "customer_name": customer_name,
+        "meter_number": meter_number,
+        "branch_number": branch,
+        "subscription_amps": subscription_amps,
+        "prev_reading": prev,
+        "curr_reading": curr,
+        "unit_price": unit_price,
+        "subscription_fee": subscription_fee,
+        "is_paid": _import_bool(f_paid),
+    })
 
-        # رقم الفاتورة: نستخدم المرسل إن وُجد، وإلا نتولّد بحسب التاريخ
-        inv_number_from_file = (str(getv("invoice_number") or "").strip() or None)
-        invoice_number = inv_number_from_file or next_invoice_number_for_date(inv_date)
+IMPORT_UPSERT_COLUMNS = ("date", "customer_name", "meter_number", "subscription_amps", "prev_reading",
+                         "curr_reading", "unit_price", "subscription_fee", "is_paid", "kwh_used",
+                         "energy_cost", "month_cost", "total_due", "search_text",
+                         "sync_version")   # NULL -> restamped at commit
 
-        # حالة الدفع من الملف (0/1, true/false, نعم/لا)
-        _is_paid_raw = getv("is_paid")
-        def _to_bool(v):
-            if v is None: return False
-            s = str(v).strip().lower()
-            return s in ("1","true","yes","y","نعم","مدفوع")
-        is_paid_val = _to_bool(_is_paid_raw)
+def import_invoice_rows(rows, batch_size: int = None, upsert: bool = False) -> dict:
+    """
+    Bulk-create invoices from import rows (tuples in IMPORT_COLUMNS order).
+    Per batch of `batch_size` rows: one prefetch of the latest invoice for the
+    batch's new branches, one lookup of the (branch, month) pairs already
+    billed, one counter bump per month for invoice numbers, and one
+    executemany INSERT ... ON CONFLICT (branch_number, billing_month).
+    A month the branch already has is skipped, or with upsert=True overwritten
+    in place (the existing invoice keeps its number and its starting reading).
+    Pricing is resolved once.
+    Runs in the caller's transaction; the caller commits.
+    """
+    batch_size = max(1, int(batch_size or IMPORT_BATCH_SIZE))
+    t0 = time.perf_counter()
+    pricing = get_pricing()
+    today = datetime.utcnow().date()
+    tbl = Invoice.__table__
+    ins = dialect_insert(tbl)
+    if upsert:
+        ins = ins.on_conflict_do_update(**billing_month_conflict(tbl),
+                                        set_={c: ins.excluded[c] for c in IMPORT_UPSERT_COLUMNS})
+    else:
+        ins = ins.on_conflict_do_nothing(**billing_month_conflict(tbl))
+    ins = ins.returning(tbl.c.invoice_number, sort_by_parameter_order=upsert)
 
+    latest = {}          # branch -> latest known invoice (DB row or a row from this file)
+    seen = {}            # (branch, month) -> (invoice_number, row it chained from) for this file's rows
+    stats = {"created": 0, "updated": 0, "skipped": 0, "duplicates": 0, "batches": 0}
 
-        inv = Invoice(
-            invoice_number=invoice_number,
-            date=inv_date,
-            customer_name=customer_name,
-            meter_number=meter_number,
-            branch_number=branch,
-            subscription_amps=subscription_amps,
-            prev_reading=prev,
-            curr_reading=curr,
-            unit_price=unit_price,
-            subscription_fee=subscription_fee,
-            is_paid=is_paid_val,
-        )
+    def flush(batch):
+        if not batch:
+            return
+        new_branches = [str(row[0] or "").strip() for row in batch]
+        missing = [b for b in set(new_branches) if b and b not in latest]
+        latest.update(branch_states(missing))
+
+        # months these branches already have anywhere in the DB (not just the last billed one):
+        # skipped up front, or with upsert overwritten in place, so no row chains off a month
+        # that ON CONFLICT would drop and no counter number is burnt on an existing invoice
+        keys = [(b, month_key(_parse_import_date(row[8]) or today)) for row, b in zip(batch, new_branches) if b]
+        existing = {}
+        if keys:
+            existing = {(r.branch_number, r.billing_month): r for r in db.session.query(
+                            Invoice.branch_number, Invoice.billing_month, Invoice.invoice_number, Invoice.date,
+                            Invoice.prev_reading, Invoice.customer_name, Invoice.meter_number,
+                            Invoice.subscription_amps, Invoice.unit_price, Invoice.subscription_fee)
+                        .filter(Invoice.branch_number.in_({b for b, _ in keys}),
+                                Invoice.billing_month.in_({m for _, m in keys}))}
+        before = {b: latest.get(b) for b, _ in keys}
+
+        values = []
+        pending = {}     # (branch, month) -> values dict already in this batch
+        replaced = set() # id() of values that target an existing invoice
+        for row, branch in zip(batch, new_branches):
+            if not branch:
+                stats["skipped"] += 1
+                continue
+            key = (branch, month_key(_parse_import_date(row[8]) or today))
+            last = latest.get(branch)
+            number = None
+            if key in seen or key in existing:
+                if not upsert:
+                    stats["duplicates"] += 1
+                    continue
+                if key in seen:
+                    number, last = seen[key]
+                else:
+                    # overwrite in place: keep its number, chain from the reading it started at
+                    old = existing[key]
+                    number = old.invoice_number
+                    last = _ImportedRow({"customer_name": old.customer_name, "meter_number": old.meter_number,
+                                         "subscription_amps": old.subscription_amps, "unit_price": old.unit_price,
+                                         "subscription_fee": old.subscription_fee, "date": old.date,
+                                         "curr_reading": old.prev_reading})
+            v = _import_row_values(row, last, pricing, today)
+            v["billing_month"] = key[1]
+            v["invoice_number"] = v["invoice_number"] or number
+            if key in pending:
+                pending[key].update(v)            # same month twice in one batch: last row wins
+            else:
+                pending[key] = v
+                values.append(v)
+                if number:
+                    replaced.add(id(v))
+            seen[key] = (v["invoice_number"], last) if upsert else (None, None)
+            # later rows of the same branch chain from this one
+            if latest.get(branch) is None or v["date"] >= latest[branch].date:
+                latest[branch] = _ImportedRow(v)
+
+        # invoice numbers: one block reservation per month, counters bumped past supplied ones
+        need = {}
+        supplied = {}
+        for v in values:
+            num = v["invoice_number"]
+            if num:
+                m = re.match(r"^(\d{6})-(\d+)$", num)
+                if m and int(m.group(2)) > supplied.get(m.group(1), (0, ""))[0]:
+                    supplied[m.group(1)] = (int(m.group(2)), num)
+            else:
+                need.setdefault(v["date"].strftime("%Y%m"), []).append(v)
+        for _, num in supplied.values():
+            sync_invoice_counter(num)
+        for rows in need.values():
+            for v, num in zip(rows, reserve_invoice_numbers(rows[0]["date"], len(rows))):
+                v["invoice_number"] = num
+
+        if values:
+            for v in values:
+                v["search_text"] = invoice_search_text(v)
+            returned = db.session.execute(ins, values).scalars().all()
+            if upsert:
+                # an existing row answers with its own number; a new one with ours
+                updated = sum(1 for v, num in zip(values, returned)
+                              if id(v) in replaced or num != v["invoice_number"])
+                stats["updated"] += updated
+                stats["created"] += len(returned) - updated
+            else:
+                stats["created"] += len(returned)
+                stats["duplicates"] += len(values) - len(returned)
+                if len(returned) < len(values):
+                    # rows ON CONFLICT skipped (a concurrent insert) must not stay as a branch's latest
+                    inserted = set(returned)
+                    for b in {v["branch_number"] for v in values if v["invoice_number"] not in inserted}:
+                        kept = [v for v in values if v["branch_number"] == b and v["invoice_number"] in inserted]
+                        best = max(kept, key=lambda v: v["date"], default=None)
+                        prior = before.get(b)
+                        if best is not None and (prior is None or best["date"] >= prior.date):
+                            latest[b] = _ImportedRow(best)
+                        elif prior is not None:
+                            latest[b] = prior
+                        else:
+                            latest.pop(b, None)   # refetched from the DB by the next batch
+        stats["batches"] += 1
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush(batch); batch = []
+    flush(batch)
+
+    stats["seconds"] = time.perf_counter() - t0
+    done = stats["created"] + stats["updated"]
+    stats["rows_per_sec"] = done / stats["seconds"] if stats["seconds"] > 0 else 0.0
+    print(f"[import] {stats['created']} created, {stats['updated']} updated, {stats['duplicates']} duplicate month(s) "
+          f"in {stats['seconds']:.2f}s ({stats['rows_per_sec']:.0f} rows/s, {stats['batches']} batches of ≤{batch_size})")
+    return stats
+
+class _ImportedRow:
+    """Attribute view over an imported values dict, so it can stand in for `last`."""
+    __slots__ = ("_v",)
+    def __init__(self, v): self._v = v
+    def __getattr__(self, name):
+        try: return self._v[name]
+        except KeyError: raise AttributeError(name)
+
+# ---------------- Streaming import readers ----------------
+# Canonical column order of the compact row tuples fed to import_invoice_rows().
+IMPORT_COLUMNS = (
+    "branch_number","customer_name","meter_number","subscription_amps",
+    "unit_price","subscription_fee","curr_reading",
+    "prev_reading","invoice_date","invoice_number","is_paid"
+)
+
+def _import_norm(s): return (str(s or "")).strip().lower().replace(" ", "").replace("_","")
+
+# أضفنا مرادفات للأعمدة الجديدة
+IMPORT_ALIASES = {
+    "branch_number"    : ["branch_number","branch","الشعبة","رقمالشعبة","شعبة"],
+    "customer_name"    : ["customer_name","customer","الاسم","اسم","المشترك"],
+    "meter_number"     : ["meter_number","meter","العداد","رقمالعداد"],
+    "subscription_amps": ["subscription_amps","amps","الأمبير","الامبير"],
+    "unit_price"       : ["unit_price","سعرالوحدة","سعر_الوحدة","سعرالكيلوواط","سعركيلوواط"],
+    "subscription_fee" : ["subscription_fee","اشتراكمشهري","رسماشتراك","اشتراك"],
+    "curr_reading"     : ["curr_reading","current_reading","القراءةالحالية","قراءةحالية","قراءة"],
+    # الجدد:
+    "prev_reading"     : ["prev_reading","previous_reading","السابق","القراءةالسابقة","قراءةسابقة"],
+    "invoice_date"     : ["invoice_date","date","تاريخ","تاريخ_الفاتورة","تاريخالفاتورة"],
+    "invoice_number"   : ["invoice_number","invoice_no","no","رقمالفاتورة","رقم_الفاتورة"],
+    "is_paid"          : ["is_paid","paid","status","مدفوع","حالةالدفع","حالة_الدفع"],
+}
 
-        # تسعير افتراضي/قواعد إضافية
-        apply_pricing_defaults(inv, get_pricing())
+def _import_header_map(header_row) -> dict:
+    idx={}; norm=[_import_norm(h) for h in header_row]
+    for canon,names in IMPORT_ALIASES.items():
+        for n in names:
+            if _import_norm(n) in norm:
+                idx[canon]=norm.index(_import_norm(n)); break
+    return idx
 
-        # حسابات
-        inv.kwh_used    = max(0, curr - prev)
-        inv.energy_cost = round(inv.kwh_used * float(inv.unit_price or 0), 2)
-        inv.month_cost  = float(inv.subscription_fee or 0)
-        inv.total_due   = round(inv.energy_cost + inv.month_cost, 2)
-
-        db.session.add(inv); created += 1
-
-    def _norm(s): return (str(s or "")).strip().lower().replace(" ", "").replace("_","")
-
-    # أضفنا مرادفات للأعمدة الجديدة
-    aliases = {
-        "branch_number"    : ["branch_number","branch","الشعبة","رقمالشعبة","شعبة"],
-        "customer_name"    : ["customer_name","customer","الاسم","اسم","المشترك"],
-        "meter_number"     : ["meter_number","meter","العداد","رقمالعداد"],
-        "subscription_amps": ["subscription_amps","amps","الأمبير","الامبير"],
-        "unit_price"       : ["unit_price","سعرالوحدة","سعر_الوحدة","سعرالكيلوواط","سعركيلوواط"],
-        "subscription_fee" : ["subscription_fee","اشتراكمشهري","رسماشتراك","اشتراك"],
-        "curr_reading"     : ["curr_reading","current_reading","القراءةالحالية","قراءةحالية","قراءة"],
-        # الجدد:
-        "prev_reading"     : ["prev_reading","previous_reading","السابق","القراءةالسابقة","قراءةسابقة"],
-        "invoice_date"     : ["invoice_date","date","تاريخ","تاريخ_الفاتورة","تاريخالفاتورة"],
-        "invoice_number"   : ["invoice_number","invoice_no","no","رقمالفاتورة","رقم_الفاتورة"],
-    
-        "is_paid"          : ["is_paid","paid","status","مدفوع","حالةالدفع","حالة_الدفع"]
-    }
+def _compact_rows(rows):
+    """
+    Resolve the header once, then yield tuples in IMPORT_COLUMNS order.
+    Without a recognised header the first row is data in the default order.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    hmap = _import_header_map(header)
+    if not hmap:
+        hmap = {k:i for i,k in enumerate(IMPORT_COLUMNS)}
+        rows = itertools.chain([header], rows)
+    cols = [hmap.get(k) for k in IMPORT_COLUMNS]
+    for r in rows:
+        if not r:
+            continue
+        n = len(r)
+        yield tuple(r[i] if (i is not None and i < n) else None for i in cols)
 
-    def build_map(header_row):
-        idx={}; norm=[_norm(h) for h in header_row]
-        for canon,names in aliases.items():
-            for n in names:
-                if _norm(n) in norm:
-                    idx[canon]=norm.index(_norm(n)); break
-        return idx
+def _sniff_text_encoding(stream, probe: int = 64 * 1024) -> str:
+    """utf-8 (with or without BOM) if the first chunk decodes, else Arabic Windows cp1256."""
+    head = stream.read(probe)
+    stream.seek(0)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1256"
 
+def iter_import_rows(file_storage):
+    """
+    Stream an uploaded .xlsx/.csv as compact row tuples with flat memory:
+    openpyxl read-only mode for Excel, incremental decoding for CSV.
+    Raises ValueError for unsupported formats.
+    """
+    name = (file_storage.filename or "").lower()
+    stream = file_storage.stream
     if name.endswith((".xlsx",".xls")):
+        from openpyxl import load_workbook
+        wb = load_workbook(stream, read_only=True, data_only=True)
         try:
-            from openpyxl import load_workbook
-        except Exception:
-            flash("يلزم تثبيت openpyxl لاستيراد Excel: pip install openpyxl", "error")
-            return redirect(url_for("import_branches_xlsx"))
+            yield from _compact_rows(wb.active.iter_rows(min_row=1, values_only=True))
+        finally:
+            wb.close()
+    elif name.endswith(".csv"):
+        encoding = _sniff_text_encoding(stream)
+        text_stream = io.TextIOWrapper(stream, encoding=encoding, errors="replace", newline="")
+        try:
+            yield from _compact_rows(csv.reader(text_stream))
+        finally:
+            text_stream.detach()
+    else:
+        raise ValueError("unsupported import format")
 
-        wb = load_workbook(f, data_only=True)
-        ws = wb.active
-        rows = ws.iter_rows(min_row=1, values_only=True)
-        header = next(rows, None) or []
-        hmap = build_map(header) if header else {}
-
-        # إن ما عرفنا الرأس، نستعمل ترتيب افتراضي يشمل الأعمدة الجديدة أيضًا (اختيارية آخر 3)
-        if not hmap:
-            headers = [
-                "branch_number","customer_name","meter_number","subscription_amps",
-                "unit_price","subscription_fee","curr_reading",
-                "prev_reading","invoice_date","invoice_number","is_paid"
-            ]
-            hmap = {k:i for i,k in enumerate(headers)}
-            rows = ws.iter_rows(min_row=1, values_only=True)
-
-        for r in rows:
-            def getv(k):
-                idx=hmap.get(k)
-                return r[idx] if (idx is not None and isinstance(r,(list,tuple)) and idx < len(r)) else None
-            create_from_row(getv)
-
-        wb.close()
-        db.session.commit()
+@routes.route("/admin/branches/import-xlsx", methods=["GET","POST"], endpoint="import_branches_xlsx")
+@login_required
+@role_required("admin")
+def import_branches_xlsx():
+    if request.method == "GET":
+        return render_template("import_branches.html", excel=True)
 
-    elif name.endswith(".csv"):
-        raw = f.read()
+    f = request.files.get("file")
+    if not f or not f.filename:
+        flash("اختر ملف Excel أو CSV.", "error")
+        return redirect(url_for("import_branches_xlsx"))
+    name = f.filename.lower()
+    if not name.endswith((".xlsx",".xls",".csv")):
+        flash("صيغة الملف غير مدعومة.", "error")
+        return redirect(url_for("import_branches_xlsx"))
+    if name.endswith((".xlsx",".xls")):
         try:
-            text_data = raw.decode("utf-8-sig")
+            import openpyxl  # noqa: F401
         except Exception:
-            try:
-                text_data = raw.decode("utf-8")
-            except Exception:
-                text_data = raw.decode("cp1256", errors="ignore")
-        rdr = csv.DictReader(io.StringIO(text_data))
-
-        if rdr.fieldnames:
-            hmap = build_map(rdr.fieldnames)
-            if hmap:
-                for row in rdr:
-                    def getv(k):
-                        # ابحث بأي مرادف
-                        for alias in aliases.get(k, []):
-                            for key in row.keys():
-                                if _norm(key) == _norm(alias):
-                                    return row.get(key)
-                        return None
-                    create_from_row(getv)
-            else:
-                # بدون رؤوس معروفة: ترتيب افتراضي
-                f2 = csv.reader(io.StringIO(text_data))
-                for row in f2:
-                    order = [
-                        "branch_number","customer_name","meter_number","subscription_amps",
-                        "unit_price","subscription_fee","curr_reading",
-                        "prev_reading","invoice_date","invoice_number"
-                    ]
-                    def getv(k):
-                        idx=order.index(k) if k in order else None
-                        return row[idx] if idx is not None and idx < len(row) else None
-                    create_from_row(getv)
-        else:
-            # ملف CSV بلا رؤوس
-            f2 = csv.reader(io.StringIO(text_data))
-            for row in f2:
-                order = [
-                    "branch_number","customer_name","meter_number","subscription_amps",
-                    "unit_price","subscription_fee","curr_reading",
-                    "prev_reading","invoice_date","invoice_number"
-                ]
-                def getv(k):
-                    idx=order.index(k) if k in order else None
-                    return row[idx] if idx is not None and idx < len(row) else None
-                create_from_row(getv)
+            flash("يلزم تثبيت openpyxl لاستيراد Excel: pip install openpyxl", "error")
+            return redirect(url_for("import_branches_xlsx"))
 
+    try:
+        stats = import_invoice_rows(iter_import_rows(f), upsert=request.form.get("upsert") in ("on", "1", "true"))
         db.session.commit()
-
-    else:
-        flash("صيغة الملف غير مدعومة.", "error")
+    except Exception as e:
+        db.session.rollback()
+        print("[import] failed:", e)
+        flash("حدث خطأ أثناء الاستيراد، لم يتم حفظ أي صف.", "error")
         return redirect(url_for("import_branches_xlsx"))
 
-    flash(f"تم استيراد {created} صفًا.", "success")
+    flash(f"تم استيراد {stats['created']} صفًا وتحديث {stats['updated']} خلال {stats['seconds']:.1f} ث ({stats['rows_per_sec']:.0f} صف/ث).", "success")
+    if stats["duplicates"]:
+        flash(f"تم تخطي {stats['duplicates']} صفًا لشعب لديها فاتورة لنفس الشهر.", "info")
     return redirect(url_for("index", **_current_filter_args()))
 
 
 # Report
-@app.get("/report", endpoint="report")
+REPORT_BRANCH_LIMIT = int(os.getenv("REPORT_BRANCH_LIMIT", "50"))
+
+@routes.get("/report", endpoint="report")
 @login_required
 @role_required("admin")
 def report():
@@ -1477,27 +3567,68 @@ def report():
         if q_end:
             try: end_date = datetime.strptime(q_end, "%Y-%m-%d").date()
             except Exception: end_date=None
-    qry = Invoice.query
-    if start_date: qry = qry.filter(Invoice.date >= start_date)
-    if end_date:   qry = qry.filter(Invoice.date <= end_date)
-    rows = qry.order_by(Invoice.date.asc(), Invoice.id.asc()).all()
-    total_invoices = len(rows)
-    total_kwh = sum(int(getattr(r,"kwh_used",(r.curr_reading or 0)-(r.prev_reading or 0)) or 0) for r in rows)
-    total_amount = round(sum(float(r.total_due or 0) for r in rows), 2)
-    paid_count = sum(1 for r in rows if r.is_paid)
-    unpaid_count = total_invoices - paid_count
-    return render_template("report.html", rows=rows, total_invoices=total_invoices, total_kwh=total_kwh,
-                           total_amount=total_amount, paid_count=paid_count, unpaid_count=unpaid_count,
+    crit = invoice_list_criteria(start_date, end_date)
+
+    # Headline numbers: one cached aggregate (same as the list totals)
+    totals = invoice_list_totals(start_date, end_date)
+
+    # Breakdowns (GROUP BY in SQL; branches capped to the biggest consumers)
+    paid = Invoice.is_paid.is_(True)
+    unpaid_due = func.coalesce(func.sum(case((paid, 0.0), else_=Invoice.total_due)), 0.0)
+    by_amps = (db.session.query(
+                    Invoice.subscription_amps,
+                    func.count(Invoice.id),
+                    func.coalesce(func.sum(Invoice.kwh_used), 0),
+                    func.coalesce(func.sum(Invoice.total_due), 0.0),
+                    unpaid_due)
+               .filter(*crit)
+               .group_by(Invoice.subscription_amps)
+               .order_by(Invoice.subscription_amps.asc())
+               .all())
+    branch_kwh = func.coalesce(func.sum(Invoice.kwh_used), 0)
+    by_branch = (db.session.query(
+                    Invoice.branch_number,
+                    func.max(Invoice.customer_name),
+                    func.count(Invoice.id),
+                    branch_kwh,
+                    func.coalesce(func.sum(Invoice.total_due), 0.0),
+                    unpaid_due)
+                 .filter(*crit)
+                 .group_by(Invoice.branch_number)
+                 .order_by(branch_kwh.desc(), Invoice.branch_number.asc())
+                 .limit(REPORT_BRANCH_LIMIT)
+                 .all())
+    branch_count = db.session.query(func.count(func.distinct(Invoice.branch_number))).filter(*crit).scalar() or 0
+
+    # Rows: keyset pages, oldest first
+    try:
+        per_page = min(max(int(request.args.get("per_page", 100)), 20), 500)
+    except Exception:
+        per_page = 100
+    after = decode_list_cursor(request.args.get("after") or "")
+    before = decode_list_cursor(request.args.get("before") or "")
+    rows, next_cursor, prev_cursor = keyset_invoice_page(
+        Invoice.query.filter(*crit), per_page, after=after, before=before, descending=False)
+    nav_args = {k: v for k, v in request.args.items() if k not in ("after", "before")}
+
+    return render_template("report.html", rows=rows, total_invoices=totals["count"], total_kwh=totals["kwh"],
+                           total_amount=round(totals["total_due"], 2), paid_count=totals["paid_count"],
+                           unpaid_count=totals["unpaid_count"], totals=totals,
+                           by_amps=by_amps, by_branch=by_branch, branch_count=int(branch_count),
+                           next_url=url_for("report", **nav_args, after=next_cursor) if next_cursor else None,
+                           prev_url=url_for("report", **nav_args, before=prev_cursor) if prev_cursor else None,
+                           first_url=url_for("report", **nav_args) if (after or before) else None,
                            start=(start_date.isoformat() if start_date else (q_start or "")),
                            end=(end_date.isoformat() if end_date else (q_end or "")))
 
 # API: latest pricing ----
-@app.get("/api/pricing/latest", endpoint="api_pricing_latest")
+@routes.get("/api/pricing/latest", endpoint="api_pricing_latest")
 @login_required
 def api_pricing_latest():
-    p = Pricing.query.order_by(Pricing.updated_at.desc()).first()
-    if not p:
-        return jsonify({"unit_price": 0.0, "fees": {"5":0.0,"10":0.0,"15":0.0,"20":0.0}})
+    p = get_pricing()
+    fresh = revalidate("pricing", p.id, p.updated_at, last_modified=p.updated_at)
+    if fresh is not None:
+        return fresh
     return jsonify({
         "unit_price": float(p.unit_price or 0.0),
         "fees": {
@@ -1527,9 +3658,155 @@ class Expense(db.Model):
             "description": self.description or ""
         }
 
+# ---------------- Monthly rollup ----------------
+# One row per "YYYY-MM" with the invoice and expense totals the dashboards
+# chart. Writes record the months they touch; before_commit recomputes just
+# those months (a date-range scan each) inside the same transaction.
+class InvoiceMonthlySummary(db.Model):
+    __tablename__ = "invoice_monthly_summary"
+    month_key = db.Column(db.String(7), primary_key=True)   # "YYYY-MM"
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)
+    kwh = db.Column(db.BigInteger, nullable=False, default=0)
+    total_due = db.Column(db.Float, nullable=False, default=0.0)
+    paid_due = db.Column(db.Float, nullable=False, default=0.0)
+    expense_total = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+_ROLLUP_MODELS = {"invoices": Invoice, "expenses": Expense}
+_rollup_ready = {"ok": False}   # table present (schema may lag when AUTO_MIGRATE=0)
+
+def _month_key(v):
+    if v is None:
+        return None
+    if isinstance(v, str):
+        return v[:7] if re.match(r"^\d{4}-\d{2}", v) else None
+    return v.strftime("%Y-%m")
+
+def mark_rollup_months(months, session=None) -> None:
+    """Queue months for recompute at commit (for writes the session events can't see)."""
+    (session or db.session).info.setdefault("rollup_months", set()).update(m for m in months if m)
+
+def mark_rollup_all(session=None) -> None:
+    """Queue a full rollup rebuild at commit (e.g. a bulk UPDATE that moves dates)."""
+    (session or db.session).info["rollup_all"] = True
+
+def refresh_monthly_summary(conn, months) -> None:
+    """Recompute the rollup rows for `months` ("YYYY-MM") from the base tables."""
+    tbl = InvoiceMonthlySummary.__table__
+    paid = Invoice.is_paid.is_(True)
+    now = datetime.utcnow()
+    for mk in sorted(set(months)):
+        first, next_first = month_bounds(date(int(mk[:4]), int(mk[5:7]), 1))
+        inv = conn.execute(
+            select(func.count(Invoice.id),
+                   func.coalesce(func.sum(Invoice.kwh_used), 0),
+                   func.coalesce(func.sum(Invoice.total_due), 0.0),
+                   func.coalesce(func.sum(case((paid, Invoice.total_due), else_=0.0)), 0.0))
+            .where(Invoice.date >= first, Invoice.date < next_first)
+        ).one()
+        exp_count, exp_total = conn.execute(
+            select(func.count(Expense.id), func.coalesce(func.sum(Expense.cost), 0.0))
+            .where(Expense.date >= first, Expense.date < next_first)
+        ).one()
+        if not inv[0] and not exp_count:
+            conn.execute(tbl.delete().where(tbl.c.month_key == mk))
+            continue
+        values = dict(invoice_count=int(inv[0]), kwh=int(inv[1] or 0), total_due=float(inv[2] or 0),
+                      paid_due=float(inv[3] or 0), expense_total=float(exp_total or 0), updated_at=now)
+        ins = dialect_insert(tbl).values(month_key=mk, **values)
+        conn.execute(ins.on_conflict_do_update(index_elements=[tbl.c.month_key], set_=values))
+
+def rebuild_monthly_summary(conn) -> int:
+    """Backfill: recompute every month that has invoices or expenses. Returns months written."""
+    months = set()
+    for model in (Invoice, Expense):
+        lo, hi = conn.execute(select(func.min(model.date), func.max(model.date))).one()
+        if lo is None:
+            continue
+        lo, hi = _as_date(lo), _as_date(hi)
+        y, m = lo.year, lo.month
+        while (y, m) <= (hi.year, hi.month):
+            months.add(f"{y:04d}-{m:02d}")
+            y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    conn.execute(InvoiceMonthlySummary.__table__.delete())
+    refresh_monthly_summary(conn, months)
+    return conn.execute(select(func.count()).select_from(InvoiceMonthlySummary.__table__)).scalar() or 0
+
+def _as_date(v):
+    if isinstance(v, str):
+        return date.fromisoformat(v[:10])
+    return v.date() if isinstance(v, datetime) else v
+
+# ORM writes: current and previous date of every new / edited / deleted row
+@event.listens_for(Session, "before_flush")
+def _track_rollup_flush(session, flush_context, instances):
+    months = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, (Invoice, Expense)):
+            continue
+        hist = inspect(obj).attrs.date.history   # passive: empty when date isn't loaded
+        seen = [v for v in itertools.chain(hist.added or (), hist.unchanged or (), hist.deleted or ()) if v]
+        for v in seen or [obj.date or datetime.utcnow()]:   # None => column default (today)
+            months.add(_month_key(v))
+    months.discard(None)
+    if months:
+        mark_rollup_months(months, session)
+
+# Bulk writes: executemany INSERTs carry their dates; UPDATE/DELETE ... WHERE
+# first reads the distinct dates they are about to touch.
+@event.listens_for(Session, "do_orm_execute")
+def _track_rollup_bulk(state):
+    if not (state.is_insert or state.is_update or state.is_delete):
+        return
+    model = _ROLLUP_MODELS.get(getattr(getattr(state.statement, "table", None), "name", None))
+    if model is None:
+        return
+    params = state.parameters
+    rows = params if isinstance(params, (list, tuple)) else ([params] if params else [])
+    if state.is_insert:
+        months = {_month_key(p.get("date")) for p in rows}
+        if not rows or None in months:
+            mark_rollup_all(state.session)
+        else:
+            mark_rollup_months(months, state.session)
+        return
+    sel = select(model.date).distinct()
+    if state.statement.whereclause is not None:
+        sel = sel.where(state.statement.whereclause)
+    elif rows and all("id" in p for p in rows):           # ORM bulk UPDATE by primary key
+        sel = sel.where(model.id.in_([p["id"] for p in rows]))
+    if any("date" in p for p in rows):
+        mark_rollup_all(state.session)
+    mark_rollup_months({_month_key(d) for (d,) in state.session.connection().execute(sel)}, state.session)
+
+@event.listens_for(Session, "before_commit")
+def _refresh_rollup_on_commit(session):
+    if not (session.info.get("rollup_months") or session.info.get("rollup_all") or session.new
+            or session.dirty or session.deleted):
+        return
+    session.flush()   # let before_flush record the pending rows first
+    months = session.info.pop("rollup_months", None)
+    full = session.info.pop("rollup_all", False)
+    if not (months or full):
+        return
+    conn = session.connection()
+    if not _rollup_ready["ok"]:
+        if not inspect(conn).has_table(InvoiceMonthlySummary.__tablename__):
+            return   # not migrated yet; `python migrate_db.py rebuild-summary` backfills later
+        _rollup_ready["ok"] = True
+    if full:
+        rebuild_monthly_summary(conn)
+    else:
+        refresh_monthly_summary(conn, months)
+
+@event.listens_for(Session, "after_rollback")
+def _rollup_rolled_back(session):
+    session.info.pop("rollup_months", None)
+    session.info.pop("rollup_all", None)
+
 
 
-@app.route("/expenses", methods=["GET", "POST"], endpoint="expenses")
+@routes.route("/expenses", methods=["GET", "POST"], endpoint="expenses")
 @login_required
 def expenses():
     if request.method == "POST":
@@ -1556,7 +3833,7 @@ def expenses():
     return render_template("expenses.html", expenses=q, total=total)
 
 
-@app.route("/expenses/delete/<int:expense_id>", methods=["POST"])
+@routes.route("/expenses/delete/<int:expense_id>", methods=["POST"])
 @login_required
 def delete_expense(expense_id):
     e = Expense.query.get_or_404(expense_id)
@@ -1565,7 +3842,7 @@ def delete_expense(expense_id):
     return redirect(url_for("expenses"))
 
 
-@app.route("/api/expenses/summary")
+@routes.route("/api/expenses/summary")
 @login_required
 def api_expenses_summary():
     # Optional date filters
@@ -1584,96 +3861,233 @@ def api_expenses_summary():
             qry = qry.filter(Expense.date <= ed)
         except Exception:
             pass
-    data = [e.to_dict() for e in qry.all()]
-    # Aggregate by type and by date
+    # Aggregates in SQL (ix_expenses_date_type covers the range + type)
     by_type = {"fuel": 0.0, "maintenance": 0.0, "other": 0.0}
-    by_day = {}
     fuel_litres = 0.0
-    for d in data:
-        by_type[d["type"]] = by_type.get(d["type"], 0.0) + float(d["cost"] or 0)
-        day = d["date"][:10]
-        by_day[day] = by_day.get(day, 0.0) + float(d["cost"] or 0)
-        if d["type"] == "fuel" and d.get("litres") is not None:
-            fuel_litres += float(d["litres"] or 0)
-    return jsonify({
-        "items": data,
+    for t, cost, litres in (qry.with_entities(Expense.type,
+                                              func.coalesce(func.sum(Expense.cost), 0.0),
+                                              func.coalesce(func.sum(Expense.litres), 0.0))
+                               .group_by(Expense.type)):
+        by_type[t] = by_type.get(t, 0.0) + float(cost or 0)
+        if t == "fuel":
+            fuel_litres = float(litres or 0)
+    by_day = (qry.with_entities(Expense.date, func.coalesce(func.sum(Expense.cost), 0.0))
+                 .group_by(Expense.date)
+                 .order_by(Expense.date.asc())
+                 .all())
+    payload = {
         "by_type": by_type,
-        "by_day": [{"date": k, "total": v} for k, v in sorted(by_day.items())],
-        "fuel_litres": fuel_litres
-    })
-
-
-
-# ---- DB bootstrap & lightweight migration ----
-with app.app_context():
-    try:
-        db.create_all()
-    except Exception:
-        pass
-
-    insp = inspect(db.engine)
+        "by_day": [{"date": d.isoformat(), "total": float(v or 0)} for d, v in by_day],
+        "fuel_litres": fuel_litres,
+    }
 
-    def table_exists(table_name: str) -> bool:
+    # Item list only on request (?items=1), one page at a time
+    if request.args.get("items") in ("1", "true", "yes"):
         try:
-            return table_name in insp.get_table_names()
+            page = max(int(request.args.get("page", 1)), 1)
         except Exception:
-            return False
-
-    def has_column(table_name: str, col_name: str) -> bool:
+            page = 1
         try:
-            cols = insp.get_columns(table_name)
-            return any(c.get("name") == col_name for c in cols)
+            per_page = min(max(int(request.args.get("per_page", 100)), 1), 500)
         except Exception:
-            return False
-
-    # --- users.is_admin (one-time) ---
-    try:
-        if table_exists("users") and not has_column("users", "is_admin"):
-            db.session.execute(text(
-                "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin BOOLEAN NOT NULL DEFAULT FALSE"
-            ))
-            db.session.commit()
-            print("[migrate] Added users.is_admin")
-    except Exception as e:
-        print("[migrate] users.is_admin check:", e)
+            per_page = 100
+        items = (qry.order_by(Expense.date.desc(), Expense.id.desc())
+                    .limit(per_page + 1).offset((page - 1) * per_page).all())
+        payload.update(items=[e.to_dict() for e in items[:per_page]], page=page,
+                       per_page=per_page, has_more=len(items) > per_page)
+    return jsonify(payload)
 
-    # --- pricing.fee_15 (one-time) ---
-    try:
-        if table_exists("pricing") and not has_column("pricing", "fee_15"):
-            db.session.execute(text(
-                "ALTER TABLE pricing ADD COLUMN IF NOT EXISTS fee_15 REAL NOT NULL DEFAULT 0"
-            ))
-            db.session.commit()
-            print("[migrate] Added pricing.fee_15")
 
-    # --- performance indexes for fast filtering/search ---
-        try:
-            if db.engine.name == "postgresql":
-                db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_date ON invoices(date)"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_date_id_desc ON invoices(date DESC, id DESC)"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_customer_lower ON invoices(LOWER(customer_name))"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_branch_lower ON invoices(LOWER(branch_number))"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_meter_lower ON invoices(LOWER(meter_number))"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_invoice_lower ON invoices(LOWER(invoice_number))"))
-            else:
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_date ON invoices(date)"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_date_id ON invoices(date, id)"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_customer ON invoices(customer_name)"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_branch ON invoices(branch_number)"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_meter ON invoices(meter_number)"))
-                db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_invoice ON invoices(invoice_number)"))
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            print("[index-setup] skipped:", e)
-    except Exception as e:
-        print("[migrate] pricing.fee_15 check:", e)
 
+# ---------------- Schema migrations ----------------
+# Ordered, versioned steps replacing the old import-time "self-healing" blocks.
+# Run once per deploy with `python migrate_db.py`; worker startup only reads
+# the current version (one query) and skips everything when it is up to date.
+class SchemaVersion(db.Model):
+    __tablename__ = "schema_version"
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255), nullable=False, default="")
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+MIGRATIONS = []   # (version, description, fn(conn)), kept sorted by version
+MIGRATION_LOCK_KEY = 727001  # pg_advisory_lock key shared by all workers
 
+def migration(version: int, description: str):
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
 
-@app.route('/dashboards')
+def _has_column(conn, table: str, col: str) -> bool:
+    insp = inspect(conn)
+    if not insp.has_table(table):
+        return False
+    return any(c.get("name") == col for c in insp.get_columns(table))
+
+def _add_column(conn, table: str, col: str, ddl: str) -> None:
+    """ALTER TABLE ... ADD COLUMN unless it already exists (SQLite has no IF NOT EXISTS here)."""
+    if inspect(conn).has_table(table) and not _has_column(conn, table, col):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {col} {ddl}"))
+        print(f"[migrate] Added {table}.{col}")
+
+@migration(1, "users.is_admin")
+def _m0001_users_is_admin(conn):
+    _add_column(conn, "users", "is_admin", "BOOLEAN NOT NULL DEFAULT FALSE")
+
+@migration(2, "pricing.fee_15")
+def _m0002_pricing_fee_15(conn):
+    _add_column(conn, "pricing", "fee_15", "REAL NOT NULL DEFAULT 0")
+
+@migration(3, "pricing.currency_code / pricing.usd_rate")
+def _m0003_pricing_currency(conn):
+    _add_column(conn, "pricing", "currency_code", "VARCHAR(8) NOT NULL DEFAULT 'LBP'")
+    _add_column(conn, "pricing", "usd_rate", "REAL NOT NULL DEFAULT 90000")
+
+@migration(4, "invoice filter/search indexes")
+def _m0004_invoice_indexes(conn):
+    if conn.engine.name == "postgresql":
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_date ON invoices(date)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_date_id_desc ON invoices(date DESC, id DESC)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_customer_lower ON invoices(LOWER(customer_name))"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_branch_lower ON invoices(LOWER(branch_number))"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_meter_lower ON invoices(LOWER(meter_number))"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_invoice_lower ON invoices(LOWER(invoice_number))"))
+    else:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_date ON invoices(date)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_date_id ON invoices(date, id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_customer ON invoices(customer_name)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_branch ON invoices(branch_number)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_meter ON invoices(meter_number)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_invoice ON invoices(invoice_number)"))
+
+@migration(5, "counters table seeded from existing invoice numbers")
+def _m0005_invoice_counters(conn):
+    Counter.__table__.create(conn, checkfirst=True)
+    last = {}
+    for (num,) in conn.execute(text("SELECT invoice_number FROM invoices")):
+        m = re.match(r"^(\d{6})-(\d+)$", num or "")
+        if m:
+            last[m.group(1)] = max(last.get(m.group(1), 0), int(m.group(2)))
+    existing = {r[0] for r in conn.execute(text("SELECT name FROM counters"))}
+    rows = [{"name": f"invoice:{k}", "value": v} for k, v in last.items() if f"invoice:{k}" not in existing]
+    if rows:
+        conn.execute(Counter.__table__.insert(), rows)
+
+@migration(6, "invoice_monthly_summary rollup (backfilled)")
+def _m0006_monthly_summary(conn):
+    InvoiceMonthlySummary.__table__.create(conn, checkfirst=True)
+    rebuild_monthly_summary(conn)
+
+@migration(7, "expenses(date, type) index")
+def _m0007_expenses_date_type(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_expenses_date_type ON expenses(date, type)"))
+
+@migration(8, "invoices.search_text + FTS5 trigram / GIN trigram search index")
+def _m0008_invoice_search(conn):
+    _add_column(conn, "invoices", "search_text", "TEXT")
+    backfill_search_text(conn)
+    create_search_index(conn)
+    _search_backend["name"] = None
+
+@migration(9, "branch_state (latest invoice per branch, backfilled)")
+def _m0009_branch_state(conn):
+    BranchState.__table__.create(conn, checkfirst=True)
+    rebuild_branch_state(conn)
+
+@migration(10, "invoices.billing_month + unique (branch_number, billing_month)")
+def _m0010_billing_month(conn):
+    _add_column(conn, "invoices", "billing_month", "VARCHAR(7)")
+    month = "to_char(date, 'YYYY-MM')" if conn.engine.name == "postgresql" else "strftime('%Y-%m', date)"
+    conn.execute(text(f"UPDATE invoices SET billing_month = {month} WHERE billing_month IS NULL"))
+    # Months billed twice before the constraint existed: the latest invoice keeps
+    # the month, older ones are left with a NULL billing_month (kept, not deleted).
+    dups = conn.execute(text("""
+        UPDATE invoices SET billing_month = NULL WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY branch_number, billing_month
+                                              ORDER BY date DESC, id DESC) AS rn
+                FROM invoices WHERE billing_month IS NOT NULL) ranked
+            WHERE rn > 1)""")).rowcount
+    if dups:
+        print(f"[migrate] {dups} duplicate invoice(s) per branch/month left without billing_month")
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_invoices_branch_month ON invoices(branch_number, billing_month)"))
+
+@migration(11, "invoices.sync_version + invoice_tombstones / sync_ops (delta sync)")
+def _m0011_delta_sync(conn):
+    _add_column(conn, "invoices", "sync_version", "BIGINT")
+    conn.execute(text("UPDATE invoices SET sync_version = 0 WHERE sync_version IS NULL"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_sync ON invoices(sync_version, id)"))
+    InvoiceTombstone.__table__.create(conn, checkfirst=True)
+    SyncOp.__table__.create(conn, checkfirst=True)
+
+@migration(12, "invoices.updated_at (indexed)")
+def _m0012_invoice_updated_at(conn):
+    _add_column(conn, "invoices", "updated_at", "TIMESTAMP")
+    conn.execute(text("UPDATE invoices SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_invoices_updated_at ON invoices(updated_at)"))
+
+def latest_schema_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def current_schema_version(conn=None) -> int:
+    """Highest applied migration, or 0 on a fresh database."""
+    try:
+        if conn is not None:
+            return int(conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0)
+        with db.engine.connect() as c:
+            return int(c.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0)
+    except Exception:
+        return 0
+
+def run_migrations() -> list:
+    """Create missing tables and apply pending migrations in order. Returns applied versions."""
+    applied = []
+    with db.engine.connect() as conn:
+        is_pg = conn.engine.name == "postgresql"
+        if is_pg:
+            # Only one worker/deploy step migrates; the others wait, then see it done.
+            conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": MIGRATION_LOCK_KEY})
+            conn.commit()
+        try:
+            db.metadata.create_all(conn)
+            conn.commit()
+            current = current_schema_version(conn)
+            for version, description, fn in MIGRATIONS:
+                if version <= current:
+                    continue
+                try:
+                    fn(conn)
+                    conn.execute(SchemaVersion.__table__.insert().values(
+                        version=version, description=description, applied_at=datetime.utcnow()))
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    if current_schema_version(conn) >= version:
+                        continue  # applied concurrently by another worker (SQLite)
+                    print(f"[migrate] {version:04d} {description} failed:", e)
+                    raise
+                applied.append(version)
+                print(f"[migrate] applied {version:04d} {description}")
+        finally:
+            if is_pg:
+                conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_KEY})
+                conn.commit()
+    return applied
+
+def ensure_schema() -> None:
+    """Worker startup check: a single version query; migrate only when behind."""
+    current = current_schema_version()
+    if current >= latest_schema_version():
+        return
+    if os.getenv("AUTO_MIGRATE", "1") == "0":
+        print(f"[migrate] schema at {current}, latest is {latest_schema_version()}; run: python migrate_db.py")
+        return
+    run_migrations()
+
+
+@routes.route('/dashboards')
 @login_required
 def dashboards():
     start_str = (request.args.get('start') or '').strip()
@@ -1701,27 +4115,22 @@ def dashboards():
     p = get_pricing()
     rate = float(p.usd_rate or 1.0) or 1.0
 
-    # --- Engine-aware label for Invoice
-    if db.engine.name == "postgresql":
-        ym_invoice = func.to_char(Invoice.date, 'YYYY-MM').label('ym')
-    else:
-        ym_invoice = func.strftime('%Y-%m', Invoice.date).label('ym')
-
-    qry = (db.session.query(
-        ym_invoice,
-        func.count(Invoice.id).label('count'),
-        func.sum(Invoice.total_due).label('total_due'),
-        func.sum(Invoice.kwh_used).label('kwh'),
-        func.sum(case((Invoice.is_paid == True, Invoice.total_due), else_=0.0)).label('paid_due')
-    ))
+    # Any rollup upsert moves max(updated_at); a month dropping out changes the count
+    S = InvoiceMonthlySummary
+    rollup_at, rollup_rows = db.session.query(func.max(S.updated_at), func.count(S.month_key)).one()
+    fresh = revalidate("dashboards", rollup_at, rollup_rows, p.updated_at, start_str, end_str,
+                       last_modified=max(d for d in (rollup_at, p.updated_at, datetime(2000, 1, 1)) if d))
+    if fresh is not None:
+        return fresh
 
+    # Read the monthly rollup (one row per month) instead of grouping the base tables
+    qry = S.query.filter(S.invoice_count > 0)
     if start_date:
-        qry = qry.filter(Invoice.date >= start_date)
+        qry = qry.filter(S.month_key >= start_date.strftime("%Y-%m"))
     if next_after_end:
-        qry = qry.filter(Invoice.date < next_after_end)
-
-    rows = qry.group_by(ym_invoice).order_by(ym_invoice).all()
-    labels = [r.ym for r in rows]
+        qry = qry.filter(S.month_key < next_after_end.strftime("%Y-%m"))
+    rows = qry.order_by(S.month_key.asc()).all()
+    labels = [r.month_key for r in rows]
 
     if not rows:
         return render_template('dashboards.html',
@@ -1738,7 +4147,7 @@ def dashboards():
     except ValueError:
         sel_idx = len(labels) - 1
 
-    invoice_counts = [int(r.count or 0) for r in rows]
+    invoice_counts = [int(r.invoice_count or 0) for r in rows]
     kwh            = [int(r.kwh or 0) for r in rows]
 
     totals_usd = [float(r.total_due or 0.0) / rate for r in rows]
@@ -1747,24 +4156,7 @@ def dashboards():
     avg_inv_usd= [totals_usd[i] / invoice_counts[i] if invoice_counts[i] else 0.0
                    for i in range(len(rows))]
 
-    # --- Engine-aware label for Expense
-    if db.engine.name == "postgresql":
-        ym_expense = func.to_char(Expense.date, 'YYYY-MM').label('ym')
-    else:
-        ym_expense = func.strftime('%Y-%m', Expense.date).label('ym')
-
-    exp_q = db.session.query(
-        ym_expense,
-        func.sum(Expense.cost).label('exp_total')
-    )
-
-    if start_date:
-        exp_q = exp_q.filter(Expense.date >= start_date)
-    if next_after_end:
-        exp_q = exp_q.filter(Expense.date < next_after_end)
-
-    exp_rows = exp_q.group_by(ym_expense).order_by(ym_expense).all()
-    exp_map = {r.ym: float(r.exp_total or 0.0) for r in exp_rows}
+    exp_map = {r.month_key: float(r.expense_total or 0.0) for r in rows}
     net_usd = [totals_usd[i] - float(exp_map.get(lbl, 0.0)) for i, lbl in enumerate(labels)]
 
     latest = {
@@ -1791,8 +4183,10 @@ def dashboards():
                            start=start_str, end=end_str)
 
 
+app = create_app()
 
 if __name__ == "__main__":
+    startup_self_check(app)
     app.run(debug=True, host="0.0.0.0", port=5000)
 
 
@@ -0,0 +1,63 @@
+# migrate_db.py
+# Usage (run from the same folder as app.py, once per deploy — e.g. Render "Pre-Deploy Command"):
+#   python migrate_db.py            # apply pending schema migrations
+#   python migrate_db.py status     # show current / latest schema version
+#   python migrate_db.py rebuild-summary   # recompute the dashboards' monthly rollup
+#   python migrate_db.py rebuild-search    # recompute invoices.search_text and the search index
+#   python migrate_db.py rebuild-branch-state   # recompute branch_state from invoices
+#
+# gunicorn workers (wsgi.py) default to AUTO_MIGRATE=0, so this script is the
+# only migrator in production; `python app.py` still migrates on start.
+
+import os
+import sys
+
+# The explicit run below is the migration; don't let the import do it implicitly.
+os.environ["AUTO_MIGRATE"] = "0"
+
+try:
+    from app import (app, db, run_migrations, current_schema_version, latest_schema_version, MIGRATIONS,
+                     rebuild_monthly_summary, backfill_search_text, create_search_index,
+                     rebuild_branch_state)
+except Exception:
+    print("Import error: make sure this file is next to app.py.")
+    raise
+
+def main():
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    with app.app_context():
+        if cmd == "status":
+            current = current_schema_version()
+            print(f"schema version: {current} (latest {latest_schema_version()})")
+            for version, description, _ in MIGRATIONS:
+                mark = "x" if version <= current else " "
+                print(f"  [{mark}] {version:04d} {description}")
+            return
+        if cmd == "rebuild-summary":
+            with db.engine.begin() as conn:
+                months = rebuild_monthly_summary(conn)
+            print(f"✓ Rebuilt invoice_monthly_summary ({months} month(s))")
+            return
+        if cmd == "rebuild-search":
+            with db.engine.begin() as conn:
+                rows = backfill_search_text(conn, only_missing=False)
+                create_search_index(conn)
+            print(f"✓ Rebuilt search text for {rows} invoice(s)")
+            return
+        if cmd == "rebuild-branch-state":
+            with db.engine.begin() as conn:
+                branches = rebuild_branch_state(conn)
+            print(f"✓ Rebuilt branch_state ({branches} branch(es))")
+            return
+        if cmd != "upgrade":
+            print("usage: python migrate_db.py [upgrade|status|rebuild-summary|rebuild-search|rebuild-branch-state]")
+            sys.exit(2)
+
+        applied = run_migrations()
+        if applied:
+            print(f"✓ Applied {len(applied)} migration(s); schema version {current_schema_version()}")
+        else:
+            print(f"✓ Schema already current (version {current_schema_version()})")
+
+if __name__ == "__main__":
+    main()
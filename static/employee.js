@@ -1,60 +1,252 @@
-
+// Employee list: search / filter / sort run on the server (/api/employee/invoices);
+// this script only fetches pages and appends rows, so the DOM holds what was asked for.
+// Offline: a local copy of the list is kept in localStorage by delta sync
+// (/api/employee/sync); readings and payments made without a connection are
+// queued with idempotency keys and replayed when the connection returns.
 (function(){
-  const qInput = document.querySelector('#emp-q');
-  const statusFilter = document.querySelector('#emp-status');
-  const sortSel = document.querySelector('#emp-sort');
-  const cards = Array.from(document.querySelectorAll('.emp-card'));
-  if(!cards.length) return;
-  function normalize(s){ return (s||'').toString().trim().toLowerCase(); }
-  function apply(){
-    const q = normalize(qInput && qInput.value);
-    const status = statusFilter ? statusFilter.value : '';
-    const sortedBy = sortSel ? sortSel.value : '';
-    cards.forEach(c => {
-      const hay = normalize(c.dataset.customer + ' ' + c.dataset.branch);
-      const paid = c.dataset.paid === '1';
-      const okQ = !q || hay.includes(q);
-      const okStatus = !status || (status === 'paid' ? paid : !paid);
-      c.style.display = (okQ && okStatus) ? '' : 'none';
+  const tbl = document.querySelector('#tbl');
+  if(!tbl || !tbl.dataset.api) return;
+  const tbody = tbl.querySelector('tbody');
+  const qInput = document.querySelector('#q');
+  const statusSel = document.querySelector('#status');
+  const ymInput = document.querySelector('#ym');
+  const sortSel = document.querySelector('#sort');
+  const moreBtn = document.querySelector('#emp-more-btn');
+  const emptyMsg = document.querySelector('#emp-empty');
+  const syncMsg = document.querySelector('#emp-sync');
+  const syncUrl = tbl.dataset.sync;
+
+  const perPage = parseInt(tbl.dataset.perPage || '50', 10);
+  let page = 1;
+  let hasMore = tbl.dataset.hasMore === '1';
+  let loading = false;
+  let seq = 0;            // drops responses that arrive after a newer search
+
+  function esc(s){
+    return (s === null || s === undefined ? '' : String(s))
+      .replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;');
+  }
+
+  function rowHtml(i){
+    const paidCell = i.pending_pay
+      ? '<button class="btn" disabled type="button">مدفوع (بانتظار الاتصال)</button>'
+      : i.is_paid
+      ? '<button class="btn" disabled type="button">مدفوع</button>'
+      : '<form action="' + esc(tbl.dataset.markPaid.replace(/\/0\//, '/' + i.id + '/')) + '" class="mark-paid-form" method="post" style="display:inline">' +
+        '<button class="btn danger" onclick="return confirm(\'هل أنت متأكد أنك تريد تغيير الحالة إلى مدفوع؟\');" type="submit">غير مدفوع</button></form>';
+    return '<tr>' +
+      '<td>' + esc(i.branch_number) + '</td>' +
+      '<td>' + esc(i.customer_name) + '</td>' +
+      '<td>' + esc(i.curr_reading) + (i.pending_reading ? ' ← ' + esc(i.pending_reading) + ' (بانتظار الاتصال)' : '') + '</td>' +
+      '<td><form action="' + esc(tbl.dataset.quickCreate) + '" method="post">' +
+        '<input name="branch_number" type="hidden" value="' + esc(i.branch_number) + '"/>' +
+        '<input min="' + esc(i.curr_reading || 0) + '" name="curr_reading" placeholder="القراءة الحالية" required style="max-width:160px" type="number"/>' +
+        '<button class="btn" type="submit">إضافة</button></form></td>' +
+      '<td>' + esc(i.date) + '</td>' +
+      '<td>' + esc(i.kwh_used) + '</td>' +
+      '<td>' + Number(i.total_due || 0).toFixed(2) + '</td>' +
+      '<td>' + paidCell + '</td>' +
+      '</tr>';
+  }
+
+  function params(p){
+    const u = new URLSearchParams();
+    if(qInput && qInput.value.trim()) u.set('q', qInput.value.trim());
+    if(statusSel && statusSel.value) u.set('status', statusSel.value);
+    if(ymInput && ymInput.value) u.set('ym', ymInput.value);
+    if(sortSel && sortSel.value) u.set('sort', sortSel.value);
+    u.set('page', p);
+    u.set('per_page', perPage);
+    return u;
+  }
+
+  function syncUi(){
+    if(moreBtn) moreBtn.hidden = !hasMore;
+    if(emptyMsg) emptyMsg.hidden = tbody.children.length > 0;
+  }
+
+  function load(p, replace){
+    if(!navigator.onLine && store.fields){ renderLocal(); return; }
+    if(loading && !replace) return;
+    loading = true;
+    const mine = ++seq;
+    const u = params(p);
+    fetch(tbl.dataset.api + '?' + u.toString(), {credentials: 'same-origin', headers: {'Accept': 'application/json'}})
+      .then(r => r.ok ? r.json() : Promise.reject(r.status))
+      .then(data => {
+        if(mine !== seq) return;
+        const html = (data.items || []).map(rowHtml).join('');
+        if(replace) tbody.innerHTML = html;
+        else tbody.insertAdjacentHTML('beforeend', html);
+        page = data.page;
+        hasMore = !!data.has_more;
+        // keep the address bar shareable (and the server-rendered first page in sync on reload)
+        u.delete('page'); u.delete('per_page');
+        history.replaceState(null, '', location.pathname + (u.toString() ? '?' + u.toString() : ''));
+        syncUi();
+      })
+      .catch(() => { if(mine === seq && store.fields) renderLocal(); })
+      .finally(() => { if(mine === seq) loading = false; });
+  }
+
+  // ---------------- Local store + offline queue ----------------
+  const STORE_KEY = 'emp-sync-v1', QUEUE_KEY = 'emp-queue-v1';
+  function readJson(k, dflt){ try { return JSON.parse(localStorage.getItem(k)) || dflt; } catch(e){ return dflt; } }
+  function writeJson(k, v){ try { localStorage.setItem(k, JSON.stringify(v)); return true; } catch(e){ return false; } }
+  let store = readJson(STORE_KEY, {cursor: null, fields: null, invoices: {}});
+  let queue = readJson(QUEUE_KEY, []);
+  let syncing = false;
+  let storageWarning = '';
+
+  function newKey(){
+    return (window.crypto && crypto.randomUUID) ? crypto.randomUUID()
+      : Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+  }
+
+  function setSyncMsg(){
+    if(!syncMsg) return;
+    const parts = [];
+    if(!navigator.onLine) parts.push('غير متصل — تُعرض النسخة المحفوظة');
+    if(queue.length) parts.push(queue.length + ' عملية بانتظار الإرسال');
+    if(storageWarning) parts.push(storageWarning);
+    syncMsg.textContent = parts.join(' · ');
+  }
+
+  function applyChanges(data){
+    const f = data.fields;
+    (data.deleted || []).forEach(id => { delete store.invoices[id]; });
+    (data.invoices || []).forEach(r => { store.invoices[r[0]] = r; });
+    store.fields = f;
+    if(data.cursor) store.cursor = data.cursor;
+    // rows that aged out of the server's sync window are dropped here
+    if(data.window_start && f){
+      const di = f.indexOf('date');
+      Object.keys(store.invoices).forEach(id => {
+        if(String(store.invoices[id][di] || '') < data.window_start) delete store.invoices[id];
+      });
+    }
+  }
+
+  // Storage quota: drop the oldest half of the local copy until it fits, and say so
+  function saveStore(){
+    if(writeJson(STORE_KEY, store)){ storageWarning = ''; return true; }
+    const di = store.fields ? store.fields.indexOf('date') : -1;
+    const ids = Object.keys(store.invoices).sort((a, b) =>
+      String(store.invoices[a][di] || '').localeCompare(String(store.invoices[b][di] || '')));
+    while(ids.length){
+      ids.splice(0, Math.ceil(ids.length / 2)).forEach(id => { delete store.invoices[id]; });
+      if(writeJson(STORE_KEY, store)){
+        storageWarning = 'مساحة التخزين ممتلئة: حُذفت الفواتير الأقدم من النسخة المحلية';
+        return true;
+      }
+    }
+    storageWarning = 'تعذّر حفظ النسخة المحلية (مساحة التخزين ممتلئة)';
+    return false;
+  }
+
+  // Client-side version of the list's filters/sort over the local copy
+  function renderLocal(){
+    const f = store.fields;
+    const q = (qInput && qInput.value.trim().toLowerCase()) || '';
+    const status = statusSel ? statusSel.value : '';
+    const ym = ymInput ? ymInput.value : '';
+    const [key, dir] = ((sortSel && sortSel.value) || 'id:desc').split(':');
+    const col = {date: 'date', amount: 'total_due', kwh: 'kwh_used'}[key] || 'id';
+    const pendingPay = new Set(queue.filter(op => op.type === 'pay').map(op => op.id));
+    const pendingReading = {};
+    queue.filter(op => op.type === 'reading').forEach(op => { pendingReading[op.branch_number] = op.curr_reading; });
+    let rows = Object.values(store.invoices).map(r => {
+      const o = {}; f.forEach((k, i) => { o[k] = r[i]; }); return o;
+    }).filter(o =>
+      (!q || [o.customer_name, o.branch_number, o.meter_number, o.invoice_number].some(v => String(v || '').toLowerCase().includes(q))) &&
+      (!status || (status === 'paid') === !!o.is_paid) &&
+      (!ym || String(o.date || '').slice(0, 7) === ym));
+    rows.sort((a, b) => (a[col] < b[col] ? -1 : a[col] > b[col] ? 1 : a.id - b.id) * (dir === 'asc' ? 1 : -1));
+    rows.forEach(o => {
+      if(pendingPay.has(o.id)) o.pending_pay = true;
+      if(o.branch_number in pendingReading) o.pending_reading = pendingReading[o.branch_number];
     });
-    if (sortedBy) {
-      const grid = cards[0].parentElement;
-      const key = sortedBy.split(':')[0];
-      const dir = sortedBy.split(':')[1] || 'desc';
-      const mult = dir === 'asc' ? 1 : -1;
-      const getVal = (c) => {
-        switch(key){
-          case 'amount': return parseFloat(c.dataset.amount||'0');
-          case 'kwh': return parseInt(c.dataset.kwh||'0', 10);
-          case 'date': return Date.parse(c.dataset.date || '1970-01-01');
-          default: return 0;
+    tbody.innerHTML = rows.map(rowHtml).join('');
+    hasMore = false;
+    syncUi(); setSyncMsg();
+  }
+
+  // One POST flushes the queue and pulls changes; further pages are pulled with empty ops
+  function sync(){
+    if(!syncUrl || syncing || !navigator.onLine) return Promise.resolve();
+    syncing = true;
+    const ops = queue.slice();
+    const step = (sendOps) => fetch(syncUrl, {
+        method: 'POST', credentials: 'same-origin',
+        headers: {'Content-Type': 'application/json', 'Accept': 'application/json'},
+        body: JSON.stringify({ops: sendOps, since: store.cursor})})
+      .then(r => r.ok ? r.json() : Promise.reject(r.status))
+      .then(data => {
+        if(sendOps.length){
+          const done = new Set((data.results || []).map(r => r.key));
+          queue = readJson(QUEUE_KEY, []).filter(op => !done.has(op.key));
+          writeJson(QUEUE_KEY, queue);
+          const failed = (data.results || []).filter(r => r.error);
+          if(failed.length) alert(failed.map(r => (r.branch_number || r.id || '') + ': ' + r.error).join('\n'));
         }
-      };
-      const visCards = cards.filter(c => c.style.display !== 'none');
-      visCards.sort((a,b) => (getVal(a) - getVal(b)) * mult);
-      visCards.forEach(c => grid.appendChild(c));
+        applyChanges(data);
+        if(data.has_more) return step([]);
+        saveStore();
+        return ops.length > 0;
+      });
+    return step(ops)
+      .catch(() => false)
+      .finally(() => { syncing = false; setSyncMsg(); });
+  }
+
+  function enqueue(op){
+    op.key = newKey();
+    queue.push(op);
+    if(!writeJson(QUEUE_KEY, queue)){
+      // the queue matters more than the cached list: make room and retry once
+      try { localStorage.removeItem(STORE_KEY); } catch(e){}
+      storageWarning = 'تعذّر حفظ النسخة المحلية (مساحة التخزين ممتلئة)';
+      if(!writeJson(QUEUE_KEY, queue)) alert('تعذّر حفظ العملية على الجهاز (مساحة التخزين ممتلئة). أعد المحاولة عند توفر الاتصال.');
     }
+    renderLocal();
   }
-  ['input','change'].forEach(ev => {
-    if(qInput) qInput.addEventListener(ev, apply);
-    if(statusFilter) statusFilter.addEventListener(ev, apply);
-    if(sortSel) sortSel.addEventListener(ev, apply);
+
+  // Without a connection the row forms queue their action instead of posting
+  tbody.addEventListener('submit', ev => {
+    if(navigator.onLine || !store.fields) return;
+    const form = ev.target;
+    ev.preventDefault();
+    if(form.classList.contains('mark-paid-form')){
+      const m = form.action.match(/\/invoice\/(\d+)\//);
+      if(m) enqueue({type: 'pay', id: parseInt(m[1], 10)});
+    } else if(form.elements.curr_reading){
+      enqueue({type: 'reading', branch_number: form.elements.branch_number.value,
+               curr_reading: parseInt(form.elements.curr_reading.value, 10),
+               date: new Date().toISOString().slice(0, 10)});
+    }
   });
-  apply();
-})();
-// when opening:
-function openModal(form){
-  pendingForm = form;
-  modal.classList.remove('mp-hidden');
-  modal.setAttribute('aria-hidden', 'false');
-  document.body.classList.add('mp-open');      // ← stop background scrolling
-}
-
-// when closing:
-function closeModal(){
-  modal.classList.add('mp-hidden');
-  modal.setAttribute('aria-hidden', 'true');
-  document.body.classList.remove('mp-open');   // ← restore scrolling
-  pendingForm = null;
-}
 
+  window.addEventListener('online', () => { setSyncMsg(); sync().then(sent => { if(sent) load(1, true); }); });
+  window.addEventListener('offline', () => { if(store.fields) renderLocal(); else setSyncMsg(); });
+
+  let timer = null;
+  function refresh(){
+    clearTimeout(timer);
+    timer = setTimeout(() => load(1, true), 250);
+  }
+
+  if(qInput) qInput.addEventListener('input', refresh);
+  [statusSel, ymInput, sortSel].forEach(el => { if(el) el.addEventListener('change', refresh); });
+  if(moreBtn) moreBtn.addEventListener('click', () => { if(hasMore) load(page + 1, false); });
+
+  // Infinite scroll: fetch the next page when the "load more" row comes into view
+  if('IntersectionObserver' in window && moreBtn){
+    new IntersectionObserver(entries => {
+      if(entries.some(e => e.isIntersecting) && hasMore && !loading) load(page + 1, false);
+    }, {rootMargin: '300px'}).observe(document.querySelector('#emp-more'));
+  }
+  syncUi();
+  setSyncMsg();
+  if(!navigator.onLine && store.fields) renderLocal();
+  else sync().then(sent => { if(sent) load(1, true); });
+})();
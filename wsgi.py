@@ -0,0 +1,18 @@
+# wsgi.py — production entry point for gunicorn:
+#   gunicorn wsgi:app --workers 2 --timeout 120
+#
+# The app is built by create_app() in app.py; this module only logs the
+# effective engine/pool/compression settings so a misconfiguration is visible.
+# Migrations run once per deploy (python migrate_db.py), not in every worker
+# at import: AUTO_MIGRATE defaults to 0 here (set AUTO_MIGRATE=1 to opt in).
+
+import os
+
+os.environ.setdefault("AUTO_MIGRATE", "0")
+
+from app import app, startup_self_check  # noqa: E402
+
+startup_self_check(app)
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000)